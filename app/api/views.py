@@ -0,0 +1,117 @@
+from flask import request, jsonify, Response, stream_with_context
+from sqlalchemy import select
+from .. import db
+from ..models import Recipe, Ingredient, recipe_detail_select, group_recipe_rows, \
+    search_recipe_by_ingredient, search_recipe_by_ingredient_amounts, get_top_recipes_page, InvalidCursor
+from ..export import EXPORT_FORMATS
+from . import api
+
+# Read-only JSON API. Everything is read with Core selects and serialized straight from the
+# row tuples, so no ORM objects are built. Responses carry an ETag of their body, and a
+# request whose If-None-Match matches it gets an empty 304 instead.
+
+MAX_BATCH = 100
+
+def json_response(payload):
+    response = jsonify(payload)
+    response.add_etag()
+    return response.make_conditional(request)
+
+def error_response(message, status):
+    return jsonify(error=message), status
+
+def serialize_recipe(row, ingredients):
+    return {
+        "id": row.id,
+        "name": row.name,
+        "time": row.time,
+        "rating": row.rating,
+        "description": row.description,
+        "steps": (row.steps or "").split("\n"),
+        "meal": row.meal,
+        "ingredients": [{"id": i.id, "name": i.name, "amount": i.amount, "measure": i.measure} for i in ingredients],
+    }
+
+def read_recipes(recipe_ids):
+    stmt = recipe_detail_select().where(Recipe.__table__.c.id.in_(recipe_ids))
+    rows = db.session.execute(stmt)
+    return [serialize_recipe(row, ingredients) for row, ingredients in group_recipe_rows(rows)]
+
+def parse_ids(value):
+    try:
+        return [int(i) for i in value.split(',') if i.strip() != '']
+    except ValueError:
+        return None
+
+@api.route('/recipes/<int:recipe_id>')
+def get_recipe(recipe_id):
+    recipes = read_recipes([recipe_id])
+    if len(recipes) == 0:
+        return error_response('recipe not found', 404)
+    return json_response(recipes[0])
+
+@api.route('/recipes')
+def get_recipes():
+    # ?ids=1,2,3 returns those recipes in id order, unknown ids are left out
+    ids = parse_ids(request.args.get('ids', ''))
+    if ids is None:
+        return error_response('ids must be a comma separated list of integers', 400)
+    if len(ids) > MAX_BATCH:
+        return error_response('at most {} ids per request'.format(MAX_BATCH), 400)
+    return json_response({"recipes": read_recipes(ids) if ids else []})
+
+@api.route('/search')
+def search():
+    # ?name=salad&ingredients=1,2,3 and optionally &amounts=5,5,5 for the amount-aware search
+    ingred_ids = parse_ids(request.args.get('ingredients', ''))
+    amounts = request.args.get('amounts')
+    try:
+        amounts = [float(a) for a in amounts.split(',')] if amounts else None
+    except ValueError:
+        return error_response('amounts must be a comma separated list of numbers', 400)
+    if ingred_ids is None:
+        return error_response('ingredients must be a comma separated list of integers', 400)
+    name = request.args.get('name', '')
+    if amounts is not None:
+        recipe_ids = search_recipe_by_ingredient_amounts(name, ingred_ids, amounts)
+    else:
+        recipe_ids = search_recipe_by_ingredient(name, ingred_ids)
+
+    recipes = []
+    if len(recipe_ids) > 0:
+        r = Recipe.__table__
+        rows = db.session.execute(select([r.c.id, r.c.name]).where(r.c.id.in_(recipe_ids)).order_by(r.c.name, r.c.id))
+        recipes = [{"id": row.id, "name": row.name} for row in rows]
+    return json_response({"recipes": recipes})
+
+@api.route('/ingredients')
+def get_ingredients():
+    i = Ingredient.__table__
+    rows = db.session.execute(select([i.c.id, i.c.name, i.c.measure]).order_by(i.c.name))
+    return json_response({"ingredients": [{"id": row.id, "name": row.name, "measure": row.measure} for row in rows]})
+
+@api.route('/top')
+def top_recipes():
+    # ?meal=dinner&after=<cursor>, best Bayesian average rating first
+    per_page = max(1, min(request.args.get('per_page', MAX_BATCH, type=int), MAX_BATCH))
+    try:
+        page = get_top_recipes_page(request.args.get('meal') or None, request.args.get('after'),
+                                    request.args.get('before'), per_page)
+    except InvalidCursor:
+        return error_response('invalid cursor', 400)
+    return json_response({
+        "recipes": [{"id": row.id, "name": row.name, "score": row.rating_score, "rating_count": row.rating_count}
+                    for row in page.items],
+        "next": page.next_cursor,
+        "prev": page.prev_cursor,
+        "total": page.total,
+    })
+
+@api.route('/export/recipes')
+def export_recipes():
+    # streams the whole catalog, ?format=ndjson (default) or csv
+    export_format = request.args.get('format', 'ndjson')
+    if export_format not in EXPORT_FORMATS:
+        return error_response('format must be one of: ' + ', '.join(sorted(EXPORT_FORMATS)), 400)
+    generate, mimetype = EXPORT_FORMATS[export_format]
+    return Response(stream_with_context(generate()), mimetype=mimetype)
@@ -0,0 +1,173 @@
+import time
+from collections import OrderedDict
+from functools import wraps
+from threading import Lock
+from flask import current_app, has_app_context
+from sqlalchemy import event, text
+from werkzeug.utils import import_string
+from . import db
+
+
+# Small in-process LRU cache with a time to live, with hit/miss counters for sizing it
+class LRUCache():
+    def __init__(self, maxsize=1024, ttl=300):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.lock = Lock()
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key, default=None):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and (self.ttl is None or entry[0] > time.monotonic()):
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return entry[1]
+            if entry is not None:
+                del self.entries[key]
+            self.misses += 1
+            return default
+
+    def set(self, key, value):
+        if self.maxsize <= 0:
+            return
+        expires = time.monotonic() + self.ttl if self.ttl is not None else None
+        with self.lock:
+            self.entries[key] = (expires, value)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.maxsize:
+                self.entries.popitem(last=False)
+                self.evictions += 1
+
+    def delete(self, key):
+        with self.lock:
+            self.entries.pop(key, None)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+    def stats(self):
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions,
+                    'hit_rate': self.hits / lookups if lookups else 0.0,
+                    'size': len(self.entries), 'maxsize': self.maxsize, 'ttl': self.ttl}
+
+
+# The catalog version is a counter in the one row catalog_version table, bumped in the same
+# transaction as every write to recipes or ingredients. Cache keys include it, so entries computed
+# against an older catalog are never returned again and age out of the LRU. Being in the database,
+# it's shared by every worker process and by manage.py commands, so a write anywhere is seen
+# everywhere. Each process reads it at most once per CATALOG_VERSION_CHECK_INTERVAL seconds,
+# and learns the new version of its own writes when they commit.
+CATALOG_VERSION_SELECT = text('SELECT version FROM catalog_version WHERE id = 1')
+CATALOG_VERSION_BUMP = text('UPDATE catalog_version SET version = version + 1 WHERE id = 1')
+CATALOG_VERSION_LOCK = text('UPDATE catalog_version SET version = version WHERE id = 1')
+catalog_version_lock = Lock()
+
+def get_catalog_version():
+    pending = db.session.info.get('catalog_version')
+    if pending is not None:
+        # this transaction changed the catalog and hasn't committed, don't remember its version
+        return pending
+    checked = current_app.extensions.get('catalog_version')
+    now = time.monotonic()
+    if checked is not None and now - checked[1] < current_app.config['CATALOG_VERSION_CHECK_INTERVAL']:
+        return checked[0]
+    version = db.session.execute(CATALOG_VERSION_SELECT).scalar() or 0
+    current_app.extensions['catalog_version'] = (version, now)
+    return version
+
+def bump_catalog_version(session=None):
+    # bumps the version once per transaction, as part of it, and returns the new version.
+    # On sqlite the update also takes the database write lock, on postgres it locks the row,
+    # so catalog writes that bump first are serialized until they commit.
+    session = session or db.session
+    if session.info.get('catalog_version') is None:
+        session.execute(CATALOG_VERSION_BUMP)
+        session.info['catalog_version'] = session.execute(CATALOG_VERSION_SELECT).scalar() or 0
+    return session.info['catalog_version']
+
+def lock_catalog_version(session=None):
+    # takes the same lock as bump_catalog_version without bumping, for a writer that has to
+    # read the catalog (max ids, existing names) before it knows whether it changes anything
+    (session or db.session).execute(CATALOG_VERSION_LOCK)
+
+def forget_catalog_version():
+    current_app.extensions.pop('catalog_version', None)
+
+@event.listens_for(db.session, 'after_commit')
+def catalog_version_commit_listener(session):
+    version = session.info.pop('catalog_version', None)
+    if version is not None and has_app_context():
+        with catalog_version_lock:
+            # another thread may have committed a newer version already
+            checked = current_app.extensions.get('catalog_version')
+            if checked is None or checked[0] < version:
+                current_app.extensions['catalog_version'] = (version, time.monotonic())
+
+@event.listens_for(db.session, 'after_rollback')
+def catalog_version_rollback_listener(session):
+    session.info.pop('catalog_version', None)
+
+# Named per-app caches, created on first use
+def get_cache(name, maxsize, ttl):
+    cache = current_app.extensions.get(name)
+    if cache is None:
+        cache = current_app.extensions.setdefault(name, LRUCache(maxsize, ttl))
+    return cache
+
+def get_search_cache():
+    return get_cache('search_cache', current_app.config['SEARCH_CACHE_SIZE'], current_app.config['SEARCH_CACHE_TTL'])
+
+# Row counts for the paginated listings only need to be approximately right,
+# so they're cached for COUNT_CACHE_TTL seconds instead of counted on every request
+def get_count_cache():
+    return get_cache('count_cache', 1024, current_app.config['COUNT_CACHE_TTL'])
+
+def cached_count(key, count_fn):
+    cache = get_count_cache()
+    count = cache.get(key)
+    if count is None:
+        count = count_fn()
+        cache.set(key, count)
+    return count
+
+def get_search_cache_stats():
+    return get_search_cache().stats()
+
+# Rendered page fragments. The backend is any class taking (maxsize, ttl) with the
+# get/set/delete/clear methods of LRUCache, named by FRAGMENT_CACHE_BACKEND, so a shared
+# store can replace the in-process LRU without touching the views. Keys that depend on the
+# catalog should include get_catalog_version(), which every process reads from the database.
+def get_fragment_cache():
+    cache = current_app.extensions.get('fragment_cache')
+    if cache is None:
+        backend = current_app.config['FRAGMENT_CACHE_BACKEND']
+        if isinstance(backend, str):
+            backend = import_string(backend)
+        cache = current_app.extensions.setdefault('fragment_cache', backend(
+            current_app.config['FRAGMENT_CACHE_SIZE'], current_app.config['FRAGMENT_CACHE_TTL']))
+    return cache
+
+# Caches a search function's result list under (function name, catalog version, key_fn(*args)).
+# key_fn takes the same arguments as the search and returns a normalized hashable key.
+def cached_search(key_fn):
+    def decorator(fn):
+        @wraps(fn)
+        def wrapper(*args, **kwargs):
+            cache = get_search_cache()
+            key = (fn.__name__, get_catalog_version(), key_fn(*args, **kwargs))
+            result = cache.get(key)
+            if result is None:
+                result = tuple(fn(*args, **kwargs))
+                cache.set(key, result)
+            # callers get their own list so they can't change the cached one
+            return list(result)
+        wrapper.uncached = fn
+        return wrapper
+    return decorator
@@ -0,0 +1,63 @@
+import csv
+import io
+import json
+from . import db
+from .models import recipe_detail_select, group_recipe_rows
+
+# Streaming export of the whole recipe catalog. Rows come from a server-side cursor
+# (stream_results) fetched batch_size at a time and are turned into output lines by
+# generators, so memory use doesn't depend on the size of the catalog.
+
+CSV_COLUMNS = ['recipe_id', 'recipe_name', 'time', 'rating', 'description', 'steps', 'meal', 'spoonacular_id',
+               'ingredient_id', 'ingredient_name', 'amount', 'measure']
+
+def iter_recipe_rows(batch_size=1000):
+    result = db.session.execute(recipe_detail_select().execution_options(stream_results=True))
+    try:
+        while True:
+            rows = result.fetchmany(batch_size)
+            if not rows:
+                break
+            for row in rows:
+                yield row
+    finally:
+        result.close()
+
+def export_recipes_ndjson(batch_size=1000):
+    # one JSON object per line, a recipe with its list of ingredients
+    for row, ingredients in group_recipe_rows(iter_recipe_rows(batch_size)):
+        yield json.dumps({
+            "id": row.id,
+            "name": row.name,
+            "time": row.time,
+            "rating": row.rating,
+            "description": row.description,
+            "steps": row.steps,
+            "meal": row.meal,
+            "spoonacular_id": row.spoonacular_id,
+            "ingredients": [{"id": i.id, "name": i.name, "amount": i.amount, "measure": i.measure}
+                            for i in ingredients],
+        }) + "\n"
+
+def export_recipes_csv(batch_size=1000):
+    # one line per (recipe, ingredient), recipes without ingredients get a single line
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+
+    def flush():
+        line = buffer.getvalue()
+        buffer.seek(0)
+        buffer.truncate()
+        return line
+
+    writer.writerow(CSV_COLUMNS)
+    yield flush()
+    for row in iter_recipe_rows(batch_size):
+        writer.writerow([row.id, row.name, row.time, row.rating, row.description, row.steps, row.meal, row.spoonacular_id,
+                         row.i_id, row.i_name, row.amount, row.measure])
+        yield flush()
+
+EXPORT_FORMATS = {
+    'ndjson': (export_recipes_ndjson, 'application/x-ndjson'),
+    'csv': (export_recipes_csv, 'text/csv'),
+}
@@ -0,0 +1,176 @@
+import queue
+import threading
+from collections import namedtuple
+from concurrent.futures import Future, ThreadPoolExecutor, TimeoutError
+from time import monotonic
+from flask import current_app
+from . import db
+from .models import Recipe, Ingredient, search_recipe_by_ingredient
+from .cache import get_cache
+from app.integrations.spoonacular_module import spoonacular_module
+
+# Ingredient search topped up from spoonacular. The remote keyword lookup is only started when
+# the local search finds fewer than HYBRID_SEARCH_MIN_RESULTS recipes, and is waited on until
+# HYBRID_SEARCH_DEADLINE seconds after the search started. At most HYBRID_SEARCH_MAX_PENDING
+# lookups are queued or running, a search finding them all taken goes without. A lookup still
+# queued at the deadline is cancelled. One already running can't be interrupted, when it
+# finishes its recipes are cached for the next search and queued for a background thread to
+# ingest into the catalog.
+
+# one search result, source is 'local' (id is a recipe id) or 'spoonacular' (id is a spoonacular id)
+HybridResult = namedtuple('HybridResult', ['id', 'name', 'source'])
+
+def get_remote_search_client():
+    client = current_app.extensions.get('spoonacular_client')
+    if client is None:
+        client = current_app.extensions.setdefault('spoonacular_client', spoonacular_module())
+    return client
+
+def get_remote_search_executor():
+    executor = current_app.extensions.get('remote_search_executor')
+    if executor is None:
+        executor = current_app.extensions.setdefault('remote_search_executor', ThreadPoolExecutor(
+            max_workers=current_app.config['HYBRID_SEARCH_WORKERS']))
+    return executor
+
+def get_remote_search_slots():
+    slots = current_app.extensions.get('remote_search_slots')
+    if slots is None:
+        slots = current_app.extensions.setdefault('remote_search_slots', threading.BoundedSemaphore(
+            current_app.config['HYBRID_SEARCH_MAX_PENDING']))
+    return slots
+
+def get_remote_search_cache():
+    return get_cache('remote_search_cache', 256, current_app.config['REMOTE_SEARCH_CACHE_TTL'])
+
+
+# Recipes found remotely are ingested by one background thread per app, so request threads
+# never wait on the import and imports never run concurrently with each other. The queue holds
+# at most maxsize result lists, more are dropped, they'll be found again by a later search.
+class IngestionQueue():
+    def __init__(self, app, maxsize=0):
+        self.app = app
+        self.queue = queue.Queue(maxsize)
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def put(self, recipes):
+        try:
+            self.queue.put_nowait(recipes)
+        except queue.Full:
+            self.app.logger.warning('ingestion queue full, dropped %d remote recipes', len(recipes))
+
+    def join(self):
+        # blocks until everything queued so far has been ingested
+        self.queue.join()
+
+    def run(self):
+        from .ingestion import ingest_spoonacular_responses
+        while True:
+            recipes = self.queue.get()
+            try:
+                with self.app.app_context():
+                    ingest_spoonacular_responses([(None, recipes)])
+                    db.session.remove()
+            except Exception:
+                self.app.logger.exception('ingesting remote search results failed')
+            finally:
+                self.queue.task_done()
+
+def get_ingestion_queue():
+    ingestion_queue = current_app.extensions.get('ingestion_queue')
+    if ingestion_queue is None:
+        ingestion_queue = current_app.extensions.setdefault('ingestion_queue', IngestionQueue(
+            current_app._get_current_object(), current_app.config['HYBRID_INGESTION_QUEUE_SIZE']))
+    return ingestion_queue
+
+
+def remote_query(recipe_name, ingred_ids):
+    # the keyword sent to spoonacular: the name searched for, or else the ingredients' names
+    if recipe_name:
+        return recipe_name
+    if not ingred_ids:
+        return ""
+    names = db.session.query(Ingredient.name).filter(Ingredient.id.in_(ingred_ids)).order_by(Ingredient.name)
+    return " ".join(name for name, in names)
+
+def start_remote_search(query):
+    # returns a future of the remote recipes, already resolved when they are cached, or None
+    # when HYBRID_SEARCH_MAX_PENDING lookups are already pending
+    cache = get_remote_search_cache()
+    number = current_app.config['HYBRID_SEARCH_REMOTE_RESULTS']
+    key = (query, number)
+    cached = cache.get(key)
+    if cached is not None:
+        future = Future()
+        future.set_result(cached)
+        return future
+    slots = get_remote_search_slots()
+    if not slots.acquire(blocking=False):
+        return None
+    client = get_remote_search_client()
+    ingestion_queue = get_ingestion_queue()
+    logger = current_app.logger
+    future = get_remote_search_executor().submit(client.get_recipes_by_keyword, query, number)
+
+    def finished(future):
+        # called when the lookup finished or was cancelled
+        slots.release()
+        if future.cancelled():
+            return
+        if future.exception() is not None:
+            logger.warning('remote recipe search for %r failed: %s', query, future.exception())
+            return
+        recipes = future.result()
+        cache.set(key, recipes)
+        if recipes:
+            ingestion_queue.put(recipes)
+    future.add_done_callback(finished)
+    return future
+
+def hybrid_search(recipe_name="", ingred_ids=[], min_results=None, deadline=None):
+    # returns ([HybridResult], remote status), the status being 'skipped' (enough local hits),
+    # 'busy' (too many lookups pending), 'ok', 'timeout' (the deadline passed first) or 'error'
+    started = monotonic()
+    config = current_app.config
+    min_results = config['HYBRID_SEARCH_MIN_RESULTS'] if min_results is None else min_results
+    deadline = config['HYBRID_SEARCH_DEADLINE'] if deadline is None else deadline
+
+    local_ids = search_recipe_by_ingredient(recipe_name, ingred_ids)
+    rows = db.session.query(Recipe.id, Recipe.name, Recipe.spoonacular_id).filter(Recipe.id.in_(local_ids)).all() \
+        if local_ids else []
+    position = {id: idx for idx, id in enumerate(local_ids)}
+    rows.sort(key=lambda row: position[row.id])
+    results = [HybridResult(row.id, row.name, 'local') for row in rows]
+    if len(results) >= min_results:
+        return results, 'skipped'
+    query = remote_query(recipe_name, ingred_ids)
+    if not query:
+        return results, 'skipped'
+    future = start_remote_search(query)
+    if future is None:
+        return results, 'busy'
+
+    try:
+        remote = future.result(timeout=max(0, deadline - (monotonic() - started)))
+    except TimeoutError:
+        # only takes effect while the lookup is still queued behind others
+        future.cancel()
+        return results, 'timeout'
+    except Exception:
+        return results, 'error'
+    # recipes that were ingested already are returned as the local recipe, once
+    remote_ids = [recipe['id'] for recipe in remote if 'id' in recipe]
+    ingested = {row.spoonacular_id: row for row in db.session.query(Recipe.id, Recipe.name, Recipe.spoonacular_id)
+                .filter(Recipe.spoonacular_id.in_(remote_ids))} if remote_ids else {}
+    listed = {result.id for result in results}
+    for recipe in remote:
+        if 'id' not in recipe:
+            continue
+        row = ingested.get(recipe['id'])
+        if row is None:
+            results.append(HybridResult(recipe['id'], recipe.get('title'), 'spoonacular'))
+        elif row.id not in listed:
+            results.append(HybridResult(row.id, row.name, 'local'))
+            listed.add(row.id)
+    return results, 'ok'
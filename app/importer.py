@@ -0,0 +1,263 @@
+import csv
+import hashlib
+import json
+import time
+from itertools import groupby, islice
+from sqlalchemy import func, and_, or_, text
+from . import db
+from .models import Recipe, Ingredient, RI_Association
+from .cache import bump_catalog_version, lock_catalog_version
+
+# Bulk loader for the NDJSON and CSV files written by app/export.py.
+# Recipes are read lazily and inserted batch_size at a time with bulk mappings and one commit
+# per batch. Ingredients are resolved by name through a dict loaded once, unknown names are
+# inserted with the batch. Recipe ids are reserved here, so the RI rows can be built without
+# reading anything back. Ids in the file are ignored, the import appends to the catalog.
+# Each batch first takes the catalog write lock (see lock_catalog_version), so what it reads
+# (existing recipes and ingredient names, max(id) outside postgres) can't change under it
+# through add_recipe, another import or the ingestion thread before it commits.
+# Imports are idempotent: a recipe with a spoonacular_id replaces the stored recipe with that
+# id if its content changed and is skipped if it didn't, a recipe without one is skipped when
+# a recipe with the same content hash (and no spoonacular id) is already stored.
+
+def read_ndjson_recipes(lines):
+    for line in lines:
+        line = line.strip()
+        if line:
+            yield json.loads(line)
+
+def read_csv_recipes(lines):
+    # one line per (recipe, ingredient) like the csv export, consecutive lines of a recipe are merged
+    rows = csv.DictReader(lines)
+    for _, recipe_rows in groupby(rows, key=lambda row: (row['recipe_id'], row['recipe_name'])):
+        recipe_rows = list(recipe_rows)
+        first = recipe_rows[0]
+        yield {
+            "name": first['recipe_name'],
+            "time": int(first['time']) if first['time'] else None,
+            "rating": float(first['rating']) if first['rating'] else None,
+            "description": first['description'],
+            "steps": first['steps'],
+            "meal": first.get('meal') or None,
+            "spoonacular_id": int(first['spoonacular_id']) if first.get('spoonacular_id') else None,
+            "ingredients": [{"name": row['ingredient_name'],
+                             "amount": float(row['amount']) if row['amount'] else None,
+                             "measure": row['measure'] or None}
+                            for row in recipe_rows if row['ingredient_name']],
+        }
+
+IMPORT_FORMATS = {
+    'ndjson': read_ndjson_recipes,
+    'csv': read_csv_recipes,
+}
+
+def import_recipes(recipes, batch_size=1000, progress=None, source_stage='read'):
+    # recipes is an iterable of dicts shaped like the NDJSON export, progress is called
+    # with the running stats after every batch. Returns the final stats, which include the
+    # seconds spent in each stage: pulling recipes from the iterable (named source_stage),
+    # resolving ingredient names, inserting, and committing.
+    ingredient_ids = dict(db.session.query(Ingredient.name, Ingredient.id))
+    stats = {'recipes': 0, 'updated': 0, 'unchanged': 0, 'ingredient_lines': 0, 'new_ingredients': 0, 'seconds': 0.0,
+             'stages': {source_stage: 0.0, 'resolve': 0.0, 'insert': 0.0, 'commit': 0.0}}
+    stages = stats['stages']
+    start = time.perf_counter()
+    recipes = iter(recipes)
+    changed = 0
+    try:
+        while True:
+            stage_start = time.perf_counter()
+            batch = list(islice(recipes, batch_size))
+            stages[source_stage] += time.perf_counter() - stage_start
+            if not batch:
+                break
+
+            stage_start = time.perf_counter()
+            lock_catalog_version()
+            resolve_ingredients(batch, ingredient_ids, stats)
+            stages['resolve'] += time.perf_counter() - stage_start
+
+            stage_start = time.perf_counter()
+            insert_recipe_batch(batch, ingredient_ids, stats)
+            stages['insert'] += time.perf_counter() - stage_start
+
+            stage_start = time.perf_counter()
+            # a batch of known recipes leaves the catalog version, and so every cache and index, alone
+            if stats['recipes'] + stats['new_ingredients'] > changed:
+                changed = stats['recipes'] + stats['new_ingredients']
+                bump_catalog_version()
+            db.session.commit()
+            stages['commit'] += time.perf_counter() - stage_start
+
+            stats['seconds'] = time.perf_counter() - start
+            if progress is not None:
+                progress(stats)
+    except Exception:
+        # releases the catalog lock, the batches committed so far stay in the catalog
+        db.session.rollback()
+        raise
+    return stats
+
+def format_import_stats(stats):
+    rate = stats['recipes'] / stats['seconds'] if stats['seconds'] else 0.0
+    line = "{recipes} recipes ({updated} updated, {unchanged} unchanged), {ingredient_lines} ingredient lines, {new_ingredients} new ingredients " \
+           "in {seconds:.1f}s ({rate:.0f} recipes/s)".format(rate=rate, **stats)
+    stages = ["{} {:.2f}s ({:.0f}/s)".format(stage, seconds, stats['recipes'] / seconds if seconds else 0.0)
+              for stage, seconds in stats['stages'].items()]
+    return line + "; " + ", ".join(stages)
+
+def resolve_ingredients(batch, ingredient_ids, stats):
+    # adds the batch's unknown ingredient names to the database and to ingredient_ids
+    new_ingredients = {}
+    for recipe in batch:
+        for line in recipe.get('ingredients') or []:
+            name = line['name']
+            if name not in ingredient_ids and name not in new_ingredients:
+                new_ingredients[name] = {'name': name, 'measure': line.get('measure')}
+    if new_ingredients:
+        # another writer may have added some since ingredient_ids was loaded
+        for name, id in db.session.query(Ingredient.name, Ingredient.id).filter(
+                Ingredient.name.in_(list(new_ingredients))):
+            ingredient_ids[name] = id
+            del new_ingredients[name]
+    if new_ingredients:
+        # return_defaults fills in the new ids, there are few of these once the pantry is known
+        mappings = list(new_ingredients.values())
+        db.session.bulk_insert_mappings(Ingredient, mappings, return_defaults=True)
+        for mapping in mappings:
+            ingredient_ids[mapping['name']] = mapping['id']
+        stats['new_ingredients'] += len(mappings)
+
+def recipe_content_hash(recipe):
+    # sha256 of everything the import stores for a recipe, with the numbers normalized
+    # so the NDJSON and CSV forms of the same recipe hash the same
+    ingredients = {}
+    for line in recipe.get('ingredients') or []:
+        amount = line.get('amount')
+        ingredients.setdefault(line['name'], [float(amount) if amount is not None else None, line.get('measure')])
+    rating = recipe.get('rating', 4.5)
+    content = [recipe.get('name'), recipe.get('time'), float(rating) if rating is not None else None,
+               recipe.get('description', ""), recipe.get('steps'), recipe.get('meal'), sorted(ingredients.items())]
+    return hashlib.sha256(json.dumps(content).encode()).hexdigest()
+
+def stored_recipe_content_hash(recipe, ingredients):
+    # recipe_content_hash of a stored recipe, recipe having the recipes columns and ingredients
+    # being (name, amount, measure) lines. Equal to the hash of the recipe's export.
+    return recipe_content_hash({'name': recipe.name, 'time': recipe.time, 'rating': recipe.rating,
+                                'description': recipe.description, 'steps': recipe.steps, 'meal': recipe.meal,
+                                'ingredients': [{'name': name, 'amount': amount, 'measure': measure}
+                                                for name, amount, measure in ingredients]})
+
+# the recipe columns and ingredient lines the hash covers, of the recipes stored without one
+STORED_RECIPES_SELECT = text(
+    'SELECT r.id, r.name, r.time, r.rating, r.description, r.steps, r.meal, r.spoonacular_id, '
+    'i.name AS i_name, ri.amount, i.measure FROM recipes r '
+    'LEFT OUTER JOIN "RI" ri ON ri.r_id = r.id LEFT OUTER JOIN ingredients i ON i.id = ri.i_id '
+    'WHERE r.content_hash IS NULL ORDER BY r.id, ri.i_id')
+
+def backfill_content_hashes(connection):
+    # sets content_hash on the recipes stored without one, so importing them again (or their
+    # export) is recognized. Only one recipe without a spoonacular id may have a given hash, of
+    # identical ones the oldest gets it. Returns the number of recipes hashed.
+    taken = {h for h, in connection.execute(text(
+        'SELECT content_hash FROM recipes WHERE content_hash IS NOT NULL AND spoonacular_id IS NULL'))}
+    updates = []
+    rows = connection.execute(STORED_RECIPES_SELECT)
+    for _, recipe_rows in groupby(rows, key=lambda row: row.id):
+        recipe_rows = list(recipe_rows)
+        recipe = recipe_rows[0]
+        content_hash = stored_recipe_content_hash(recipe, [(row.i_name, row.amount, row.measure)
+                                                           for row in recipe_rows if row.i_name is not None])
+        if recipe.spoonacular_id is None:
+            if content_hash in taken:
+                continue
+            taken.add(content_hash)
+        updates.append({'id': recipe.id, 'content_hash': content_hash})
+    if updates:
+        connection.execute(text('UPDATE recipes SET content_hash = :content_hash WHERE id = :id'), updates)
+    return len(updates)
+
+def find_existing_recipes(batch, hashes):
+    # one query for the stored recipes the batch could match, as {spoonacular id: (id, hash)}
+    # and {hash: id} for recipes stored without a spoonacular id
+    spoonacular_ids = [recipe['spoonacular_id'] for recipe in batch if recipe.get('spoonacular_id') is not None]
+    plain_hashes = [h for recipe, h in zip(batch, hashes) if recipe.get('spoonacular_id') is None]
+    by_spoonacular_id, by_hash = {}, {}
+    if not spoonacular_ids and not plain_hashes:
+        return by_spoonacular_id, by_hash
+    rows = db.session.query(Recipe.id, Recipe.spoonacular_id, Recipe.content_hash).filter(or_(
+        Recipe.spoonacular_id.in_(spoonacular_ids),
+        and_(Recipe.spoonacular_id.is_(None), Recipe.content_hash.in_(plain_hashes))))
+    for id, spoonacular_id, content_hash in rows:
+        if spoonacular_id is not None:
+            by_spoonacular_id[spoonacular_id] = (id, content_hash)
+        else:
+            by_hash[content_hash] = id
+    return by_spoonacular_id, by_hash
+
+def reserve_recipe_ids(count):
+    # ids for count new recipes. Postgres hands them out from the recipes id sequence that
+    # add_recipe draws from as well, elsewhere the caller holds the catalog lock, so max(id)
+    # can't move before it commits.
+    if count == 0:
+        return []
+    if db.engine.dialect.name == 'postgresql':
+        rows = db.session.execute("SELECT nextval(pg_get_serial_sequence('recipes', 'id')) "
+                                  "FROM generate_series(1, :count)", {'count': count})
+        return [id for id, in rows]
+    next_id = (db.session.query(func.max(Recipe.id)).scalar() or 0) + 1
+    return list(range(next_id, next_id + count))
+
+def insert_recipe_batch(batch, ingredient_ids, stats):
+    hashes = [recipe_content_hash(recipe) for recipe in batch]
+    by_spoonacular_id, by_hash = find_existing_recipes(batch, hashes)
+    # one id per recipe that could be new, the ones not used for a skipped or updated recipe are gaps
+    new_ids = iter(reserve_recipe_ids(sum(
+        1 for recipe, content_hash in zip(batch, hashes)
+        if (recipe['spoonacular_id'] not in by_spoonacular_id if recipe.get('spoonacular_id') is not None
+            else content_hash not in by_hash))))
+    seen = set()
+    recipe_rows = []
+    updated_rows = []
+    ri_rows = []
+    for recipe, content_hash in zip(batch, hashes):
+        spoonacular_id = recipe.get('spoonacular_id')
+        # a recipe repeated within the batch is only written once
+        key = ('spoonacular', spoonacular_id) if spoonacular_id is not None else ('hash', content_hash)
+        if key in seen:
+            stats['unchanged'] += 1
+            continue
+        seen.add(key)
+        if spoonacular_id is not None and spoonacular_id in by_spoonacular_id:
+            r_id, stored_hash = by_spoonacular_id[spoonacular_id]
+            if stored_hash == content_hash:
+                stats['unchanged'] += 1
+                continue
+            rows = updated_rows
+        elif spoonacular_id is None and content_hash in by_hash:
+            stats['unchanged'] += 1
+            continue
+        else:
+            r_id = next(new_ids)
+            rows = recipe_rows
+        rows.append({'id': r_id, 'name': recipe['name'], 'time': recipe.get('time'),
+                     'rating': recipe.get('rating', 4.5), 'description': recipe.get('description', ""),
+                     'steps': recipe.get('steps'), 'meal': recipe.get('meal'),
+                     'spoonacular_id': spoonacular_id, 'content_hash': content_hash})
+        ingredients_seen = set()
+        for line in recipe.get('ingredients') or []:
+            i_id = ingredient_ids[line['name']]
+            # (r_id, i_id) is the RI key, the first line of a repeated ingredient wins
+            if i_id in ingredients_seen:
+                continue
+            ingredients_seen.add(i_id)
+            ri_rows.append({'r_id': r_id, 'i_id': i_id, 'amount': line.get('amount')})
+    if updated_rows:
+        # a changed recipe keeps its id (and so its reviews and saves), its ingredient lines are replaced
+        updated_ids = [row['id'] for row in updated_rows]
+        db.session.query(RI_Association).filter(RI_Association.r_id.in_(updated_ids)).delete(synchronize_session=False)
+        db.session.bulk_update_mappings(Recipe, updated_rows)
+    db.session.bulk_insert_mappings(Recipe, recipe_rows)
+    db.session.bulk_insert_mappings(RI_Association, ri_rows)
+    stats['recipes'] += len(recipe_rows) + len(updated_rows)
+    stats['updated'] += len(updated_rows)
+    stats['ingredient_lines'] += len(ri_rows)
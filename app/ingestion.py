@@ -0,0 +1,55 @@
+from .importer import import_recipes
+
+# Spoonacular ingestion as a staged pipeline: responses are parsed into recipe dicts shaped
+# like the NDJSON export, then handed to import_recipes, which resolves ingredient names
+# against one preloaded name -> id map and bulk inserts the recipes a batch per commit.
+# The returned stats have the time spent in each stage (parse, resolve, insert, commit).
+
+def parse_spoonacular_ingredient(ingredient):
+    # amounts are stored in the api's metric measure, ingredients without one are skipped
+    metric = (ingredient.get('measures') or {}).get('metric') or {}
+    if 'name' not in ingredient or 'unitShort' not in metric:
+        return None
+    return {"name": ingredient['name'], "amount": metric.get('amount'), "measure": metric['unitShort']}
+
+def parse_spoonacular_steps(recipe):
+    if recipe.get('instructions'):
+        return recipe['instructions']
+    steps = ""
+    for ins in recipe.get('analyzedInstructions') or []:
+        # the api groups steps as [{"name": ..., "steps": [{"step": ...}]}]
+        if 'step' in ins:
+            steps += ins['step'] + '\n'
+        for step in ins.get('steps') or []:
+            steps += step['step'] + '\n'
+    return steps
+
+def parse_spoonacular_recipe(recipe, meal=None):
+    if 'readyInMinutes' in recipe:
+        time = recipe['readyInMinutes']
+    else:
+        time = recipe.get('preparationMinutes', 0) + recipe.get('cookingMinutes', 0)
+    ingredients = []
+    for ingredient in recipe.get('extendedIngredients') or []:
+        line = parse_spoonacular_ingredient(ingredient)
+        if line is not None:
+            ingredients.append(line)
+    return {
+        "name": recipe.get('title'),
+        "time": time,
+        "rating": recipe['spoonacularScore'] % 6 if 'spoonacularScore' in recipe else 4.5,
+        "description": recipe.get('summary') or '',
+        "steps": parse_spoonacular_steps(recipe),
+        "meal": meal,
+        "spoonacular_id": recipe.get('id'),
+        "ingredients": ingredients,
+    }
+
+def parse_spoonacular_responses(responses):
+    # responses are (meal, list of api recipes) pairs
+    for meal, recipes in responses:
+        for recipe in recipes:
+            yield parse_spoonacular_recipe(recipe, meal)
+
+def ingest_spoonacular_responses(responses, batch_size=500, progress=None):
+    return import_recipes(parse_spoonacular_responses(responses), batch_size, progress, source_stage='parse')
@@ -0,0 +1,106 @@
+from bisect import bisect_left, insort
+from heapq import nsmallest
+from threading import Lock
+from flask import current_app
+from sqlalchemy import func
+from . import db
+from .cache import get_catalog_version
+from .search_index import is_next_version
+
+
+# Per-process prefix index for the ingredient autocomplete box.
+# Every word of every ingredient name is stored lowercased as a (suffix, ingredient id) entry
+# of one sorted list, so "carr" finds both "carrots" and "baby carrots" with two bisects.
+# Matches are ranked by how many recipes use the ingredient (its RI row count).
+# Like the recipe index it's rebuilt when the catalog version moves and its structures are
+# swapped rather than changed, see app/search_index.py.
+class IngredientPrefixIndex():
+    def __init__(self):
+        self.lock = Lock()
+        self.build_lock = Lock()
+        self.built = False
+        self.version = None
+        self.entries = []
+        self.names = {}
+        self.popularity = {}
+
+    def build(self):
+        from .models import Ingredient, RI_Association
+        version = get_catalog_version()
+        ingredients = db.session.query(Ingredient.id, Ingredient.name).all()
+        counts = db.session.query(RI_Association.i_id, func.count()).group_by(RI_Association.i_id).all()
+        entries = []
+        for i_id, name in ingredients:
+            entries.extend(name_keys(i_id, name))
+        entries.sort()
+        with self.lock:
+            self.entries = entries
+            self.names = {i_id: name for i_id, name in ingredients}
+            self.popularity = {i_id: count for i_id, count in counts}
+            self.built = True
+            self.version = version
+
+    def ensure_built(self):
+        if self.built and self.version == get_catalog_version():
+            return
+        with self.build_lock:
+            if not self.built or self.version != get_catalog_version():
+                self.build()
+
+    def clear(self):
+        with self.lock:
+            self.entries = []
+            self.names = {}
+            self.popularity = {}
+            self.built = False
+            self.version = None
+
+    def add_ingredient(self, ingredient_id, name, versions):
+        with self.lock:
+            if is_next_version(self, versions):
+                entries = list(self.entries)
+                for entry in name_keys(ingredient_id, name):
+                    insort(entries, entry)
+                self.names = {**self.names, ingredient_id: name}
+                self.entries = entries
+                self.version = versions[1]
+
+    def add_recipe(self, ingred_ids, versions):
+        with self.lock:
+            if is_next_version(self, versions):
+                popularity = dict(self.popularity)
+                for i_id in set(ingred_ids):
+                    popularity[i_id] = popularity.get(i_id, 0) + 1
+                self.popularity = popularity
+                self.version = versions[1]
+
+    def search(self, term, limit):
+        # returns up to limit (id, name) tuples, most used ingredients first
+        self.ensure_built()
+        term = (term or "").strip().lower()
+        if not term:
+            return []
+        with self.lock:
+            entries, popularity, names = self.entries, self.popularity, self.names
+        lo = bisect_left(entries, (term,))
+        hi = bisect_left(entries, (term + '\U0010ffff',))
+        matches = {i_id for _, i_id in entries[lo:hi]}
+        ranked = nsmallest(limit, matches, key=lambda i_id: (-popularity.get(i_id, 0), names[i_id]))
+        return [(i_id, names[i_id]) for i_id in ranked]
+
+
+def name_keys(ingredient_id, name):
+    # one entry per word start, e.g. "baby carrots" -> "baby carrots", "carrots"
+    name = (name or "").lower()
+    keys = []
+    for idx, char in enumerate(name):
+        if not char.isspace() and (idx == 0 or name[idx - 1].isspace()):
+            keys.append((name[idx:], ingredient_id))
+    return keys
+
+
+def get_ingredient_prefix_index():
+    index = current_app.extensions.get('ingredient_prefix_index')
+    if index is None:
+        index = current_app.extensions.setdefault('ingredient_prefix_index', IngredientPrefixIndex())
+    return index
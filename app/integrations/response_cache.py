@@ -0,0 +1,110 @@
+import hashlib
+import json
+import os
+import tempfile
+import threading
+import time
+
+
+class ResponseCacheMiss(LookupError):
+    pass
+
+
+# Content addressed on-disk cache of api responses. An entry's file name is the sha256 of its
+# endpoint and query (without the api key), so the same request always finds the same file,
+# from any process. Entries older than ttl seconds count as misses, except in replay mode,
+# which serves whatever is stored so re-seeding a database works offline and repeatably.
+# When the files grow past max_bytes the least recently used ones are deleted.
+class DiskResponseCache():
+    def __init__(self, directory, ttl=None, max_bytes=None):
+        self.directory = directory
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        self.total_bytes = None
+
+    def key(self, path, params):
+        params = {k: str(v) for k, v in params.items() if k != 'apiKey'}
+        return hashlib.sha256(json.dumps([path, params], sort_keys=True).encode()).hexdigest()
+
+    def filename(self, key):
+        return os.path.join(self.directory, key[:2], key + '.json')
+
+    def get(self, path, params, allow_expired=False):
+        filename = self.filename(self.key(path, params))
+        try:
+            with open(filename) as f:
+                entry = json.load(f)
+        except (OSError, ValueError):
+            return None
+        if not allow_expired and self.ttl is not None and entry['stored_at'] + self.ttl < time.time():
+            return None
+        # the access time drives eviction, mtime is used since atime is often not kept
+        try:
+            os.utime(filename)
+        except OSError:
+            pass
+        return entry['body']
+
+    def set(self, path, params, body):
+        key = self.key(path, params)
+        filename = self.filename(key)
+        os.makedirs(os.path.dirname(filename), exist_ok=True)
+        data = json.dumps({'path': path, 'params': {k: v for k, v in params.items() if k != 'apiKey'},
+                           'stored_at': time.time(), 'body': body})
+        # written to a temporary file and renamed, so readers never see half an entry
+        fd, tmp = tempfile.mkstemp(dir=os.path.dirname(filename), suffix='.tmp')
+        with os.fdopen(fd, 'w') as f:
+            f.write(data)
+        try:
+            old_size = os.path.getsize(filename)
+        except OSError:
+            old_size = 0
+        os.replace(tmp, filename)
+        with self.lock:
+            if self.total_bytes is not None:
+                self.total_bytes += len(data.encode()) - old_size
+        self.evict()
+
+    def entries(self):
+        # (mtime, size, filename) of every stored entry
+        found = []
+        for root, _, files in os.walk(self.directory):
+            for name in files:
+                if name.endswith('.json'):
+                    filename = os.path.join(root, name)
+                    try:
+                        stat = os.stat(filename)
+                    except OSError:
+                        continue
+                    found.append((stat.st_mtime, stat.st_size, filename))
+        return found
+
+    def evict(self):
+        if self.max_bytes is None:
+            return
+        with self.lock:
+            if self.total_bytes is None:
+                self.total_bytes = sum(size for _, size, _ in self.entries())
+            if self.total_bytes <= self.max_bytes:
+                return
+            # only walk the directory when over the cap, and then go down to 90% of it
+            entries = sorted(self.entries())
+            self.total_bytes = sum(size for _, size, _ in entries)
+            for _, size, filename in entries:
+                if self.total_bytes <= self.max_bytes * 0.9:
+                    break
+                try:
+                    os.remove(filename)
+                except OSError:
+                    continue
+                self.total_bytes -= size
+
+    def clear(self):
+        with self.lock:
+            for _, _, filename in self.entries():
+                try:
+                    os.remove(filename)
+                except OSError:
+                    pass
+            self.total_bytes = 0
@@ -1,40 +1,174 @@
-import requests
 import os
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+import requests
+from requests.adapters import HTTPAdapter
 from config import Config
+from .response_cache import DiskResponseCache, ResponseCacheMiss
+
+
+# Blocks callers so that on average no more than rate requests per second go out,
+# with bursts of up to capacity requests after an idle period
+class TokenBucket():
+    def __init__(self, rate, capacity, clock=time.monotonic, sleep=time.sleep):
+        self.rate = rate
+        self.capacity = capacity
+        self.clock = clock
+        self.sleep = sleep
+        self.lock = threading.Lock()
+        self.tokens = capacity
+        self.updated = clock()
+
+    def acquire(self):
+        if not self.rate:
+            return
+        while True:
+            with self.lock:
+                now = self.clock()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            self.sleep(wait)
+
+
+# Responses worth another try: rate limited, or the server/gateway having a bad moment
+RETRY_STATUSES = {429, 500, 502, 503, 504}
 
 class spoonacular_module:
 
-    def __init__(self,):
+    # Every request goes through one pooled requests.Session (so connections are reused), the
+    # token bucket (so the API quota isn't exceeded, however many threads are fetching), and
+    # retries with exponential backoff and full jitter. Independent requests run on a small
+    # thread pool. Responses can be kept in a DiskResponseCache, see cache_mode.
+    # Settings default to the SPOONACULAR_* values of Config.
+    def __init__(self, base_url=None, secret=None, max_workers=None, rate=None, burst=None,
+                 max_retries=None, timeout=None, bulk_chunk_size=None, cache_mode=None, cache=None):
 
-        self.baseUrl = 'https://api.spoonacular.com'
+        self.baseUrl = base_url or Config.SPOONACULAR_BASE_URL
         self.userName = os.environ.get('SPOONACULAR_USER')
-        self.secret = Config.SPOONACULAR_SECRET
+        self.secret = secret or Config.SPOONACULAR_SECRET
         #categories
         self.recipeEndPoint = '/recipes'
-        
+
         #functions
         self.autoCompleteFunction = '/autocomplete'
         self.getRecipeBulkFunction = '/informationBulk'
+
+        self.max_workers = max_workers or Config.SPOONACULAR_MAX_WORKERS
+        self.max_retries = Config.SPOONACULAR_MAX_RETRIES if max_retries is None else max_retries
+        self.timeout = timeout or Config.SPOONACULAR_TIMEOUT
+        self.bulk_chunk_size = bulk_chunk_size or Config.SPOONACULAR_BULK_CHUNK_SIZE
+        self.backoff_base = 0.5
+        self.backoff_cap = 30
+        rate = Config.SPOONACULAR_RATE if rate is None else rate
+        self.rate_limiter = TokenBucket(rate, burst or Config.SPOONACULAR_BURST)
+
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=self.max_workers)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+        self.executor = ThreadPoolExecutor(max_workers=self.max_workers)
+        # every request sent to the api, retries included, for callers on a request budget
+        self.requests_made = 0
+        self.requests_lock = threading.Lock()
+
+        self.cache_mode = cache_mode or Config.SPOONACULAR_CACHE_MODE
+        if self.cache_mode not in ('off', 'cache', 'replay'):
+            raise ValueError('unknown spoonacular cache mode ' + repr(self.cache_mode))
+        if cache is None and self.cache_mode != 'off':
+            cache = DiskResponseCache(Config.SPOONACULAR_CACHE_DIR, Config.SPOONACULAR_CACHE_TTL,
+                                      Config.SPOONACULAR_CACHE_MAX_BYTES)
+        self.cache = cache
+
+    def close(self):
+        self.executor.shutdown()
+        self.session.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def get_json(self, path, params):
+        if self.cache_mode == 'off':
+            return self.fetch_json(path, params)
+        body = self.cache.get(path, params, allow_expired=self.cache_mode == 'replay')
+        if body is not None:
+            return body
+        if self.cache_mode == 'replay':
+            raise ResponseCacheMiss('no stored response for {} {}'.format(path, params))
+        body = self.fetch_json(path, params)
+        self.cache.set(path, params, body)
+        return body
+
+    def fetch_json(self, path, params):
+        url = self.baseUrl + path
+        params = dict(params, apiKey=self.secret)
+        for attempt in range(self.max_retries + 1):
+            self.rate_limiter.acquire()
+            with self.requests_lock:
+                self.requests_made += 1
+            try:
+                response = self.session.get(url, params=params, timeout=self.timeout)
+            except (requests.ConnectionError, requests.Timeout):
+                if attempt == self.max_retries:
+                    raise
+                self.sleep_before_retry(attempt, None)
+                continue
+            if response.status_code in RETRY_STATUSES and attempt < self.max_retries:
+                self.sleep_before_retry(attempt, response.headers.get('Retry-After'))
+                continue
+            response.raise_for_status()
+            return response.json()
+
+    def sleep_before_retry(self, attempt, retry_after):
+        # a Retry-After from the server wins, otherwise full jitter: anywhere up to base * 2^attempt
+        try:
+            delay = float(retry_after)
+        except (TypeError, ValueError):
+            delay = random.uniform(0, min(self.backoff_cap, self.backoff_base * 2 ** attempt))
+        # a negative (or NaN) Retry-After means no wait rather than an error from time.sleep
+        time.sleep(max(0, min(delay, self.backoff_cap)))
+
     def get_recipes_by_keyword(self, queryString, numResults):
-        
-        endpoint = self.baseUrl + self.recipeEndPoint
-        
-        queryEndpoint = endpoint + self.autoCompleteFunction + '?apiKey=' + str(self.secret) + '&query=' + queryString + '&number=' + str(numResults)
-        response = requests.get(queryEndpoint).json()
-
-        bulkRecipeEndPoint = endpoint + self.getRecipeBulkFunction + '?apiKey=' + str(self.secret) + '&ids='
-        for recipe in response:
-            if 'id' in recipe:
-                bulkRecipeEndPoint += str(recipe['id']) + ','
-        bulkRecipeEndPoint += '&includeNutrition=false'
-        response = requests.get(bulkRecipeEndPoint).json()
 
-        return response['recipes']
+        endpoint = self.recipeEndPoint
+
+        response = self.get_json(endpoint + self.autoCompleteFunction, {'query': queryString, 'number': numResults})
+        ids = [recipe['id'] for recipe in response if 'id' in recipe]
+        return self.get_recipes_information(ids)
+
+    def get_recipes_information(self, ids):
+        # informationBulk in chunks of bulk_chunk_size ids, fetched in parallel, results in the order of ids
+        chunks = [ids[start:start + self.bulk_chunk_size] for start in range(0, len(ids), self.bulk_chunk_size)]
+        recipes = []
+        for chunk_recipes in self.executor.map(self.get_recipes_information_chunk, chunks):
+            recipes.extend(chunk_recipes)
+        return recipes
+
+    def get_recipes_information_chunk(self, ids):
+        response = self.get_json(self.recipeEndPoint + self.getRecipeBulkFunction,
+                                 {'ids': ','.join(str(id) for id in ids), 'includeNutrition': 'false'})
+        # the api answers with a plain list, older responses wrapped it in {"recipes": [...]}
+        return response['recipes'] if isinstance(response, dict) else response
+
+    def search_recipes(self, params, offset, number):
+        # one page of complexSearch, {"results": [{"id": ..., "title": ...}], "offset", "number", "totalResults"}
+        return self.get_json(self.recipeEndPoint + '/complexSearch', dict(params, offset=offset, number=number))
 
     def get_random_recipes(self, tag):
 
-        endpoint = self.baseUrl + self.recipeEndPoint + '/random'
+        endpoint = self.recipeEndPoint + '/random'
+
+        response = self.get_json(endpoint, {'number': 100, 'tags': tag})
+        return response['recipes']
 
-        queryEndpoint = endpoint + '?apiKey=' + str(self.secret) + '&number=100&tags=' + tag
-        response = requests.get(queryEndpoint).json()
-        return response['recipes']
\ No newline at end of file
+    def get_random_recipes_for_tags(self, tags):
+        # one get_random_recipes per tag, fetched in parallel, as a {tag: recipes} dict
+        return dict(zip(tags, self.executor.map(self.get_random_recipes, tags)))
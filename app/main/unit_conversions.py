@@ -1,6 +1,14 @@
 import math
+from flask import g, has_request_context
+from flask_login import current_user
 from . import main
-from ..user import get_user_volume_preference, get_user_mass_preference
+from .. import db
+from ..models import User
+
+try:
+    import numpy as np
+except ImportError:  # only the *_array kernels and the batch formatters need numpy
+    np = None
 
 @main.context_processor
 def volume_conversion_processor():
@@ -14,6 +22,54 @@ def mass_conversion_processor():
         return get_user_mass_preference_string(userID, volume)
     return {'template_get_user_mass_preference_string' : template_get_user_mass_preference_string}
 
+@main.context_processor
+def ingredient_amounts_processor():
+    def template_format_ingredient_amounts(userID, ingredients):
+        return format_ingredient_amounts(ingredients, get_unit_preferences(userID))
+    return {'template_format_ingredient_amounts' : template_format_ingredient_amounts}
+
+# (metric volume, metric mass) preferences of a user, looked up at most once per request
+# and not at all for the logged in user, whose row flask-login has already loaded
+def get_unit_preferences(userID):
+    if not userID:
+        return (True, True)
+    userID = int(userID)
+    preferences = g.setdefault('unit_preferences', {})
+    if userID not in preferences:
+        if has_request_context() and current_user.is_authenticated and current_user.id == userID:
+            user = current_user
+        else:
+            user = db.session.query(User.prefers_metric_volume, User.prefers_metric_mass).filter_by(id=userID).first()
+        if user is not None:
+            preferences[userID] = (bool(user.prefers_metric_volume), bool(user.prefers_metric_mass))
+        else:
+            preferences[userID] = (True, True)
+    return preferences[userID]
+
+def get_viewer_unit_preferences():
+    # preferences of whoever is viewing the page, metric for anonymous viewers
+    if current_user.is_authenticated:
+        return get_unit_preferences(current_user.id)
+    return (True, True)
+
+# Formats the amounts of a whole ingredient list (objects with amount and measure) in one call
+def format_ingredient_amounts(ingredients, preferences):
+    prefers_metric_volume, prefers_metric_mass = preferences
+    amounts = ["" if ingredient.amount is None else "{}".format(ingredient.amount) for ingredient in ingredients]
+    for measure, formatter, batch_formatter, prefers_metric in [('volume', volume_string, volume_strings, prefers_metric_volume),
+                                                                ('mass', mass_string, mass_strings, prefers_metric_mass)]:
+        rows = [idx for idx, ingredient in enumerate(ingredients)
+                if ingredient.measure == measure and ingredient.amount is not None]
+        if len(rows) == 0:
+            continue
+        if np is not None:
+            strings = batch_formatter([ingredients[idx].amount for idx in rows], prefers_metric)
+        else:
+            strings = [formatter(ingredients[idx].amount, prefers_metric) for idx in rows]
+        for idx, string in zip(rows, strings):
+            amounts[idx] = string
+    return amounts
+
 def metric_to_spoons_volume(volume):
     numQuarterCups = math.floor(volume / 62.5)
     cupRemainder = volume - 62.5 * numQuarterCups
@@ -39,86 +95,80 @@ def imp_to_metric_mass(numPound, numOz):
 
 
 def get_user_volume_preference_string(userID, volume):
-    if userID != 0:
-        if get_user_volume_preference(userID):
-            returnString = "{:0.2f} ml"
-            returnString = returnString.format(volume)
-            return returnString
-        else:
-            cups, quarterCups, tbsps, tsps = metric_to_spoons_volume(volume)
-            returnString = ""
-            first = True
-            if cups > 0:
-                if cups != 1:
-                    returnString = returnString + "{} cups"
-                else:
-                    returnString = returnString + "{} cup"
-                returnString = returnString.format(cups)
-                first = False
-            if quarterCups > 0:
-                if not first:
-                    returnString = returnString + ", "
-                if quarterCups % 2 != 0:
-                    if quarterCups != 1:
-                        returnString = returnString + "{} quarter cups"
-                    else:
-                        returnString = returnString + "{} quarter cup"
-                    first = False
-                    returnString = returnString.format(quarterCups)
-                else:
-                    first = False
-                    returnString = returnString + "1 half cup"
-            if tbsps > 0:
-                if not first:
-                    returnString = returnString + ", "
-                if tbsps != 1:
-                    returnString = returnString + "{} tablespoons"
-                else:
-                    returnString = returnString + "{} tablespoon"
-                first = False
-                returnString = returnString.format(tbsps)
-            if tsps > 0:
-                if not first:
-                    returnString = returnString + ", "
-                if tsps != 1:
-                    returnString = returnString + "{} teaspoons"
-                else:
-                    returnString = returnString + "{} teaspoon"
-                first = False
-                returnString = returnString.format(tsps)
-            return returnString
-    else:
-        returnString = "{:0.2f} ml"
-        returnString = returnString.format(volume)
-        return returnString
+    return volume_string(volume, get_unit_preferences(userID)[0])
 
 def get_user_mass_preference_string(userID, mass):
-    if userID != 0:
-        if get_user_mass_preference(userID):
-            returnString = "{:0.2f} g"
-            returnString = returnString.format(mass)
-            return returnString
-        else:
-            pounds, oz = metric_to_imp_mass(mass)
-            returnString = ""
-            first = True
-            if pounds > 0:
-                if pounds != 1:
-                    returnString = returnString + "{} lbs"
-                else:
-                    returnString = returnString + "{} lb"
-                first = False
-                returnString = returnString.format(pounds)
-            if oz > 0:
-                if not first:
-                    returnString = returnString + " and "
-                if oz != 1:
-                    returnString = returnString + "{:0.2f} ozs"
-                else:
-                    returnString = returnString + "{:0.2f} oz"
-                returnString = returnString.format(oz)
-            return returnString
-    else:
-        returnString = "{:0.2f} g"
-        returnString = returnString.format(mass)
-        return returnString
\ No newline at end of file
+    return mass_string(mass, get_unit_preferences(userID)[1])
+
+# Imperial units from largest to smallest as (singular, plural, {value: fixed text}).
+# A part is only printed when its value is positive.
+VOLUME_UNITS = [("{} cup", "{} cups", {}),
+                ("{} quarter cup", "{} quarter cups", {2: "1 half cup"}),
+                ("{} tablespoon", "{} tablespoons", {}),
+                ("{} teaspoon", "{} teaspoons", {})]
+MASS_UNITS = [("{} lb", "{} lbs", {}),
+              ("{:0.2f} oz", "{:0.2f} ozs", {})]
+
+def format_units(values, units, separator):
+    return separator.join([fixed[value] if value in fixed else (singular if value == 1 else plural).format(value)
+                           for value, (singular, plural, fixed) in zip(values, units) if value > 0])
+
+def volume_string(volume, prefers_metric=True):
+    if prefers_metric:
+        return "{:0.2f} ml".format(volume)
+    return format_units(metric_to_spoons_volume(volume), VOLUME_UNITS, ", ")
+
+def mass_string(mass, prefers_metric=True):
+    if prefers_metric:
+        return "{:0.2f} g".format(mass)
+    return format_units(metric_to_imp_mass(mass), MASS_UNITS, " and ")
+
+# Array versions of the conversions, converting a whole column of amounts at once, e.g.
+# every ingredient of a scaled recipe or every row of an export. They take anything numpy
+# can turn into an array and return arrays matching the scalar functions element-wise.
+# They need numpy, which is optional and not in requirements.txt; format_ingredient_amounts
+# uses the scalar functions when it isn't installed.
+def metric_to_spoons_volume_array(volumes):
+    volumes = np.asarray(volumes, dtype=np.float64)
+    numQuarterCups = np.floor(volumes / 62.5)
+    cupRemainder = volumes - 62.5 * numQuarterCups
+    numCups = numQuarterCups // 4
+    numQuarterCups = numQuarterCups - 4 * numCups
+    numTeaSpoon = cupRemainder / (4.92892)
+    numTbSpoon = np.floor(numTeaSpoon / 3)
+    numTeaSpoon = numTeaSpoon - 3 * numTbSpoon
+    # np.round rounds halves to even like python's round
+    numTeaSpoon = np.round(numTeaSpoon * 4) / 4
+    return numCups.astype(np.int64), numQuarterCups.astype(np.int64), numTbSpoon.astype(np.int64), numTeaSpoon
+
+def spoons_to_metric_volume_array(numCups, numQuarterCups, numTbSpoon, numTeaSpoon):
+    return np.asarray(numCups) * 250 + np.asarray(numQuarterCups) * 62.5 \
+        + np.asarray(numTbSpoon) * (62.5 / 4) + np.asarray(numTeaSpoon) * (4.92892)
+
+def metric_to_imp_mass_array(masses):
+    numOz = np.asarray(masses, dtype=np.float64) / 28.35
+    numPound = np.floor(numOz / 16)
+    numOz = numOz - 16 * numPound
+    return numPound.astype(np.int64), numOz
+
+def imp_to_metric_mass_array(numPound, numOz):
+    return 16 * np.asarray(numPound) * 28.35 + np.asarray(numOz) * 28.35
+
+def volume_strings(volumes, prefers_metric=True):
+    # volume_string for a whole column of volumes
+    if prefers_metric:
+        return ["{:0.2f} ml".format(volume) for volume in volumes]
+    columns = [column.tolist() for column in metric_to_spoons_volume_array(volumes)]
+    # teaspoons are rounded to quarters, so a column only has a few distinct unit tuples
+    strings = {}
+    for values in zip(*columns):
+        if values not in strings:
+            strings[values] = format_units(values, VOLUME_UNITS, ", ")
+    return [strings[values] for values in zip(*columns)]
+
+def mass_strings(masses, prefers_metric=True):
+    # mass_string for a whole column of masses
+    if prefers_metric:
+        return ["{:0.2f} g".format(mass) for mass in masses]
+    columns = [column.tolist() for column in metric_to_imp_mass_array(masses)]
+    return [format_units(values, MASS_UNITS, " and ") for values in zip(*columns)]
@@ -1,97 +1,16 @@
-from flask import render_template, session, redirect, url_for, request, jsonify
-from .. import db
-from ..models import User, get_all_ingredients, get_ingredient_name, get_ingredient_measure, add_recipe, get_recipe, add_ingredient, get_all_recipes, search_ingredients, save_recipe, is_saved_recipe, get_user_saved_recipes, get_user_volume_preference, get_user_mass_preference
+from flask import render_template, session, redirect, url_for, request, jsonify, current_app, abort
+from ..cache import get_search_cache_stats, get_fragment_cache, get_catalog_version
+from ..hybrid_search import hybrid_search
+from ..models import get_all_ingredients, get_ingredient_name, get_ingredient_measure, add_recipe, get_recipe, add_ingredient, save_recipe, is_saved_recipe, search_recipe_near_miss, autocomplete_ingredients, get_recipes_page, get_user_saved_recipes_page, get_top_recipes_page, set_saved_recipes, InvalidCursor, is_int
 from flask_login import current_user, login_required
 from . import main
+from .unit_conversions import get_viewer_unit_preferences, format_ingredient_amounts
 from .forms import RecipeForm, IngredientForm, IngredientAddForm, SaveRecipeToggleForm, UnsaveRecipeToggleForm
-import math
 
 @main.route('/', methods=['GET', 'POST'])
 def index():
     return render_template('index.html', name=session.get('name'), known=session.get('known', False))
 
-def metric_to_spoons_volume(volume):
-    numQuarterCups = math.floor(volume / 62.5)
-    cupRemainder = volume - 62.5 * numQuarterCups
-    numCups = numQuarterCups // 4
-    numQuarterCups = numQuarterCups - 4 * numCups
-    numTeaSpoon = cupRemainder / (4.92892)
-    numTbSpoon = math.floor(numTeaSpoon / 3)
-    numTeaSpoon = numTeaSpoon - 3 * numTbSpoon
-    numTeaSpoon = math.floor(numTeaSpoon)
-    return numCups, numQuarterCups, numTbSpoon, numTeaSpoon
-
-def spoons_to_metric_volume(numCups, numQuarterCups, numTbSpoon, numTeaSpoon):
-    return numCups * 250 + numQuarterCups * 62.5 + numTbSpoon * (62.5 / 4) + numTeaSpoon * (4.92892)
-
-def metric_to_imp_mass(mass):
-    numOz = mass / 28.35
-    numPound = math.floor(numOz / 16)
-    numOz = numOz - 16 * numPound
-    return numPound, numOz
-
-def imp_to_metric_mass(numPound, numOz):
-    return 16 * numPound * 28.35 + numOz * 28.35
-
-def get_user_volume_preference_string(userID, volume):
-    if get_user_volume_preference(userID):
-        returnString = "{:0.2f} ml | "
-        returnString = returnString.format(volume)
-        return returnString
-    else:
-        cups, quarterCups, tbsps, tsps = metric_to_spoons_volume(volume)
-        returnString = ""
-        if cups > 0:
-            if cups > 1:
-                returnString = returnString + "{} cups | "
-            else:
-                returnString = returnString + "{} cup | "
-            returnString = returnString.format(cups)
-        if quarterCups > 0:
-            if quarterCups % 2 != 0:
-                if quarterCups > 1:
-                    returnString = returnString + "{} quarter cups | "
-                else:
-                    returnString = returnString + "{} quarter cup | "
-                returnString = returnString.format(quarterCups)
-            else:
-                returnString = returnString + "1 half cup | "
-        if tbsps > 0:
-            if tbsps > 1:
-                returnString = returnString + "{} tablespoons | "
-            else:
-                returnString = returnString + "{} tablespoon | "
-            returnString = returnString.format(tbsps)
-        if tsps > 0:
-            if tsps > 1:
-                returnString = returnString + "{} teaspoons | "
-            else:
-                returnString = returnString + "{} teaspoon | "
-            returnString = returnString.format(tsps)
-        return returnString
-
-def get_user_mass_preference_string(userID, mass):
-    if get_user_mass_preference(userID):
-        returnString = "{:0.2f} g | "
-        returnString = returnString.format(mass)
-        return returnString
-    else:
-        pounds, oz = metric_to_imp_mass(mass)
-        returnString = ""
-        if pounds > 0:
-            if pounds > 1:
-                returnString = returnString + "{} lbs | "
-            else:
-                returnString = returnString + "{} lb | "
-            returnString = returnString.format(pounds)
-        if oz > 0:
-            if oz != 1:
-                returnString = returnString + "{:0.2f} ozs | "
-            else:
-                returnString = returnString + "{:0.2f} oz | "
-            returnString = returnString.format(oz)
-        return returnString
-
 @main.route('/add_new_recipe', methods=['GET', 'POST'])
 @login_required
 def add_new_recipe():
@@ -149,33 +68,93 @@ def add_new_ingredient():
 def view_recipe(recipe_ID):
     saveForm = SaveRecipeToggleForm()
     unsaveForm = UnsaveRecipeToggleForm()
-    if saveForm.validate_on_submit():
-        save_recipe(current_user.id, recipe_ID)
-        return redirect(url_for('main.view_recipe', recipe_ID=recipe_ID))
-    if unsaveForm.validate_on_submit():
-        save_recipe(current_user.id, recipe_ID)
+    if saveForm.validate_on_submit() or unsaveForm.validate_on_submit():
+        try:
+            save_recipe(current_user.id, recipe_ID)
+        except ValueError:
+            abort(404)
         return redirect(url_for('main.view_recipe', recipe_ID=recipe_ID))
-    recipe = get_recipe(recipe_ID)
+    fragment = get_recipe_fragment(recipe_ID)
+    if fragment is None:
+        abort(404)
+    recipe_name, recipe_body = fragment
+    # the save toggle depends on the viewer, so it stays outside the cached fragment
     if current_user.is_authenticated:
         if is_saved_recipe(current_user.id, recipe_ID):
-            return render_template('view_recipe.html', recipe = recipe, saveToggle = unsaveForm)
+            return render_template('view_recipe.html', recipe_name = recipe_name, recipe_body = recipe_body, saveToggle = unsaveForm)
         else:
-            return render_template('view_recipe.html', recipe = recipe, saveToggle = saveForm)
+            return render_template('view_recipe.html', recipe_name = recipe_name, recipe_body = recipe_body, saveToggle = saveForm)
     else:
         del saveForm.saveRecipe
-        return render_template('view_recipe.html', recipe = recipe, saveToggle = saveForm)
+        return render_template('view_recipe.html', recipe_name = recipe_name, recipe_body = recipe_body, saveToggle = saveForm)
+
+# Returns (recipe name, rendered recipe body) or None if the recipe doesn't exist.
+# Bodies are cached per recipe, catalog version and unit preferences, so any change to
+# a recipe or ingredient (which bumps the catalog version) re-renders them. The version is
+# the one stored in the database, so the keys agree between workers sharing a fragment cache
+# and a change made by another process is seen within CATALOG_VERSION_CHECK_INTERVAL.
+def get_recipe_fragment(recipe_ID):
+    preferences = get_viewer_unit_preferences()
+    key = ('recipe_body', str(recipe_ID), get_catalog_version(), preferences)
+    cache = get_fragment_cache()
+    fragment = cache.get(key)
+    if fragment is None:
+        recipe = get_recipe(recipe_ID)
+        if recipe is None:
+            return None
+        body = render_template('recipe_body.html', recipe = recipe,
+                               amounts = format_ingredient_amounts(recipe.ingredients, preferences))
+        fragment = (recipe.name, body)
+        cache.set(key, fragment)
+    return fragment
+
+def get_page_args():
+    # after/before are cursors from a previous page, per_page is capped so a page stays small
+    per_page = request.args.get('per_page', current_app.config['RECIPES_PER_PAGE'], type=int)
+    return request.args.get('after'), request.args.get('before'), max(1, min(per_page, 100))
 
 @main.route('/view_recipes', methods=['GET', 'POST'])
 def view_recipes():
-    recipes_to_view = get_all_recipes()
-    return render_template('view_recipes.html', recipes = recipes_to_view)
+    after, before, per_page = get_page_args()
+    try:
+        page = get_recipes_page(after, before, per_page)
+    except InvalidCursor:
+        abort(400)
+    return render_template('view_recipes.html', recipes = page.items, page = page, endpoint = 'main.view_recipes')
 
 
 @main.route('/view_saved_recipes', methods=['GET', 'POST'])
 @login_required
 def view_saved_recipes():
-    recipes_to_view = get_user_saved_recipes(current_user.id)
-    return render_template('view_recipes.html', recipes = recipes_to_view)
+    after, before, per_page = get_page_args()
+    try:
+        page = get_user_saved_recipes_page(current_user.id, after, before, per_page)
+    except InvalidCursor:
+        abort(400)
+    return render_template('view_saved_recipes.html', recipes = page.items, page = page)
+
+@main.route('/saved_recipes', methods=['POST'])
+@login_required
+def update_saved_recipes():
+    # JSON body {"save": [ids], "unsave": [ids]}, applied in one transaction
+    data = request.get_json(silent=True) or {}
+    save_ids, unsave_ids = data.get('save', []), data.get('unsave', [])
+    if not all(isinstance(ids, list) and all(is_int(id) for id in ids) for ids in (save_ids, unsave_ids)):
+        return jsonify(error='save and unsave must be lists of recipe ids'), 400
+    if len(save_ids) + len(unsave_ids) > 1000:
+        return jsonify(error='at most 1000 recipe ids per request'), 400
+    return jsonify(saved_count=set_saved_recipes(current_user.id, save_ids, unsave_ids))
+
+@main.route('/top_recipes', methods=['GET'])
+def top_recipes():
+    meal = request.args.get('meal') or None
+    after, before, per_page = get_page_args()
+    try:
+        page = get_top_recipes_page(meal, after, before, per_page)
+    except InvalidCursor:
+        abort(400)
+    return render_template('view_recipes.html', recipes = page.items, page = page, endpoint = 'main.top_recipes',
+                           endpoint_args = {'meal': meal} if meal else {})
 
 @main.route('/select_ingredients', methods=['GET', 'POST'])
 def select_ingredients():
@@ -186,9 +165,39 @@ def select_ingredients():
 def autocomplete():
     # search_phrase is the phrase that is currently written in the combobox
     search_phrase = request.args.get('term')
-    # use database search function to return ingredients that have the phrase as a substring
-    ingredients = search_ingredients(search_phrase)
-    results = [{"value": i.name, "id": i.id} for i in ingredients]
+    # use the in-memory prefix index to return the most used ingredients with a word starting with the phrase
+    ingredients = autocomplete_ingredients(search_phrase)
+    results = [{"value": name, "id": i_id} for i_id, name in ingredients]
 
     return jsonify(matching_results=results)
 
+
+@main.route('/search_cache_stats', methods=['GET'])
+@login_required
+def search_cache_stats():
+    # per-process hit/miss counters, used to size SEARCH_CACHE_SIZE
+    return jsonify(get_search_cache_stats())
+
+@main.route('/search_near_miss', methods=['GET'])
+def search_near_miss():
+    # ingredients are passed as repeated ids, e.g. ?ingredients=1&ingredients=4&max_missing=2
+    ingred_ids = request.args.getlist('ingredients', type=int)
+    recipe_name = request.args.get('name', '')
+    max_missing = request.args.get('max_missing', 1, type=int)
+    page = request.args.get('page', 1, type=int)
+    per_page = max(1, min(request.args.get('per_page', 20, type=int), 100))
+    hits = search_recipe_near_miss(recipe_name, ingred_ids, max_missing, page, per_page)
+    results = [{"id": r.id, "name": r.name, "matched": r.matched,
+                "missing": [{"id": i_id, "name": i_name} for i_id, i_name in r.missing]} for r in hits]
+
+    return jsonify(matching_results=results, page=page)
+
+@main.route('/search_hybrid', methods=['GET'])
+def search_hybrid():
+    # like /search_near_miss, ?name=soup&ingredients=1&ingredients=4, topped up from spoonacular
+    # when few local recipes match. remote is skipped, busy, ok, timeout or error.
+    ingred_ids = request.args.getlist('ingredients', type=int)
+    recipe_name = request.args.get('name', '')
+    hits, remote = hybrid_search(recipe_name, ingred_ids)
+    results = [{"id": r.id, "name": r.name, "source": r.source} for r in hits]
+    return jsonify(results=results, remote=remote)
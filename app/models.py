@@ -1,9 +1,22 @@
+import base64
+import json
+import math
+from collections import namedtuple
 from . import db, login_manager
 from werkzeug.security import generate_password_hash, check_password_hash
 from flask_login import UserMixin, current_user
 from itsdangerous import TimedJSONWebSignatureSerializer as Serializer
 from flask import current_app
+from config import Config
+from sqlalchemy import DDL, event, select, union_all, literal, cast, case, func, and_, or_, true, text
+from sqlalchemy.orm import aliased
 from app.integrations.spoonacular_module import spoonacular_module
+from .search_index import get_recipe_index, bitset_to_ids
+from .ingredient_autocomplete import get_ingredient_prefix_index
+from .pantry_matrix import get_pantry_matrix, invalidate_pantry_matrix
+from .cache import cached_search, cached_count, get_catalog_version, bump_catalog_version, forget_catalog_version, \
+    get_search_cache, get_count_cache, get_fragment_cache
+from .name_search import install_name_search, name_filter, reset_name_search_backend
 
 
 class User(UserMixin, db.Model):
@@ -13,6 +26,11 @@ class User(UserMixin, db.Model):
     recipes = db.relationship('RU_Association')
     prefers_metric_volume = db.Column(db.Boolean, default=True)
     prefers_metric_mass = db.Column(db.Boolean, default=True)
+    # number of RU rows with saved set, kept up to date by save_recipe
+    saved_count = db.Column(db.Integer, default=0, server_default='0', nullable=False)
+    # sum and number of the ratings this user gave, kept up to date by add_review
+    rating_sum = db.Column(db.Float, default=0, server_default='0', nullable=False)
+    rating_count = db.Column(db.Integer, default=0, server_default='0', nullable=False)
     email = db.Column(db.String(64), unique=True, index=True)
     password_hash = db.Column(db.String(128))
     confirmed = db.Column(db.Boolean, default=False)
@@ -110,6 +128,8 @@ def get_user_mass_preference(user_id):
 # Association table for user recipe relations
 class RU_Association(db.Model):
     __tablename__ = "RU"
+    # lets a user's saved recipes be read a page at a time in recipe id order
+    __table_args__ = (db.Index('ix_RU_u_id_saved_r_id', 'u_id', 'saved', 'r_id'),)
     r_id = db.Column(db.Integer, db.ForeignKey('recipes.id'), primary_key=True)
     u_id = db.Column(db.Integer, db.ForeignKey('users.id'), primary_key=True)
     saved = db.Column(db.Boolean)
@@ -123,32 +143,67 @@ class RU_Association(db.Model):
 class RI_Association(db.Model):
     __tablename__ = "RI"
     r_id = db.Column(db.Integer, db.ForeignKey('recipes.id'), primary_key=True)
-    i_id = db.Column(db.Integer, db.ForeignKey('ingredients.id'), primary_key=True)
+    i_id = db.Column(db.Integer, db.ForeignKey('ingredients.id'), primary_key=True, index=True)
     amount = db.Column(db.Float)
     recipe = db.relationship("Recipe")
     ingredient = db.relationship("Ingredient")
 
 class Recipe(db.Model):
     __tablename__ = 'recipes'
+    # top recipes pages read these in rating_score order, overall and per meal
+    __table_args__ = (db.Index('ix_recipes_rating_score_id', 'rating_score', 'id'),
+                      db.Index('ix_recipes_meal_rating_score_id', 'meal', 'rating_score', 'id'),
+                      # imported recipes are matched on their spoonacular id, or their content hash without one
+                      db.Index('ix_recipes_spoonacular_id', 'spoonacular_id', unique=True),
+                      db.Index('ix_recipes_content_hash', 'content_hash', unique=True,
+                               sqlite_where=text('spoonacular_id IS NULL'),
+                               postgresql_where=text('spoonacular_id IS NULL')))
     id = db.Column(db.Integer, primary_key=True)
-    name = db.Column(db.String(128))
+    name = db.Column(db.String(128), index=True)
     time = db.Column(db.Integer)
     rating = db.Column(db.Float)
     description = db.Column(db.String(500))
     steps = db.Column(db.String(500)) # temporary. replace with enum maybe
+    # sum and number of the users' ratings, kept up to date by add_review
+    rating_sum = db.Column(db.Float, default=0, server_default='0', nullable=False)
+    rating_count = db.Column(db.Integer, default=0, server_default='0', nullable=False)
+    # Bayesian average of the ratings, what the top recipes leaderboard is ordered by. Without
+    # ratings that's the prior mean, which is also what rows inserted with plain sql start with.
+    rating_score = db.Column(db.Float, default=lambda: rating_score(0, 0),
+                             server_default=str(Config.RATING_PRIOR_MEAN), nullable=False)
+    # breakfast, lunch, dinner... or None
+    meal = db.Column(db.String(32))
+    # set by the importer, see app/importer.py
+    spoonacular_id = db.Column(db.Integer)
+    content_hash = db.Column(db.String(64))
     #ingredients = db.relationship('Ingredient',secondary=RI_Association)
     ingredients = db.relationship('RI_Association')
     users = db.relationship('RU_Association')
 
+install_name_search(Recipe.__table__)
+
+# One ingredient line of a Recipe_val
+RecipeIngredient = namedtuple('RecipeIngredient', ['id', 'name', 'amount', 'measure'])
+
+# Plain read-only view of a recipe for templates, holding no ORM objects
 class Recipe_val():
-    def __init__(self, recipe):
-        self.name = recipe.name
-        self.time = recipe.time
-        self.rating = recipe.rating
-        self.description = recipe.description
-        self.steps = recipe.steps.split("\n") # we want a list of steps
-        self.ingredients = [ingredient.ingredient for ingredient in recipe.ingredients]
-        self.amounts = [ingredient.amount for ingredient in recipe.ingredients]
+    __slots__ = ('id', 'name', 'time', 'rating', 'description', 'steps', 'ingredients')
+
+    def __init__(self, id, name, time, rating, description, steps, ingredients):
+        self.id = id
+        self.name = name
+        self.time = time
+        self.rating = rating
+        self.description = description
+        self.steps = (steps or "").split("\n") # we want a list of steps
+        self.ingredients = ingredients
+
+    @property
+    def amounts(self):
+        return [ingredient.amount for ingredient in self.ingredients]
+
+# One hit of search_recipe_near_miss: missing is a list of (ingredient id, ingredient name)
+NearMissResult = namedtuple('NearMissResult', ['id', 'name', 'matched', 'missing'])
 
 class Ingredient(db.Model):
     __tablename__ = 'ingredients'
@@ -157,6 +212,42 @@ class Ingredient(db.Model):
     # determine what type of unit to use (volume, units, mass, etc)
     measure = db.Column(db.String(64))
 
+install_name_search(Ingredient.__table__)
+
+# State of the catalog sync job (app/sync.py): one row per sync target holding its watermark,
+# the offset of the next search page to fetch, and one row used as a lock with a lease,
+# so only one node syncs at a time even when cron starts it on several
+class SyncState(db.Model):
+    __tablename__ = 'sync_state'
+    name = db.Column(db.String(128), primary_key=True)
+    watermark = db.Column(db.Integer, default=0, server_default='0', nullable=False)
+    locked_by = db.Column(db.String(128))
+    locked_until = db.Column(db.DateTime)
+    updated_at = db.Column(db.DateTime)
+
+# The shared catalog version, see app/cache.py. Created with version 0 by db.create_all()
+# and by the migration.
+class CatalogVersion(db.Model):
+    __tablename__ = 'catalog_version'
+    id = db.Column(db.Integer, primary_key=True)
+    version = db.Column(db.Integer, default=0, server_default='0', nullable=False)
+
+event.listen(CatalogVersion.__table__, 'after_create',
+             DDL("INSERT INTO catalog_version (id, version) VALUES (1, 0)"))
+
+# Any flushed change to a recipe, its ingredient rows or an ingredient bumps the catalog
+# version in the same transaction, so caches keyed by it (searches, rendered recipes) never
+# serve the old data once the change is committed
+@event.listens_for(db.session, 'after_flush')
+def catalog_change_listener(session, flush_context):
+    catalog_models = (Recipe, RI_Association, Ingredient)
+    changed = [obj for obj in list(session.new) + list(session.deleted) if isinstance(obj, catalog_models)]
+    # saving or reviewing a recipe only touches its users collection, which isn't a catalog change
+    changed += [obj for obj in session.dirty
+                if isinstance(obj, catalog_models) and session.is_modified(obj, include_collections=False)]
+    if len(changed) > 0:
+        bump_catalog_version(session)
+
 def get_ingredient_is_countable(id):
     if (db.session.query(Ingredient).filter(id=id, measure='count').first()) != None:
         return False
@@ -167,23 +258,214 @@ def get_all_ingredients(descend=False):
     return ingredients
 
 def search_ingredients(phrase):
-    ingredients = db.session.query(Ingredient).order_by(Ingredient.name).filter(Ingredient.name.like("%{}%".format(phrase)))
+    ingredients = db.session.query(Ingredient).order_by(Ingredient.name).filter(name_filter(Ingredient, phrase))
     return ingredients
 
+# Prefix search used by the autocomplete box, ranked by how many recipes use each ingredient
+def autocomplete_ingredients(phrase, limit=None):
+    if limit is None:
+        limit = current_app.config['AUTOCOMPLETE_LIMIT']
+    return get_ingredient_prefix_index().search(phrase, limit)
+
 def get_all_recipes(descend=False):
      recipes = db.session.query(Recipe).order_by(Recipe.name).with_entities(Recipe.id, Recipe.name).all()
      return recipes
 
+# One page of a keyset paginated recipe listing. items are (id, name) rows, the cursors are
+# opaque strings to pass back as after/before, or None when there is no next/previous page
+RecipePage = namedtuple('RecipePage', ['items', 'next_cursor', 'prev_cursor', 'total'])
+
+def encode_recipe_cursor(name, id):
+    return base64.urlsafe_b64encode(json.dumps([name, id]).encode()).decode()
+
+# Raised by the paginated listings for an after/before cursor they didn't hand out,
+# the views answer it with a 400
+class InvalidCursor(ValueError):
+    pass
+
+def decode_recipe_cursor(cursor, key_types=(str,)):
+    # the (key, id) of a cursor, key being one of key_types (the name by default) and id an int
+    try:
+        key, id = json.loads(base64.urlsafe_b64decode(cursor.encode()).decode())
+    except (ValueError, TypeError, UnicodeError):
+        raise InvalidCursor('malformed cursor')
+    if not isinstance(key, key_types) or not is_int(id) or isinstance(key, bool):
+        raise InvalidCursor('malformed cursor')
+    return key, id
+
+def is_int(value):
+    # bool is an int subclass, but True isn't an id
+    return isinstance(value, int) and not isinstance(value, bool)
+
+# The recipes after (or before, going backwards) the (name, id) of a cursor. Recipes without
+# a name sort first, and comparisons with NULL never hold, so they are matched explicitly.
+def recipe_keyset_filter(name, id, backwards):
+    if name is None:
+        if backwards:
+            return and_(Recipe.name.is_(None), Recipe.id < id)
+        return or_(Recipe.name.isnot(None), and_(Recipe.name.is_(None), Recipe.id > id))
+    if backwards:
+        return or_(Recipe.name.is_(None), Recipe.name < name, and_(Recipe.name == name, Recipe.id < id))
+    return or_(Recipe.name > name, and_(Recipe.name == name, Recipe.id > id))
+
+# Keyset pagination over a query of recipes ordered by (Recipe.name, Recipe.id), nameless ones first.
+# Seeking past the cursor keeps every page as cheap as the first, unlike OFFSET.
+def paginate_recipes(query, after=None, before=None, per_page=None):
+    if per_page is None:
+        per_page = current_app.config['RECIPES_PER_PAGE']
+    backwards = before is not None and after is None
+    cursor = decode_recipe_cursor(before if backwards else after, (str, type(None))) if (after or before) else None
+
+    if cursor is not None:
+        query = query.filter(recipe_keyset_filter(*cursor, backwards))
+    if backwards:
+        query = query.order_by(Recipe.name.desc().nullslast(), Recipe.id.desc())
+    else:
+        query = query.order_by(Recipe.name.nullsfirst(), Recipe.id)
+
+    rows = query.with_entities(Recipe.id, Recipe.name).limit(per_page + 1).all()
+    has_more = len(rows) > per_page
+    rows = rows[:per_page]
+    if backwards:
+        rows.reverse()
+
+    next_cursor = prev_cursor = None
+    if len(rows) > 0:
+        first = encode_recipe_cursor(rows[0].name, rows[0].id)
+        last = encode_recipe_cursor(rows[-1].name, rows[-1].id)
+        if backwards:
+            prev_cursor = first if has_more else None
+            next_cursor = last
+        else:
+            next_cursor = last if has_more else None
+            prev_cursor = first if cursor is not None else None
+    return RecipePage(rows, next_cursor, prev_cursor, None)
+
+def get_recipes_page(after=None, before=None, per_page=None):
+    page = paginate_recipes(db.session.query(Recipe), after, before, per_page)
+    total = cached_count(('recipes', get_catalog_version()), lambda: db.session.query(func.count(Recipe.id)).scalar())
+    return page._replace(total=total)
+
+# Bayesian average of a recipe's ratings: its ratings plus RATING_PRIOR_WEIGHT imaginary ones
+# of RATING_PRIOR_MEAN, so a single 5 star review doesn't outrank a hundred 4.8s.
+# Takes plain numbers or column expressions, so the same formula is used in sql updates.
+def rating_score(rating_sum, rating_count):
+    weight = current_app.config['RATING_PRIOR_WEIGHT']
+    mean = current_app.config['RATING_PRIOR_MEAN']
+    return (weight * mean + rating_sum) / (weight + rating_count)
+
+# Recomputes every recipe's rating_score from its stored aggregates, in one update.
+# add_review keeps scores current, this is for after changing the prior or recompute_ratings.
+def rank_recipes():
+    db.session.query(Recipe).update({Recipe.rating_score: rating_score(Recipe.rating_sum, Recipe.rating_count)},
+                                    synchronize_session=False)
+    db.session.commit()
+
+# Page of the top rated recipes, overall or for one meal, as (id, name, rating_score, rating_count)
+# rows ordered by score and then id, both descending. Keyset paginated over the rating_score indexes.
+def get_top_recipes_page(meal=None, after=None, before=None, per_page=None):
+    if per_page is None:
+        per_page = current_app.config['RECIPES_PER_PAGE']
+    backwards = before is not None and after is None
+    cursor = decode_score_cursor(before if backwards else after) if (after or before) else None
+
+    query = db.session.query(Recipe.id, Recipe.name, Recipe.rating_score, Recipe.rating_count)
+    if meal is not None:
+        query = query.filter(Recipe.meal == meal)
+    if cursor is not None:
+        score, id = cursor
+        if backwards:
+            query = query.filter(or_(Recipe.rating_score > score, and_(Recipe.rating_score == score, Recipe.id > id)))
+        else:
+            query = query.filter(or_(Recipe.rating_score < score, and_(Recipe.rating_score == score, Recipe.id < id)))
+    if backwards:
+        query = query.order_by(Recipe.rating_score, Recipe.id)
+    else:
+        query = query.order_by(Recipe.rating_score.desc(), Recipe.id.desc())
+
+    rows = query.limit(per_page + 1).all()
+    has_more = len(rows) > per_page
+    rows = rows[:per_page]
+    if backwards:
+        rows.reverse()
+
+    next_cursor = prev_cursor = None
+    if len(rows) > 0:
+        first = encode_recipe_cursor(rows[0].rating_score, rows[0].id)
+        last = encode_recipe_cursor(rows[-1].rating_score, rows[-1].id)
+        if backwards:
+            prev_cursor = first if has_more else None
+            next_cursor = last
+        else:
+            next_cursor = last if has_more else None
+            prev_cursor = first if cursor is not None else None
+    total = cached_count(('top_recipes', meal, get_catalog_version()),
+                         lambda: db.session.query(func.count(Recipe.id)).filter(
+                             Recipe.meal == meal if meal is not None else true()).scalar())
+    return RecipePage(rows, next_cursor, prev_cursor, total)
+
+def decode_score_cursor(cursor):
+    score, id = decode_recipe_cursor(cursor, (int, float))
+    if not math.isfinite(score):
+        raise InvalidCursor('malformed cursor')
+    return score, id
+
 def add_ingredient(name, measure):
     ingredient = Ingredient(name=name, measure=measure)
-    db.session.add(ingredient)
-    db.session.commit()
+    versions = commit_catalog_change(ingredient)
+    get_recipe_index().add_ingredient(ingredient.id, versions)
+    get_ingredient_prefix_index().add_ingredient(ingredient.id, name, versions)
     return ingredient.id
 
+def commit_catalog_change(obj):
+    # adds and commits obj, returns the catalog version (before, after) the commit, for the
+    # in-memory indexes to apply the change in place when nothing else changed in between
+    before = get_catalog_version()
+    db.session.add(obj)
+    db.session.flush()
+    after = bump_catalog_version()
+    db.session.commit()
+    return before, after
+
+# Loads a recipe and all its ingredient lines in one query, returns None if it doesn't exist
 def get_recipe(id):
-    r_query = db.session.query(Recipe).get(id)
-    recipe = Recipe_val(r_query)
-    return recipe
+    rows = db.session.query(Recipe.id, Recipe.name, Recipe.time, Recipe.rating, Recipe.description, Recipe.steps,
+                            Ingredient.id.label('i_id'), Ingredient.name.label('i_name'),
+                            RI_Association.amount, Ingredient.measure)\
+        .outerjoin(RI_Association, RI_Association.r_id == Recipe.id)\
+        .outerjoin(Ingredient, Ingredient.id == RI_Association.i_id)\
+        .filter(Recipe.id == id).order_by(RI_Association.i_id).all()
+    if len(rows) == 0:
+        return None
+    r = rows[0]
+    ingredients = [RecipeIngredient(row.i_id, row.i_name, row.amount, row.measure) for row in rows if row.i_id is not None]
+    return Recipe_val(r.id, r.name, r.time, r.rating, r.description, r.steps, ingredients)
+
+# Core select of recipes joined with their ingredient lines, one row per (recipe, ingredient)
+# and ordered by recipe, for readers that serialize rows directly instead of hydrating ORM objects
+def recipe_detail_select():
+    r = Recipe.__table__
+    ri = RI_Association.__table__
+    i = Ingredient.__table__
+    return select([r.c.id, r.c.name, r.c.time, r.c.rating, r.c.description, r.c.steps, r.c.meal, r.c.spoonacular_id,
+                   i.c.id.label('i_id'), i.c.name.label('i_name'), ri.c.amount, i.c.measure])\
+        .select_from(r.outerjoin(ri, ri.c.r_id == r.c.id).outerjoin(i, i.c.id == ri.c.i_id))\
+        .order_by(r.c.id, ri.c.i_id)
+
+# Groups consecutive recipe_detail_select rows into (recipe row, [RecipeIngredient, ...]) pairs.
+# Works on any iterable of rows, so it can consume a streamed result without loading it all
+def group_recipe_rows(rows):
+    current = None
+    ingredients = []
+    for row in rows:
+        if current is not None and row.id != current.id:
+            yield current, ingredients
+            ingredients = []
+        current = row
+        if row.i_id is not None:
+            ingredients.append(RecipeIngredient(row.i_id, row.i_name, row.amount, row.measure))
+    if current is not None:
+        yield current, ingredients
 
 def get_ingredient(id):
     ingredient = db.session.query(Ingredient).get(id)
@@ -204,6 +486,14 @@ def reset_database():
     db.session.rollback()
     db.drop_all()
     db.create_all()
+    get_recipe_index().clear()
+    get_ingredient_prefix_index().clear()
+    invalidate_pantry_matrix()
+    reset_name_search_backend()
+    # the recreated catalog_version row starts again from 0, so anything cached under a version is stale
+    forget_catalog_version()
+    for cache in (get_search_cache(), get_count_cache(), get_fragment_cache()):
+        cache.clear()
 
 def populate_with_dummy_data():
     add_ingredient("carrots", "units")
@@ -222,17 +512,20 @@ def populate_with_dummy_data():
                    [(6,0,10,0)])
 
 
-def populate_with_data():
+def populate_with_data(cache_mode=None):
 
-    module = spoonacular_module()
-    parse_spoonacular_response(module.get_random_recipes("breakfast"))
-    parse_spoonacular_response(module.get_random_recipes("lunch"))
-    parse_spoonacular_response(module.get_random_recipes("dinner"))
+    # the three meals are fetched concurrently, then parsed and bulk inserted
+    from .ingestion import ingest_spoonacular_responses
+    with spoonacular_module(cache_mode=cache_mode) as module:
+        responses = module.get_random_recipes_for_tags(["breakfast", "lunch", "dinner"])
+    return ingest_spoonacular_responses(responses.items())
 
 # add_recipe(recipeForm.name, recipeForm.time, recipeForm.steps, session.get('ingredients'))
 # Note: Ingredients are a list of tuples consisting of: (ingredientID, ingredientName, ingredientQuantity, ingredientMeasure)
-def add_recipe(name, time, steps, ingredients, rating=4.5, description=""):
-    recipe = Recipe(name=name, time=time, steps=steps, rating=rating, description=description)
+def add_recipe(name, time, steps, ingredients, rating=4.5, description="", meal=None):
+    # stored as given, without a content hash: only the importer recognizes recipes it already has
+    recipe = Recipe(name=name, time=time, steps=steps, rating=rating, description=description, meal=meal)
+    ingred_ids = []
     if ingredients is not None:
         for idx, ingred_tuple in enumerate(ingredients):
             #ingredient = Ingredient.query.filter_by(name=ingred_name).first()
@@ -240,20 +533,37 @@ def add_recipe(name, time, steps, ingredients, rating=4.5, description=""):
             assoc = RI_Association(ingredient=ingredient, amount=ingred_tuple[2])
             #assoc.ingredient = ingredient
             recipe.ingredients.append(assoc)
+            ingred_ids.append(ingred_tuple[0])
 
-    db.session.add(recipe)
-    db.session.commit()
+    versions = commit_catalog_change(recipe)
+    get_recipe_index().add_recipe(recipe.id, ingred_ids, versions)
+    get_ingredient_prefix_index().add_recipe(ingred_ids, versions)
     return recipe.id
 
+# Normalized cache keys for the ingredient searches: the name substring, the set of
+# ingredient ids, and for the amount search the (id, amount) pairs, first occurrence winning
+def ingredient_search_key(recipe_name="", ingred_ids=[]):
+    return (recipe_name, frozenset(ingred_ids))
+
+def amount_search_key(recipe_name="", ingred_ids=[], amounts=[]):
+    pairs = {}
+    for idx, i_id in enumerate(ingred_ids):
+        if i_id not in pairs:
+            pairs[i_id] = amounts[idx] if idx < len(amounts) else None
+    return (recipe_name, frozenset(pairs.items()))
+
+@cached_search(ingredient_search_key)
 def search_recipe_by_ingredient(recipe_name="", ingred_ids=[]):
     # returns a list of recipe ids that include the name as a substring and include the ingredients
+    if current_app.config.get('RECIPE_SEARCH_BACKEND') == 'index':
+        return search_recipe_by_ingredient_index(recipe_name, ingred_ids)
 
     # do a left join using recipes filtered by name, with the ingredient association list
-    potential_recipes = db.session.query(Recipe).outerjoin(RI_Association).filter(Recipe.name.like("%{}%".format(recipe_name)))\
+    potential_recipes = db.session.query(Recipe).outerjoin(RI_Association).filter(name_filter(Recipe, recipe_name))\
         .filter(RI_Association.i_id.in_(ingred_ids)).order_by(Recipe.name).with_entities(Recipe.id)
     pot_rec_set = {r.id for r in potential_recipes}
     
-    bad_recipes = db.session.query(Recipe).outerjoin(RI_Association).filter(Recipe.name.like("%{}%".format(recipe_name)))\
+    bad_recipes = db.session.query(Recipe).outerjoin(RI_Association).filter(name_filter(Recipe, recipe_name))\
         .filter(RI_Association.i_id.notin_(ingred_ids)).order_by(Recipe.name).with_entities(Recipe.id)
     bad_rec_set = {r.id for r in bad_recipes}
 
@@ -262,86 +572,248 @@ def search_recipe_by_ingredient(recipe_name="", ingred_ids=[]):
 
     return list(pot_good_recipes)
 
+def search_recipe_by_ingredient_index(recipe_name="", ingred_ids=[]):
+    # same result as the sql search, but the ingredient subset check is done on the in-memory index
+    matches = get_recipe_index().search(ingred_ids)
+    if matches == 0:
+        return []
+    ids = bitset_to_ids(matches)
+    if recipe_name:
+        named = {id for id, in db.session.query(Recipe.id).filter(name_filter(Recipe, recipe_name))}
+        ids = [id for id in ids if id in named]
+    return ids
+
+@cached_search(amount_search_key)
 def search_recipe_by_ingredient_amounts(recipe_name="", ingred_ids=[], amounts=[]):
-    # Acquire list of recipes with correct ingredients, and then check their amounts with expected amounts
-    pot_recipes = search_recipe_by_ingredient(recipe_name, ingred_ids)
-
-    recipe_ids = []
-    for r_id in pot_recipes:
-        correct_amounts = True
-        recipe = get_recipe(r_id)
-        for i_idx, ingredient in enumerate(recipe.ingredients):
-            try:
-                i_idx2 = ingred_ids.index(ingredient.id)
-                if (recipe.amounts[i_idx] > amounts[i_idx2]):
-                    # if ingredient amount in recipe greater than amount provided, recipe is bad
-                    correct_amounts = False
-                    break
-            except ValueError:
-                # if ingredient not in provided list, recipe is bad
-                # theoretically this shouldn't occur
-                # print("Shouldn't occur")
-                # print(recipe.ingredients)
-                # print(ingred_ids)
-                correct_amounts = False
-                break
-        if correct_amounts:
-            recipe_ids.append(r_id)
+    # One grouped query: every recipe ingredient has to be in the pantry (coverage)
+    # and no recipe amount may exceed the provided amount
+    if current_app.config.get('RECIPE_AMOUNT_SEARCH_BACKEND') == 'matrix':
+        return search_recipe_by_ingredient_amounts_matrix(recipe_name, ingred_ids, amounts)
+    pantry = pantry_subquery(ingred_ids, amounts)
+    if pantry is None:
+        return []
+
+    too_much = case([(RI_Association.amount > pantry.c.amount, 1)], else_=0)
+    recipes = db.session.query(Recipe.id).join(RI_Association, RI_Association.r_id == Recipe.id)\
+        .outerjoin(pantry, pantry.c.i_id == RI_Association.i_id)\
+        .filter(name_filter(Recipe, recipe_name))\
+        .group_by(Recipe.id, Recipe.name)\
+        .having(func.count(pantry.c.i_id) == func.count())\
+        .having(func.sum(too_much) == 0)\
+        .order_by(Recipe.name, Recipe.id)
+    return [r.id for r in recipes]
+
+def search_recipe_by_ingredient_amounts_matrix(recipe_name="", ingred_ids=[], amounts=[]):
+    # same result, in the same (name, id) order, as the sql search, checked against
+    # the numpy recipe x ingredient matrix
+    recipe_ids = [int(r_id) for r_id in get_pantry_matrix().search(ingred_ids, amounts)]
+    if recipe_name and len(recipe_ids) > 0:
+        named = {r.id for r in db.session.query(Recipe.id).filter(name_filter(Recipe, recipe_name))}
+        recipe_ids = [r_id for r_id in recipe_ids if r_id in named]
     return recipe_ids
 
+# Evaluate many (ingred_ids, amounts) pantries in one call, returns a list of recipe id lists
+def search_recipes_for_pantries(pantries):
+    return [[int(r_id) for r_id in result] for result in get_pantry_matrix().feasible(pantries)]
+
+# Ranked "near-miss" search: recipes that use at least one pantry ingredient and miss at most
+# max_missing of their own ingredients. Ranking and paging are done by the database, so only
+# the requested page is ever materialized and its missing ingredients fetched in one more query.
+# The query is driven from the pantry: pantry JOIN RI on i_id (the ix_RI_i_id index) gives the
+# candidate recipes with their matched counts, and each candidate's ingredient count is read
+# from the RI primary key (r_id, i_id), so recipes sharing nothing with the pantry are never read.
+def search_recipe_near_miss(recipe_name="", ingred_ids=[], max_missing=1, page=1, per_page=20):
+    pantry = pantry_subquery(ingred_ids)
+    if pantry is None:
+        return []
+
+    candidates = db.session.query(RI_Association.r_id.label('r_id'), func.count().label('matched'))\
+        .join(pantry, pantry.c.i_id == RI_Association.i_id)\
+        .group_by(RI_Association.r_id).subquery('candidates')
+    all_ingredients = aliased(RI_Association)
+    matched = candidates.c.matched
+    missing = func.count(all_ingredients.i_id) - matched
+    recipes = db.session.query(Recipe.id, Recipe.name, matched.label('matched'), missing.label('missing'))\
+        .join(candidates, candidates.c.r_id == Recipe.id)\
+        .join(all_ingredients, all_ingredients.r_id == Recipe.id)\
+        .filter(name_filter(Recipe, recipe_name))\
+        .group_by(Recipe.id, Recipe.name, matched)\
+        .having(missing <= max_missing)\
+        .order_by(matched.desc(), missing, Recipe.name, Recipe.id)\
+        .limit(per_page).offset((max(page, 1) - 1) * per_page).all()
+    if len(recipes) == 0:
+        return []
+
+    missing_ingredients = {r.id: [] for r in recipes}
+    if any(r.missing > 0 for r in recipes):
+        rows = db.session.query(RI_Association.r_id, Ingredient.id, Ingredient.name)\
+            .join(Ingredient, Ingredient.id == RI_Association.i_id)\
+            .filter(RI_Association.r_id.in_(list(missing_ingredients)))\
+            .filter(RI_Association.i_id.notin_(list(set(ingred_ids))))\
+            .order_by(Ingredient.name)
+        for r_id, i_id, i_name in rows:
+            missing_ingredients[r_id].append((i_id, i_name))
+
+    return [NearMissResult(r.id, r.name, r.matched, missing_ingredients[r.id]) for r in recipes]
+
+# Build the user's (ingredient id, amount) pairs as an inline table of UNION ALL selects,
+# which both sqlite and postgres accept where a VALUES list would need dialect specific sql
+def pantry_subquery(ingred_ids, amounts=None):
+    pairs = {}
+    for idx, i_id in enumerate(ingred_ids):
+        # the first occurrence of an ingredient wins, like list.index would
+        if i_id not in pairs:
+            pairs[i_id] = amounts[idx] if amounts is not None and idx < len(amounts) else None
+    if len(pairs) == 0:
+        return None
+    rows = [select([cast(literal(i_id), db.Integer).label('i_id'), cast(literal(amount), db.Float).label('amount')])
+            for i_id, amount in pairs.items()]
+    if len(rows) == 1:
+        return rows[0].alias('pantry')
+    return union_all(*rows).alias('pantry')
+
 
 
 # Get all saved recipes for a given user
 def get_user_saved_recipes(userID):
     return db.session.query(Recipe).join(RU_Association).filter_by(u_id=userID, saved=True)
 
+# Projection-only page of a user's saved recipes, as (id, name) rows in recipe id order.
+# The (u_id, saved, r_id) index lets the database seek straight to the page, and the total
+# comes from User.saved_count, so the cost doesn't grow with the number of saved recipes.
+def get_user_saved_recipes_page(userID, after=None, before=None, per_page=None):
+    if per_page is None:
+        per_page = current_app.config['RECIPES_PER_PAGE']
+    backwards = before is not None and after is None
+    cursor = decode_saved_cursor(before if backwards else after) if (after or before) else None
+
+    query = db.session.query(RU_Association.r_id.label('id'), Recipe.name)\
+        .join(Recipe, Recipe.id == RU_Association.r_id)\
+        .filter(RU_Association.u_id == userID, RU_Association.saved == True)
+    if cursor is not None:
+        query = query.filter(RU_Association.r_id < cursor if backwards else RU_Association.r_id > cursor)
+    query = query.order_by(RU_Association.r_id.desc() if backwards else RU_Association.r_id)
+
+    rows = query.limit(per_page + 1).all()
+    has_more = len(rows) > per_page
+    rows = rows[:per_page]
+    if backwards:
+        rows.reverse()
+
+    next_cursor = prev_cursor = None
+    if len(rows) > 0:
+        first, last = str(rows[0].id), str(rows[-1].id)
+        if backwards:
+            prev_cursor = first if has_more else None
+            next_cursor = last
+        else:
+            next_cursor = last if has_more else None
+            prev_cursor = first if cursor is not None else None
+    return RecipePage(rows, next_cursor, prev_cursor, get_user_saved_count(userID))
+
+def decode_saved_cursor(cursor):
+    try:
+        return int(cursor)
+    except ValueError:
+        raise InvalidCursor('malformed cursor')
+
+def get_user_saved_count(userID):
+    count = db.session.query(User.saved_count).filter_by(id=userID).scalar()
+    return count or 0
+
 # Get all recipes user has reviewed
 def get_user_reviewed_recipes(userID):
     return db.session.query(RU_Association).filter_by(u_id=userID).filter(RU_Association.rating.isnot(None))
 
-# Returns recipe's average rating
+# Returns recipe's average rating, from the rating_sum/rating_count kept by add_review
 def get_aggragate_recipe_rating(recipeID):
-    rating = 0
-    num = 0
-    for recipe in db.session.query(RU_Association).filter_by(r_id=recipeID).filter(RU_Association.rating.isnot(None)):
-        rating = rating + recipe.rating
-        num = num + 1
-    if num != 0:
-        return rating / num
-    else:
-        return 0
+    row = db.session.query(Recipe.rating_sum, Recipe.rating_count).filter_by(id=recipeID).first()
+    return average_rating(row)
 
 def get_aggregate_user_rating(userID):
-    rating = 0
-    num = 0
-    for user in db.session.query(RU_Association).filter_by(u_id=userID).filter(RU_Association.rating.isnot(None)):
-        rating = rating + user.rating
-        num = num + 1
-    if num != 0:
-        return rating / num
-    else:
+    row = db.session.query(User.rating_sum, User.rating_count).filter_by(id=userID).first()
+    return average_rating(row)
+
+def average_rating(row):
+    if row is None or not row.rating_count:
         return 0
+    return row.rating_sum / row.rating_count
+
+# Rebuilds every recipe's and user's rating aggregates from the RU table,
+# one grouped query per table, for after bulk loads or manual edits of RU
+def recompute_ratings():
+    for model, key in ((Recipe, RU_Association.r_id), (User, RU_Association.u_id)):
+        totals = db.session.query(key, func.sum(RU_Association.rating), func.count(RU_Association.rating))\
+            .filter(RU_Association.rating.isnot(None)).group_by(key).all()
+        db.session.query(model).update({model.rating_sum: 0, model.rating_count: 0}, synchronize_session=False)
+        db.session.bulk_update_mappings(model, [{'id': id, 'rating_sum': total, 'rating_count': count}
+                                                for id, total, count in totals])
+    rank_recipes()
 
 # Get all reviews for a given recipe
 def get_recipe_reviews(recipeID):
     return db.session.query(RU_Association).filter_by(r_id=recipeID).filter(RU_Association.rating.isnot(None))
 
-# If association exists, toggle saved, otherwise create association and set saved to true
+# Upserts of RU rows. ON CONFLICT DO UPDATE has the same syntax on sqlite (3.24+) and postgres,
+# and makes the insert-or-update one atomic statement, so concurrent requests can't race
+# between looking a row up and writing it. The upserts bypass the ORM (and sqlite doesn't
+# enforce foreign keys), so they only insert when the recipe and the user exist; RETURNING
+# (sqlite 3.35+) gives no row when they didn't.
+RU_EXISTS = ('WHERE EXISTS (SELECT 1 FROM recipes WHERE id = :r_id) '
+             'AND EXISTS (SELECT 1 FROM users WHERE id = :u_id) ')
+TOGGLE_SAVED_UPSERT = text('INSERT INTO "RU" (r_id, u_id, saved) SELECT :r_id, :u_id, :saved ' + RU_EXISTS +
+                           'ON CONFLICT (r_id, u_id) DO UPDATE SET saved = NOT coalesce("RU".saved, :unsaved) '
+                           'RETURNING saved')
+SET_SAVED_UPSERT = text('INSERT INTO "RU" (r_id, u_id, saved) SELECT :r_id, :u_id, :saved ' + RU_EXISTS +
+                        'ON CONFLICT (r_id, u_id) DO UPDATE SET saved = excluded.saved')
+# add_review needs the rating it replaces. Postgres reads it, locked, in a CTE of the upsert.
+# Sqlite's RETURNING only sees the new row, so there the row is first upserted unchanged, which
+# takes sqlite's write lock and returns the old rating, and then updated.
+REVIEW_UPSERT = text('WITH old AS (SELECT rating FROM "RU" WHERE r_id = :r_id AND u_id = :u_id FOR UPDATE), '
+                     'new AS (INSERT INTO "RU" (r_id, u_id, saved, rating, review) '
+                     'SELECT :r_id, :u_id, :saved, :rating, :review ' + RU_EXISTS +
+                     'ON CONFLICT (r_id, u_id) DO UPDATE SET rating = excluded.rating, review = excluded.review '
+                     'RETURNING rating) '
+                     'SELECT (SELECT rating FROM old) AS old_rating FROM new')
+REVIEW_LOCK = text('INSERT INTO "RU" (r_id, u_id, saved) SELECT :r_id, :u_id, :saved ' + RU_EXISTS +
+                   'ON CONFLICT (r_id, u_id) DO UPDATE SET rating = "RU".rating RETURNING rating AS old_rating')
+REVIEW_UPDATE = text('UPDATE "RU" SET rating = :rating, review = :review WHERE r_id = :r_id AND u_id = :u_id')
+
+def missing_recipe_or_user(recipeID, userID):
+    # only looked up after an upsert wrote nothing, to say which one doesn't exist
+    if db.session.query(Recipe.id).filter_by(id=recipeID).first() is None:
+        return ValueError('no recipe with id {}'.format(recipeID))
+    return ValueError('no user with id {}'.format(userID))
+
+# If association exists, toggle saved, otherwise create association and set saved to true.
+# Raises ValueError if the recipe or the user doesn't exist.
 def save_recipe(userID, recipeID):
-    user_recipe = db.session.query(RU_Association).filter_by(u_id=userID, r_id=recipeID).first()
-    if user_recipe is not None:
-        if user_recipe.saved == True:
-            user_recipe.saved = False
-        else:
-            user_recipe.saved = True
-    else:
-        user_recipe = RU_Association(r_id=recipeID, u_id=userID, saved=True)
-        current_user = db.session.query(User).filter_by(id=userID).first()
-        current_recipe = db.session.query(Recipe).filter_by(id=recipeID).first()
-        current_user.recipes.append(user_recipe)
-        current_recipe.users.append(user_recipe)
-        db.session.add(user_recipe)
+    params = {'r_id': int(recipeID), 'u_id': int(userID), 'saved': True, 'unsaved': False}
+    row = db.session.execute(TOGGLE_SAVED_UPSERT, params).fetchone()
+    if row is None:
+        raise missing_recipe_or_user(params['r_id'], params['u_id'])
+    db.session.query(User).filter_by(id=params['u_id'])\
+        .update({User.saved_count: User.saved_count + (1 if row.saved else -1)}, synchronize_session=False)
+    db.session.commit()
+
+# Saves and unsaves many recipes in one transaction, unknown recipe ids are skipped and an id
+# in both lists ends up unsaved. Returns the user's new saved count, raises ValueError for an
+# unknown user.
+def set_saved_recipes(userID, save_ids=(), unsave_ids=()):
+    wanted = {int(id): True for id in save_ids}
+    wanted.update((int(id), False) for id in unsave_ids)
+    userID = int(userID)
+    if wanted:
+        db.session.execute(SET_SAVED_UPSERT, [{'r_id': id, 'u_id': userID, 'saved': saved}
+                                              for id, saved in wanted.items()])
+    # recounted from the (u_id, saved, r_id) index rather than working out which rows changed,
+    # the update matching no row means there is no such user
+    count = select([func.count()]).where(and_(RU_Association.u_id == userID, RU_Association.saved == True)).as_scalar()
+    if db.session.query(User).filter_by(id=userID).update({User.saved_count: count}, synchronize_session=False) == 0:
+        db.session.rollback()
+        raise ValueError('no user with id {}'.format(userID))
     db.session.commit()
+    return get_user_saved_count(userID)
 
 def is_saved_recipe(userID, recipeID):
     user_recipe = db.session.query(RU_Association).filter_by(u_id=userID, r_id=recipeID).first()
@@ -351,62 +823,37 @@ def is_saved_recipe(userID, recipeID):
         return False
 
 
-# If association exists, add rating and review, otherwise create association and set rating and review
-def add_review(userID, recipeID, rating, review):
-    user_recipe = db.session.query(RU_Association).filter_by(u_id=userID, r_id=recipeID).first()
-    if user_recipe is not None:
-        user_recipe.rating = rating
-        user_recipe.review = review
+# Writes the review and returns the rating it replaced, raises ValueError if the recipe or the
+# user doesn't exist. Concurrent reviews of the same recipe by the same user take turns on the RU row.
+def write_review(params):
+    if db.engine.dialect.name == 'postgresql':
+        row = db.session.execute(REVIEW_UPSERT, params).fetchone()
     else:
-        user_recipe = RU_Association(r_id=recipeID, u_id=userID, saved=False, rating=rating, review=review)
-        current_user = db.session.query(User).filter_by(id=userID).first()
-        current_recipe = db.session.query(Recipe).filter_by(id=recipeID).first()
-        current_user.recipes.append(user_recipe)
-        current_recipe.users.append(user_recipe)
-        db.session.add(user_recipe)
+        row = db.session.execute(REVIEW_LOCK, params).fetchone()
+        if row is not None:
+            db.session.execute(REVIEW_UPDATE, params)
+    if row is None:
+        raise missing_recipe_or_user(params['r_id'], params['u_id'])
+    return row.old_rating
+
+# If association exists, add rating and review, otherwise create association and set rating and review.
+# Raises ValueError if the recipe or the user doesn't exist.
+def add_review(userID, recipeID, rating, review):
+    params = {'r_id': int(recipeID), 'u_id': int(userID), 'saved': False, 'rating': rating, 'review': review}
+    # a replaced review takes its old rating out of the aggregates
+    old_rating = write_review(params)
+    sum_change = (rating or 0) - (old_rating or 0)
+    count_change = int(rating is not None) - int(old_rating is not None)
+    # the right hand sides see the old values, so the score is computed from the changed ones
+    db.session.query(Recipe).filter_by(id=params['r_id']).update(
+        {Recipe.rating_sum: Recipe.rating_sum + sum_change, Recipe.rating_count: Recipe.rating_count + count_change,
+         Recipe.rating_score: rating_score(Recipe.rating_sum + sum_change, Recipe.rating_count + count_change)},
+        synchronize_session=False)
+    db.session.query(User).filter_by(id=params['u_id']).update(
+        {User.rating_sum: User.rating_sum + sum_change, User.rating_count: User.rating_count + count_change},
+        synchronize_session=False)
     db.session.commit()
 
-def parse_spoonacular_response(response):
-
-    for recipe in response:
-        toAdd = {}
-        ingredients = []
-        if 'title' in recipe:
-            toAdd['name'] = recipe['title']
-
-        if 'readyInMinutes' in recipe:
-            toAdd['time'] = recipe['readyInMinutes']
-        else:
-            toAdd['time'] = recipe['preparationMinutes'] + recipe['cookingMinutes']
-        toAdd['rating'] = recipe['spoonacularScore'] % 6 if 'spoonacularScore' in recipe else 4.5
-        for ingredient in recipe['extendedIngredients']:
-            ret = ingredient_unit_parser(ingredient)
-            if len(ret) > 0:
-                ingredients.append(ret)
-        instructions = ""
-        print(recipe)
-        if 'instructions' in recipe:
-            instructions = recipe['instructions']
-            recipeSteps = instructions.replace(".", "\n")
-        elif 'analyzedInstructions' in recipe:
-            for ins in recipe['analyzedInstructions']:
-                instructions += ins['step'] + '\n'
-        toAdd['steps'] = instructions
-        toAdd['description'] = recipe['summary'] if 'summary' in recipe else ''
-        
-        add_recipe(toAdd['name'], toAdd['time'], toAdd['steps'], ingredients, toAdd['rating'], toAdd['description'])
-    
-def ingredient_unit_parser(ingredient):
-    id = -1
-    if 'measures' in ingredient:
-        if 'metric' in ingredient['measures']:
-            if 'unitShort' in ingredient['measures']['metric']:
-                if get_ingredient_by_name(ingredient['name']) is None:
-                    id = add_ingredient(ingredient['name'], ingredient['measures']['metric']['unitShort'])
-                else:
-                    return ()
-                # else:
-                #     id = get_ingredient_by_name(ingredient['name']).id
-                ingredientTuple = (id, ingredient['name'], ingredient['measures']['metric']['amount'], ingredient['measures']['metric']['unitShort'])
-                return ingredientTuple
-    return ()
\ No newline at end of file
+def parse_spoonacular_response(response, meal=None):
+    from .ingestion import ingest_spoonacular_responses
+    return ingest_spoonacular_responses([(meal, response)])
@@ -0,0 +1,116 @@
+from flask import current_app
+from sqlalchemy import DDL, event, select, text, true
+from sqlalchemy.exc import DBAPIError
+from sqlalchemy.sql import table, column
+from . import db
+
+
+# Substring search over the name column of recipes and ingredients.
+# A plain LIKE '%x%' can't use a btree index, so every search is a full table scan. Instead:
+#   sqlite:   an external content FTS5 table with the trigram tokenizer, kept in sync by triggers.
+#   postgres: a pg_trgm GIN index on the name column, which the planner uses for LIKE directly.
+#   others:   LIKE on the base table.
+# Trigrams can't serve a phrase shorter than 3 characters (FTS5 falls back to scanning the whole
+# fts table and pg_trgm to scanning the whole index), so those always use LIKE on the base table.
+# The structures are created by the migration for existing databases and by the
+# after_create hooks below for databases built with db.create_all().
+
+MIN_TRIGRAM_PHRASE = 3
+
+def fts_table_name(tablename):
+    return tablename + '_fts'
+
+def trgm_index_name(tablename):
+    return 'ix_' + tablename + '_name_trgm'
+
+def sqlite_name_search_ddl(tablename):
+    fts = fts_table_name(tablename)
+    statements = [
+        "CREATE VIRTUAL TABLE IF NOT EXISTS {fts} USING fts5(name, content='{t}', content_rowid='id', tokenize='trigram')",
+        "CREATE TRIGGER IF NOT EXISTS {fts}_ai AFTER INSERT ON {t} BEGIN "
+        "INSERT INTO {fts}(rowid, name) VALUES (new.id, new.name); END",
+        "CREATE TRIGGER IF NOT EXISTS {fts}_ad AFTER DELETE ON {t} BEGIN "
+        "INSERT INTO {fts}({fts}, rowid, name) VALUES ('delete', old.id, old.name); END",
+        "CREATE TRIGGER IF NOT EXISTS {fts}_au AFTER UPDATE OF name ON {t} BEGIN "
+        "INSERT INTO {fts}({fts}, rowid, name) VALUES ('delete', old.id, old.name); "
+        "INSERT INTO {fts}(rowid, name) VALUES (new.id, new.name); END",
+        "INSERT INTO {fts}({fts}) VALUES ('rebuild')",
+    ]
+    return [statement.format(fts=fts, t=tablename) for statement in statements]
+
+def install_name_search(model_table):
+    tablename = model_table.name
+    event.listen(model_table, 'after_create', lambda target, connection, **kw: create_name_search(connection, tablename))
+    # the triggers are dropped along with the base table, the fts table has to go explicitly
+    event.listen(model_table, 'before_drop',
+                 DDL("DROP TABLE IF EXISTS {}".format(fts_table_name(tablename))).execute_if(dialect='sqlite'))
+
+def create_name_search(connection, tablename):
+    # The trigram tokenizer needs sqlite 3.34+ built with FTS5, and CREATE EXTENSION pg_trgm needs
+    # a role allowed to create it. Where they're missing the table is created without them and
+    # searches use LIKE, since detect_name_search_backend only picks a backend whose structures exist.
+    dialect = connection.dialect.name
+    if dialect == 'sqlite':
+        if connection.dialect.dbapi.sqlite_version_info < (3, 34, 0):
+            current_app.logger.warning('sqlite %s has no trigram tokenizer, %s name search uses LIKE',
+                                       connection.dialect.dbapi.sqlite_version, tablename)
+            return
+        statements = sqlite_name_search_ddl(tablename)
+    elif dialect == 'postgresql':
+        statements = ["CREATE EXTENSION IF NOT EXISTS pg_trgm",
+                      "CREATE INDEX IF NOT EXISTS {} ON {} USING gin (name gin_trgm_ops)"
+                      .format(trgm_index_name(tablename), tablename)]
+    else:
+        return
+    # in a savepoint, so a failure doesn't abort the transaction create_all runs in on postgres
+    transaction = connection.begin_nested()
+    try:
+        for statement in statements:
+            connection.execute(text(statement))
+        transaction.commit()
+    except DBAPIError as e:
+        transaction.rollback()
+        if dialect == 'sqlite':
+            # sqlite runs DDL outside the transaction, so drop whatever part got created
+            fts = fts_table_name(tablename)
+            for suffix in ['_ai', '_ad', '_au']:
+                connection.execute(text("DROP TRIGGER IF EXISTS " + fts + suffix))
+            connection.execute(text("DROP TABLE IF EXISTS " + fts))
+        current_app.logger.warning('could not create the %s name search index, it uses LIKE: %s', tablename, e.orig)
+
+def get_name_search_backend():
+    backend = current_app.extensions.get('name_search_backend')
+    if backend is None:
+        backend = detect_name_search_backend()
+        current_app.extensions['name_search_backend'] = backend
+    return backend
+
+def detect_name_search_backend():
+    if current_app.config.get('NAME_SEARCH_BACKEND', 'auto') != 'auto':
+        return current_app.config['NAME_SEARCH_BACKEND']
+    dialect = db.engine.dialect.name
+    if dialect == 'sqlite':
+        found = db.session.execute("SELECT count(*) FROM sqlite_master WHERE type = 'table' AND name IN (:r, :i)",
+                                   {'r': fts_table_name('recipes'), 'i': fts_table_name('ingredients')}).scalar()
+        if found == 2:
+            return 'fts5'
+    elif dialect == 'postgresql':
+        found = db.session.execute("SELECT count(*) FROM pg_indexes WHERE indexname IN (:r, :i)",
+                                   {'r': trgm_index_name('recipes'), 'i': trgm_index_name('ingredients')}).scalar()
+        if found == 2:
+            return 'trgm'
+    return 'like'
+
+def reset_name_search_backend():
+    current_app.extensions.pop('name_search_backend', None)
+
+def name_filter(model, phrase):
+    # returns a filter clause selecting the rows of model whose name contains phrase
+    if not phrase:
+        return true()
+    pattern = "%{}%".format(phrase)
+    if len(phrase) >= MIN_TRIGRAM_PHRASE and get_name_search_backend() == 'fts5':
+        fts = table(fts_table_name(model.__tablename__), column('rowid'), column('name'))
+        return model.id.in_(select([fts.c.rowid]).where(fts.c.name.like(pattern)))
+    # pg_trgm indexes are used by LIKE itself, so 'trgm' needs no special query
+    return model.name.like(pattern)
@@ -0,0 +1,127 @@
+from threading import Lock
+from flask import current_app
+from sqlalchemy import select
+from . import db
+from .cache import get_catalog_version
+
+try:
+    import numpy as np
+except ImportError:  # the matrix engine is optional, the sql search works without numpy
+    np = None
+
+
+# Recipe requirements as a CSR recipe x ingredient amount matrix, for checking a pantry
+# against the whole catalog with a few vectorized operations.
+# Row r holds the entries indptr[r]:indptr[r + 1] of indices (ingredient ids) and amounts.
+# A recipe is feasible when every one of its entries is in the pantry with at least that amount.
+# The matrix is only rebuilt, from one query over RI, on the first search after the catalog
+# version moved (a recipe changed in any process) or invalidate was called.
+class PantryMatrix():
+    def __init__(self):
+        if np is None:
+            raise RuntimeError('the pantry matrix engine requires numpy')
+        self.lock = Lock()
+        self.build_lock = Lock()
+        self.dirty = True
+        self.version = None
+        self.recipe_ids = np.zeros(0, dtype=np.int64)
+        self.indptr = np.zeros(1, dtype=np.int64)
+        self.indices = np.zeros(0, dtype=np.int64)
+        self.amounts = np.zeros(0, dtype=np.float64)
+        self.rows = np.zeros(0, dtype=np.int64)
+        self.n_ingredients = 0
+
+    def build(self):
+        from .models import RI_Association, Recipe
+        ri = RI_Association.__table__
+        r = Recipe.__table__
+        # cleared and read before the rows, so a write landing while the matrix is loading makes
+        # the next search rebuild again. The version is only published with the arrays.
+        self.dirty = False
+        version = get_catalog_version()
+        # rows are in (name, id) order like the sql search, so results need no sorting
+        result = db.session.execute(select([ri.c.r_id, ri.c.i_id, ri.c.amount])
+                                    .select_from(ri.join(r, r.c.id == ri.c.r_id))
+                                    .order_by(r.c.name, r.c.id, ri.c.i_id))
+        self.load(result.fetchall(), version)
+
+    def load(self, entries, version=None):
+        # entries are (recipe id, ingredient id, amount), with the entries of a recipe next to each
+        # other. Recipes keep the order they come in, which is the order search results are in.
+        if len(entries) > 0:
+            r_ids, i_ids, amounts = zip(*entries)
+        else:
+            r_ids, i_ids, amounts = (), (), ()
+        r_ids = np.fromiter(r_ids, dtype=np.int64, count=len(entries))
+        indices = np.fromiter(i_ids, dtype=np.int64, count=len(entries))
+        # a NULL amount never fails the amount check, like in the sql search
+        amounts = np.array([-np.inf if a is None else a for a in amounts], dtype=np.float64)
+
+        starts = np.flatnonzero(np.r_[True, r_ids[1:] != r_ids[:-1]]) if len(entries) else np.zeros(0, dtype=np.int64)
+        with self.lock:
+            self.recipe_ids = r_ids[starts]
+            self.indptr = np.r_[starts, len(entries)].astype(np.int64)
+            self.indices = indices
+            self.amounts = amounts
+            self.rows = np.repeat(np.arange(len(starts)), np.diff(self.indptr))
+            self.n_ingredients = int(indices.max()) + 1 if len(entries) else 0
+            self.version = version
+
+    def invalidate(self):
+        self.dirty = True
+
+    def ensure_built(self):
+        if not self.dirty and self.version == get_catalog_version():
+            return
+        # one request rebuilds, the others wait for it
+        with self.build_lock:
+            if self.dirty or self.version != get_catalog_version():
+                self.build()
+
+    def pantry_vectors(self, pantries, n_cols):
+        # dense (pantries x ingredients) amounts, NaN where an ingredient is not in the pantry so
+        # that every comparison against it fails, +inf where the pantry gives no amount
+        matrix = np.full((len(pantries), n_cols), np.nan)
+        for row, (ingred_ids, amounts) in enumerate(pantries):
+            for idx, i_id in enumerate(ingred_ids):
+                # the first occurrence of an ingredient wins, like in the sql search
+                if i_id < 0 or i_id >= n_cols or not np.isnan(matrix[row, i_id]):
+                    continue
+                amount = amounts[idx] if idx < len(amounts) and amounts[idx] is not None else np.inf
+                matrix[row, i_id] = amount
+        return matrix
+
+    def feasible(self, pantries, chunk_size=8):
+        # evaluates many (ingred_ids, amounts) pantries at once, returns one recipe id array per pantry,
+        # in recipe (name, id) order
+        self.ensure_built()
+        with self.lock:
+            recipe_ids, indices, amounts, rows = self.recipe_ids, self.indices, self.amounts, self.rows
+            n_cols = self.n_ingredients
+        results = []
+        for start in range(0, len(pantries), chunk_size):
+            matrix = self.pantry_vectors(pantries[start:start + chunk_size], n_cols)
+            bad_rows, bad_entries = np.nonzero(~(amounts <= matrix[:, indices]))
+            bad = np.zeros((len(matrix), len(recipe_ids)), dtype=bool)
+            bad[bad_rows, rows[bad_entries]] = True
+            for row in range(len(matrix)):
+                results.append(recipe_ids[~bad[row]])
+        return results
+
+    def search(self, ingred_ids, amounts):
+        return self.feasible([(ingred_ids, amounts)])[0]
+
+
+def get_pantry_matrix():
+    matrix = current_app.extensions.get('pantry_matrix')
+    if matrix is None:
+        matrix = current_app.extensions.setdefault('pantry_matrix', PantryMatrix())
+    return matrix
+
+
+def invalidate_pantry_matrix():
+    # called by reset_database, other writes reach the matrix through the catalog version.
+    # Doesn't create (and require numpy for) an engine that isn't in use.
+    matrix = current_app.extensions.get('pantry_matrix')
+    if matrix is not None:
+        matrix.invalidate()
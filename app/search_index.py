@@ -0,0 +1,146 @@
+from threading import Lock
+from flask import current_app
+from . import db
+from .cache import get_catalog_version
+
+
+# Per-process inverted index over the RI table for "cook with what I have" searches.
+# Every ingredient maps to a bitset (a python int) with bit r set if recipe r uses it.
+# Recipe ingredient counts are stored bit-sliced: count_planes[k] has bit r set if
+# bit k of recipe r's ingredient count is set. A subset query adds the pantry's
+# bitsets into bit-sliced counters and keeps the recipes whose counter equals their count.
+# The index remembers the catalog version it was built from and is rebuilt on first use after
+# the version moves, so writes by other processes are picked up too. This process's own
+# add_recipe/add_ingredient are applied in place when they were the only change in between.
+# The structures are never changed once published: a rebuild or an added recipe makes new ones
+# and swaps them in under the lock, so a search works on a consistent snapshot.
+class RecipeIngredientIndex():
+    def __init__(self):
+        self.lock = Lock()
+        # held while rebuilding, so concurrent requests wait for one rebuild instead of each doing it
+        self.build_lock = Lock()
+        self.built = False
+        self.version = None
+        self.ingredient_bits = {}
+        self.recipe_counts = {}
+        self.count_planes = []
+
+    def build(self):
+        from .models import RI_Association
+        # read before the rows, so a write landing in between makes the next use rebuild again
+        version = get_catalog_version()
+        rows = db.session.query(RI_Association.r_id, RI_Association.i_id).all()
+        recipes = {}
+        for r_id, i_id in rows:
+            recipes.setdefault(r_id, []).append(i_id)
+        ingredient_bits, recipe_counts, count_planes = {}, {}, []
+        for r_id, ingred_ids in recipes.items():
+            add_recipe_bits(ingredient_bits, recipe_counts, count_planes, r_id, ingred_ids)
+        with self.lock:
+            self.ingredient_bits = ingredient_bits
+            self.recipe_counts = recipe_counts
+            self.count_planes = count_planes
+            self.version = version
+            self.built = True
+
+    def ensure_built(self):
+        if self.built and self.version == get_catalog_version():
+            return
+        with self.build_lock:
+            if not self.built or self.version != get_catalog_version():
+                self.build()
+
+    def clear(self):
+        with self.lock:
+            self.ingredient_bits = {}
+            self.recipe_counts = {}
+            self.count_planes = []
+            self.built = False
+            self.version = None
+
+    def add_recipe(self, recipe_id, ingred_ids, versions):
+        # versions is the (before, after) catalog version of the write, see is_next_version
+        with self.lock:
+            if is_next_version(self, versions):
+                ingredient_bits, recipe_counts = dict(self.ingredient_bits), dict(self.recipe_counts)
+                count_planes = list(self.count_planes)
+                add_recipe_bits(ingredient_bits, recipe_counts, count_planes, recipe_id, ingred_ids)
+                self.ingredient_bits, self.recipe_counts, self.count_planes = ingredient_bits, recipe_counts, count_planes
+                self.version = versions[1]
+
+    def add_ingredient(self, ingredient_id, versions):
+        with self.lock:
+            if is_next_version(self, versions):
+                self.ingredient_bits = dict(self.ingredient_bits)
+                self.ingredient_bits.setdefault(ingredient_id, 0)
+                self.version = versions[1]
+
+    def search(self, ingred_ids):
+        # returns a bitset of recipes whose ingredients are all contained in ingred_ids
+        self.ensure_built()
+        with self.lock:
+            ingredient_bits, count_planes = self.ingredient_bits, self.count_planes
+
+        candidates = 0
+        counters = []
+        for i_id in set(ingred_ids):
+            carry = ingredient_bits.get(i_id, 0)
+            if carry == 0:
+                continue
+            candidates |= carry
+            # ripple-carry add of the ingredient bitset into the bit-sliced counters
+            for k in range(len(counters)):
+                counters[k], carry = counters[k] ^ carry, counters[k] & carry
+                if carry == 0:
+                    break
+            if carry:
+                counters.append(carry)
+
+        matches = candidates
+        for k in range(max(len(counters), len(count_planes))):
+            counter = counters[k] if k < len(counters) else 0
+            plane = count_planes[k] if k < len(count_planes) else 0
+            matches &= ~(counter ^ plane)
+        return matches
+
+    def search_ids(self, ingred_ids):
+        return bitset_to_ids(self.search(ingred_ids))
+
+
+def is_next_version(index, versions):
+    # True when a built index is at the version before a write and the write was the only change
+    # since, i.e. bumped the version by exactly one, so it can be applied in place. Otherwise the
+    # index is left alone and rebuilt on its next use.
+    before, after = versions
+    return index.built and index.version == before and after == before + 1
+
+def add_recipe_bits(ingredient_bits, recipe_counts, count_planes, recipe_id, ingred_ids):
+    # sets the recipe's bit in its ingredients' bitsets and its count's bit planes
+    ingred_ids = set(ingred_ids)
+    if recipe_id in recipe_counts or len(ingred_ids) == 0:
+        return
+    bit = 1 << recipe_id
+    for i_id in ingred_ids:
+        ingredient_bits[i_id] = ingredient_bits.get(i_id, 0) | bit
+    count = len(ingred_ids)
+    recipe_counts[recipe_id] = count
+    while len(count_planes) < count.bit_length():
+        count_planes.append(0)
+    for k in range(count.bit_length()):
+        if count >> k & 1:
+            count_planes[k] |= bit
+
+def bitset_to_ids(bits):
+    ids = []
+    while bits:
+        low = bits & -bits
+        ids.append(low.bit_length() - 1)
+        bits ^= low
+    return ids
+
+
+def get_recipe_index():
+    index = current_app.extensions.get('recipe_index')
+    if index is None:
+        index = current_app.extensions.setdefault('recipe_index', RecipeIngredientIndex())
+    return index
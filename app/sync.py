@@ -0,0 +1,128 @@
+import os
+import socket
+from datetime import datetime, timedelta
+from flask import current_app
+from sqlalchemy import or_
+from . import db
+from .models import Recipe, SyncState
+from .ingestion import ingest_spoonacular_responses
+from app.integrations.spoonacular_module import spoonacular_module
+
+# Incremental catalog sync. Each target ("tag:dinner" or "query:pasta") is paged through with
+# complexSearch, starting at its stored watermark. Ids already in the catalog (the unique
+# recipes.spoonacular_id index is the set of seen ids) aren't fetched again, the rest are
+# fetched with informationBulk and ingested. A run stops when it has sent budget requests,
+# and the watermarks are saved after every page, so the next run carries on from there.
+# The lock's lease is renewed before every page. If it ran out and another node took the lock
+# over, the run stops there and its stats say lock_lost.
+
+LOCK_NAME = 'lock:catalog_sync'
+
+def target_params(target):
+    # (complexSearch params, meal) for a sync target
+    kind, _, value = target.partition(':')
+    if kind == 'tag':
+        return {'type': value}, value
+    if kind == 'query':
+        return {'query': value}, None
+    raise ValueError('sync targets look like tag:<meal type> or query:<keyword>, not ' + repr(target))
+
+def get_sync_state(name):
+    state = db.session.query(SyncState).get(name)
+    if state is None:
+        # another node may insert it at the same time, the upsert makes that harmless
+        db.session.execute('INSERT INTO sync_state (name, watermark) VALUES (:name, 0) ON CONFLICT (name) DO NOTHING',
+                           {'name': name})
+        db.session.commit()
+        state = db.session.query(SyncState).get(name)
+    return state
+
+def acquire_sync_lock(owner, lease_seconds):
+    # takes the lock row if it is free or its lease ran out, in one conditional update
+    get_sync_state(LOCK_NAME)
+    now = datetime.utcnow()
+    taken = db.session.query(SyncState)\
+        .filter(SyncState.name == LOCK_NAME,
+                or_(SyncState.locked_until.is_(None), SyncState.locked_until < now, SyncState.locked_by == owner))\
+        .update({SyncState.locked_by: owner, SyncState.locked_until: now + timedelta(seconds=lease_seconds)},
+                synchronize_session=False)
+    db.session.commit()
+    return taken == 1
+
+def release_sync_lock(owner):
+    db.session.query(SyncState).filter(SyncState.name == LOCK_NAME, SyncState.locked_by == owner)\
+        .update({SyncState.locked_by: None, SyncState.locked_until: None}, synchronize_session=False)
+    db.session.commit()
+
+def save_watermark(target, watermark):
+    db.session.query(SyncState).filter_by(name=target)\
+        .update({SyncState.watermark: watermark, SyncState.updated_at: datetime.utcnow()}, synchronize_session=False)
+    db.session.commit()
+
+def sync_catalog(targets=None, budget=None, module=None, owner=None, page_size=None, lease_seconds=None):
+    # returns the run's stats, or None if another node holds the lock. A run that lost the lock
+    # part way through stops early, with stats['lock_lost'] set.
+    config = current_app.config
+    targets = targets or config['SYNC_TARGETS']
+    budget = config['SYNC_REQUEST_BUDGET'] if budget is None else budget
+    page_size = page_size or config['SYNC_PAGE_SIZE']
+    lease_seconds = lease_seconds or config['SYNC_LOCK_LEASE']
+    owner = owner or '{}:{}'.format(socket.gethostname(), os.getpid())
+    for target in targets:
+        target_params(target)
+    if not acquire_sync_lock(owner, lease_seconds):
+        return None
+
+    own_module = module is None
+    if own_module:
+        module = spoonacular_module()
+    stats = {'requests': 0, 'pages': 0, 'seen': 0, 'fetched': 0, 'recipes': 0, 'lock_lost': False}
+    start = module.requests_made
+    try:
+        active = list(targets)
+        # one page per target in turn, so a small budget is shared between them
+        while active and module.requests_made - start < budget and not stats['lock_lost']:
+            for target in list(active):
+                if module.requests_made - start >= budget:
+                    break
+                # still ours for another lease, unless another node took it over meanwhile
+                if not acquire_sync_lock(owner, lease_seconds):
+                    stats['lock_lost'] = True
+                    break
+                if not sync_target_page(target, module, budget - (module.requests_made - start), page_size, stats):
+                    active.remove(target)
+    finally:
+        stats['requests'] = module.requests_made - start
+        if own_module:
+            module.close()
+        release_sync_lock(owner)
+    return stats
+
+def sync_target_page(target, module, budget, page_size, stats):
+    # fetches and ingests one page of target, returns False when the target has nothing more this run
+    params, meal = target_params(target)
+    offset = get_sync_state(target).watermark
+    page = module.search_recipes(params, offset, page_size)
+    stats['pages'] += 1
+    ids = [result['id'] for result in page.get('results') or [] if 'id' in result]
+    if not ids:
+        # ran off the end of the results, start from the top next time
+        save_watermark(target, 0)
+        return False
+
+    seen = {id for id, in db.session.query(Recipe.spoonacular_id).filter(Recipe.spoonacular_id.in_(ids))}
+    new_ids = [id for id in ids if id not in seen]
+    stats['seen'] += len(ids) - len(new_ids)
+    # what's left of the budget after the search buys budget - 1 informationBulk requests
+    affordable = new_ids[:max(0, budget - 1) * module.bulk_chunk_size]
+    if affordable:
+        recipes = module.get_recipes_information(affordable)
+        stats['fetched'] += len(recipes)
+        stats['recipes'] += ingest_spoonacular_responses([(meal, recipes)])['recipes']
+    # the watermark only moves past the ids that were handled
+    handled = ids.index(new_ids[len(affordable)]) if len(affordable) < len(new_ids) else len(ids)
+    watermark = offset + handled
+    if handled == len(ids) and watermark >= page.get('totalResults', watermark + 1):
+        watermark = 0
+    save_watermark(target, watermark)
+    return handled == len(ids) and watermark != 0
@@ -0,0 +1,77 @@
+#!/usr/bin/env python
+# Compares the sql amount-aware search with the numpy pantry matrix on a synthetic catalog.
+# usage: python benchmarks/pantry_matrix.py [num_recipes] [num_pantries]
+import os
+import random
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+db_file = os.path.join(tempfile.mkdtemp(), 'bench.sqlite')
+os.environ['DATABASE_URL'] = 'sqlite:///' + db_file
+
+from app import create_app, db
+from app.models import Recipe, Ingredient, RI_Association, search_recipe_by_ingredient_amounts, \
+    search_recipes_for_pantries, get_pantry_matrix
+
+NUM_INGREDIENTS = 2000
+
+
+def populate(num_recipes):
+    random.seed(42)
+    db.session.execute(Ingredient.__table__.insert(),
+                       [{'id': i, 'name': 'ingredient %d' % i, 'measure': 'mass'} for i in range(1, NUM_INGREDIENTS + 1)])
+    db.session.execute(Recipe.__table__.insert(),
+                       [{'id': r, 'name': 'recipe %d' % r, 'time': 10, 'rating': 4.5, 'steps': '', 'description': ''}
+                        for r in range(1, num_recipes + 1)])
+    rows = []
+    for r in range(1, num_recipes + 1):
+        # common ingredients are used much more often than rare ones
+        ingred_ids = {min(int(random.paretovariate(0.8)), NUM_INGREDIENTS) for _ in range(random.randint(2, 12))}
+        rows.extend({'r_id': r, 'i_id': i, 'amount': random.randint(1, 500)} for i in ingred_ids)
+    db.session.execute(RI_Association.__table__.insert(), rows)
+    db.session.commit()
+    return len(rows)
+
+
+def random_pantry():
+    ingred_ids = list({min(int(random.paretovariate(0.8)), NUM_INGREDIENTS) for _ in range(random.randint(5, 40))})
+    return ingred_ids, [random.randint(100, 1000) for _ in ingred_ids]
+
+
+def timed(fn):
+    start = time.perf_counter()
+    result = fn()
+    return result, time.perf_counter() - start
+
+
+def main():
+    num_recipes = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    num_pantries = int(sys.argv[2]) if len(sys.argv) > 2 else 20
+    app = create_app('testing')
+    with app.app_context():
+        db.create_all()
+        _, seconds = timed(lambda: populate(num_recipes))
+        print('populated {} recipes in {:.1f}s'.format(num_recipes, seconds))
+        pantries = [random_pantry() for _ in range(num_pantries)]
+
+        app.config['RECIPE_AMOUNT_SEARCH_BACKEND'] = 'sql'
+        sql_results, sql_seconds = timed(lambda: [sorted(search_recipe_by_ingredient_amounts("", i, a)) for i, a in pantries])
+        _, build_seconds = timed(lambda: get_pantry_matrix().build())
+        app.config['RECIPE_AMOUNT_SEARCH_BACKEND'] = 'matrix'
+        matrix_results, matrix_seconds = timed(lambda: [sorted(search_recipe_by_ingredient_amounts("", i, a)) for i, a in pantries])
+        batch_results, batch_seconds = timed(lambda: search_recipes_for_pantries(pantries))
+
+        assert sql_results == matrix_results == [sorted(r) for r in batch_results]
+        print('average hits per pantry: {:.1f}'.format(sum(len(r) for r in sql_results) / num_pantries))
+        print('sql:          {:8.2f} ms/pantry'.format(1000 * sql_seconds / num_pantries))
+        print('matrix build: {:8.2f} ms (once per catalog change)'.format(1000 * build_seconds))
+        print('matrix:       {:8.2f} ms/pantry'.format(1000 * matrix_seconds / num_pantries))
+        print('matrix batch: {:8.2f} ms/pantry'.format(1000 * batch_seconds / num_pantries))
+        db.drop_all()
+    os.remove(db_file)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,89 @@
+#!/usr/bin/env python
+# Per-ingredient cost of the unit conversions and imperial formatting, scalar vs array kernels.
+# usage: python benchmarks/unit_conversions.py [num_amounts]
+import os
+import random
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from app.main.unit_conversions import metric_to_spoons_volume, metric_to_imp_mass, \
+    metric_to_spoons_volume_array, metric_to_imp_mass_array, volume_string, mass_string, volume_strings, mass_strings
+
+
+# the nested if/format formatter volume_string replaced, kept as the baseline
+def legacy_volume_string(volume):
+    cups, quarterCups, tbsps, tsps = metric_to_spoons_volume(volume)
+    returnString = ""
+    first = True
+    if cups > 0:
+        if cups != 1:
+            returnString = returnString + "{} cups"
+        else:
+            returnString = returnString + "{} cup"
+        returnString = returnString.format(cups)
+        first = False
+    if quarterCups > 0:
+        if not first:
+            returnString = returnString + ", "
+        if quarterCups % 2 != 0:
+            if quarterCups != 1:
+                returnString = returnString + "{} quarter cups"
+            else:
+                returnString = returnString + "{} quarter cup"
+            first = False
+            returnString = returnString.format(quarterCups)
+        else:
+            first = False
+            returnString = returnString + "1 half cup"
+    if tbsps > 0:
+        if not first:
+            returnString = returnString + ", "
+        if tbsps != 1:
+            returnString = returnString + "{} tablespoons"
+        else:
+            returnString = returnString + "{} tablespoon"
+        first = False
+        returnString = returnString.format(tbsps)
+    if tsps > 0:
+        if not first:
+            returnString = returnString + ", "
+        if tsps != 1:
+            returnString = returnString + "{} teaspoons"
+        else:
+            returnString = returnString + "{} teaspoon"
+        first = False
+        returnString = returnString.format(tsps)
+    return returnString
+
+
+def per_item(fn, count, repeat=5):
+    # best of repeat runs, in microseconds per amount
+    return min(timeit.repeat(fn, number=1, repeat=repeat)) / count * 1e6
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    random.seed(42)
+    amounts = [random.uniform(0, 2000) for _ in range(count)]
+    assert [legacy_volume_string(v) for v in amounts[:1000]] == volume_strings(amounts[:1000], False)
+
+    rows = [
+        ('volume conversion, scalar loop', lambda: [metric_to_spoons_volume(v) for v in amounts]),
+        ('volume conversion, array kernel', lambda: metric_to_spoons_volume_array(amounts)),
+        ('mass conversion, scalar loop', lambda: [metric_to_imp_mass(m) for m in amounts]),
+        ('mass conversion, array kernel', lambda: metric_to_imp_mass_array(amounts)),
+        ('volume formatting, nested ifs', lambda: [legacy_volume_string(v) for v in amounts]),
+        ('volume formatting, table scalar', lambda: [volume_string(v, False) for v in amounts]),
+        ('volume formatting, table batch', lambda: volume_strings(amounts, False)),
+        ('mass formatting, table scalar', lambda: [mass_string(m, False) for m in amounts]),
+        ('mass formatting, table batch', lambda: mass_strings(amounts, False)),
+    ]
+    print('{} amounts'.format(count))
+    for name, fn in rows:
+        print('{:34} {:8.3f} us/ingredient'.format(name, per_item(fn, count)))
+
+
+if __name__ == '__main__':
+    main()
@@ -18,6 +18,61 @@ class Config:
     GOCOOKBOOK_MAIL_SUBJECT_PREFIX = '[Go Cookbook]'
     GOCOOKBOOK_MAIL_SENDER = 'Go Cookbook Admin <gocookbook.runtimeerror@gmail.com>'
     SPOONACULAR_SECRET = os.environ.get('SPOONTACULAR_SECRET')
+    SPOONACULAR_BASE_URL = os.environ.get('SPOONACULAR_BASE_URL') or 'https://api.spoonacular.com'
+    # concurrent requests, and the token bucket keeping them under the api quota (requests/second, burst)
+    SPOONACULAR_MAX_WORKERS = int(os.environ.get('SPOONACULAR_MAX_WORKERS') or 4)
+    SPOONACULAR_RATE = float(os.environ.get('SPOONACULAR_RATE') or 2)
+    SPOONACULAR_BURST = int(os.environ.get('SPOONACULAR_BURST') or 4)
+    SPOONACULAR_MAX_RETRIES = int(os.environ.get('SPOONACULAR_MAX_RETRIES') or 3)
+    SPOONACULAR_TIMEOUT = float(os.environ.get('SPOONACULAR_TIMEOUT') or 10)
+    SPOONACULAR_BULK_CHUNK_SIZE = int(os.environ.get('SPOONACULAR_BULK_CHUNK_SIZE') or 50)
+    # 'off', 'cache' to keep responses on disk and reuse them for SPOONACULAR_CACHE_TTL seconds,
+    # or 'replay' to only serve stored responses (however old) and never call the api
+    SPOONACULAR_CACHE_MODE = os.environ.get('SPOONACULAR_CACHE_MODE') or 'off'
+    SPOONACULAR_CACHE_DIR = os.environ.get('SPOONACULAR_CACHE_DIR') or os.path.join(basedir, 'spoonacular_cache')
+    SPOONACULAR_CACHE_TTL = int(os.environ.get('SPOONACULAR_CACHE_TTL') or 7 * 24 * 3600)
+    SPOONACULAR_CACHE_MAX_BYTES = int(os.environ.get('SPOONACULAR_CACHE_MAX_BYTES') or 500 * 1024 * 1024)
+    # 'sql' queries the RI table on every search, 'index' uses the per-process bitset index
+    RECIPE_SEARCH_BACKEND = os.environ.get('RECIPE_SEARCH_BACKEND') or 'sql'
+    # 'auto' uses sqlite FTS5 or postgres pg_trgm when the migration has created them, 'like' forces LIKE scans
+    NAME_SEARCH_BACKEND = os.environ.get('NAME_SEARCH_BACKEND') or 'auto'
+    # 'sql' checks amounts in one grouped query, 'matrix' uses the numpy recipe x ingredient matrix.
+    # numpy is optional and not in requirements.txt, install it to use 'matrix'
+    RECIPE_AMOUNT_SEARCH_BACKEND = os.environ.get('RECIPE_AMOUNT_SEARCH_BACKEND') or 'sql'
+    AUTOCOMPLETE_LIMIT = int(os.environ.get('AUTOCOMPLETE_LIMIT') or 10)
+    # LRU + TTL cache in front of the ingredient searches, a size of 0 disables it
+    SEARCH_CACHE_SIZE = int(os.environ.get('SEARCH_CACHE_SIZE') or 1024)
+    SEARCH_CACHE_TTL = int(os.environ.get('SEARCH_CACHE_TTL') or 300)
+    # seconds a process keeps using the shared catalog version before reading it again, i.e. how
+    # long a write by another process can go unseen by this one's caches and indexes
+    CATALOG_VERSION_CHECK_INTERVAL = float(os.environ.get('CATALOG_VERSION_CHECK_INTERVAL') or 1)
+    RECIPES_PER_PAGE = int(os.environ.get('RECIPES_PER_PAGE') or 50)
+    COUNT_CACHE_TTL = int(os.environ.get('COUNT_CACHE_TTL') or 60)
+    # /search_hybrid waits up to HYBRID_SEARCH_DEADLINE seconds for spoonacular when the local
+    # search finds fewer than HYBRID_SEARCH_MIN_RESULTS recipes
+    HYBRID_SEARCH_MIN_RESULTS = int(os.environ.get('HYBRID_SEARCH_MIN_RESULTS') or 5)
+    HYBRID_SEARCH_DEADLINE = float(os.environ.get('HYBRID_SEARCH_DEADLINE') or 0.3)
+    HYBRID_SEARCH_REMOTE_RESULTS = int(os.environ.get('HYBRID_SEARCH_REMOTE_RESULTS') or 10)
+    HYBRID_SEARCH_WORKERS = int(os.environ.get('HYBRID_SEARCH_WORKERS') or 4)
+    # lookups queued or running at once, a search past that doesn't look remotely ('busy'),
+    # and remote result lists waiting to be ingested, past that they're dropped
+    HYBRID_SEARCH_MAX_PENDING = int(os.environ.get('HYBRID_SEARCH_MAX_PENDING') or 16)
+    HYBRID_INGESTION_QUEUE_SIZE = int(os.environ.get('HYBRID_INGESTION_QUEUE_SIZE') or 100)
+    REMOTE_SEARCH_CACHE_TTL = int(os.environ.get('REMOTE_SEARCH_CACHE_TTL') or 3600)
+    # manage.py sync_catalog: targets are tag:<meal type> or query:<keyword>, each run sends
+    # at most SYNC_REQUEST_BUDGET api requests and holds the sync lock for SYNC_LOCK_LEASE seconds at a time
+    SYNC_TARGETS = (os.environ.get('SYNC_TARGETS') or 'tag:breakfast,tag:lunch,tag:dinner').split(',')
+    SYNC_REQUEST_BUDGET = int(os.environ.get('SYNC_REQUEST_BUDGET') or 50)
+    SYNC_PAGE_SIZE = int(os.environ.get('SYNC_PAGE_SIZE') or 100)
+    SYNC_LOCK_LEASE = int(os.environ.get('SYNC_LOCK_LEASE') or 900)
+    # top recipes are ranked by (weight * mean + sum of ratings) / (weight + number of ratings),
+    # the weight has to be above 0 for unrated recipes to get a score
+    RATING_PRIOR_MEAN = float(os.environ.get('RATING_PRIOR_MEAN') or 3.0)
+    RATING_PRIOR_WEIGHT = float(os.environ.get('RATING_PRIOR_WEIGHT') or 5)
+    # rendered recipe bodies, keyed by recipe, catalog version and unit preferences
+    FRAGMENT_CACHE_BACKEND = os.environ.get('FRAGMENT_CACHE_BACKEND') or 'app.cache.LRUCache'
+    FRAGMENT_CACHE_SIZE = int(os.environ.get('FRAGMENT_CACHE_SIZE') or 2048)
+    FRAGMENT_CACHE_TTL = int(os.environ.get('FRAGMENT_CACHE_TTL') or 3600)
 
     @staticmethod
     def init_app(app):
@@ -25,10 +25,83 @@ def test():
     tests = unittest.TestLoader().discover('tests')
     unittest.TextTestRunner(verbosity=2).run(tests)
 
-@manager.command
-def fill_db():
+@manager.option('-c', '--cache-mode', dest='cache_mode', default=None,
+                help='off, cache (reuse stored api responses) or replay (only stored responses)')
+def fill_db(cache_mode):
     #populate_with_dummy_data()
-    populate_with_data()
+    from app.importer import format_import_stats
+    print(format_import_stats(populate_with_data(cache_mode)))
+
+@manager.option('-t', '--target', dest='targets', action='append',
+                help='tag:<meal type> or query:<keyword>, repeatable, defaults to SYNC_TARGETS')
+@manager.option('-b', '--budget', dest='budget', default=None, type=int, help='api requests to spend')
+def sync_catalog(targets, budget):
+    """Fetch new recipes from spoonacular, carrying on from the last run."""
+    from app.sync import sync_catalog as run_sync
+    stats = run_sync(targets, budget)
+    if stats is None:
+        print("another sync is running")
+    else:
+        print("{requests} requests, {pages} pages, {seen} already known, {fetched} fetched, {recipes} stored".format(**stats))
+        if stats['lock_lost']:
+            print("stopped early, another sync took over the lock")
+            return 1
+
+@manager.command
+def recompute_ratings():
+    """Rebuild the rating aggregates of recipes and users from their reviews."""
+    from app.models import recompute_ratings as run_recompute
+    run_recompute()
+
+@manager.command
+def rank_recipes():
+    """Recompute every recipe's leaderboard score from its rating aggregates."""
+    from app.models import rank_recipes as run_rank
+    run_rank()
+
+@manager.option('-f', '--format', dest='export_format', default='ndjson', help='ndjson or csv')
+@manager.option('-o', '--output', dest='output', default='-', help='file to write, - for stdout')
+@manager.option('-b', '--batch-size', dest='batch_size', default=1000, type=int)
+def export_recipes(export_format, output, batch_size):
+    """Stream every recipe with its ingredients as NDJSON or CSV."""
+    import sys
+    from app.export import EXPORT_FORMATS
+    if export_format not in EXPORT_FORMATS:
+        return unknown_format(export_format, EXPORT_FORMATS)
+    generate, _ = EXPORT_FORMATS[export_format]
+    out = sys.stdout if output == '-' else open(output, 'w', newline='')
+    try:
+        for line in generate(batch_size):
+            out.write(line)
+    finally:
+        if out is not sys.stdout:
+            out.close()
+
+@manager.option('-f', '--format', dest='import_format', default='ndjson', help='ndjson or csv')
+@manager.option('-i', '--input', dest='input', default='-', help='file to read, - for stdin')
+@manager.option('-b', '--batch-size', dest='batch_size', default=1000, type=int)
+def import_recipes(import_format, input, batch_size):
+    """Bulk load recipes from NDJSON or CSV in the export format."""
+    import sys
+    from app.importer import IMPORT_FORMATS, import_recipes as run_import, format_import_stats
+    if import_format not in IMPORT_FORMATS:
+        return unknown_format(import_format, IMPORT_FORMATS)
+
+    def progress(stats):
+        print(format_import_stats(stats), file=sys.stderr)
+
+    source = sys.stdin if input == '-' else open(input, newline='')
+    try:
+        run_import(IMPORT_FORMATS[import_format](source), batch_size, progress)
+    finally:
+        if source is not sys.stdin:
+            source.close()
+
+def unknown_format(name, formats):
+    # prints the formats there are and returns the exit status for the command
+    import sys
+    print("unknown format {!r}, use one of: {}".format(name, ", ".join(sorted(formats))), file=sys.stderr)
+    return 2
 
 if __name__ == '__main__':
     manager.run()
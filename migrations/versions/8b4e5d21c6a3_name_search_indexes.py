@@ -0,0 +1,61 @@
+"""name search indexes
+
+Revision ID: 8b4e5d21c6a3
+Revises: 3f1c2a7d9b10
+Create Date: 2026-10-18 11:03:17.552190
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '8b4e5d21c6a3'
+down_revision = '3f1c2a7d9b10'
+branch_labels = None
+depends_on = None
+
+# sqlite gets an external content FTS5 trigram table per searched table, kept in sync by
+# triggers, postgres gets a pg_trgm GIN index on the name column. Other databases keep using LIKE.
+tables = ['recipes', 'ingredients']
+
+
+def sqlite_ddl(t):
+    fts = t + '_fts'
+    return [
+        "CREATE VIRTUAL TABLE IF NOT EXISTS {fts} USING fts5(name, content='{t}', content_rowid='id', tokenize='trigram')",
+        "CREATE TRIGGER IF NOT EXISTS {fts}_ai AFTER INSERT ON {t} BEGIN "
+        "INSERT INTO {fts}(rowid, name) VALUES (new.id, new.name); END",
+        "CREATE TRIGGER IF NOT EXISTS {fts}_ad AFTER DELETE ON {t} BEGIN "
+        "INSERT INTO {fts}({fts}, rowid, name) VALUES ('delete', old.id, old.name); END",
+        "CREATE TRIGGER IF NOT EXISTS {fts}_au AFTER UPDATE OF name ON {t} BEGIN "
+        "INSERT INTO {fts}({fts}, rowid, name) VALUES ('delete', old.id, old.name); "
+        "INSERT INTO {fts}(rowid, name) VALUES (new.id, new.name); END",
+        "INSERT INTO {fts}({fts}) VALUES ('rebuild')",
+    ], fts
+
+
+def upgrade():
+    dialect = op.get_bind().dialect.name
+    if dialect == 'sqlite':
+        for t in tables:
+            statements, fts = sqlite_ddl(t)
+            for statement in statements:
+                op.execute(statement.format(fts=fts, t=t))
+    elif dialect == 'postgresql':
+        op.execute("CREATE EXTENSION IF NOT EXISTS pg_trgm")
+        for t in tables:
+            op.execute("CREATE INDEX IF NOT EXISTS ix_{t}_name_trgm ON {t} USING gin (name gin_trgm_ops)".format(t=t))
+
+
+def downgrade():
+    dialect = op.get_bind().dialect.name
+    if dialect == 'sqlite':
+        for t in tables:
+            fts = t + '_fts'
+            for suffix in ['_ai', '_ad', '_au']:
+                op.execute("DROP TRIGGER IF EXISTS {}{}".format(fts, suffix))
+            op.execute("DROP TABLE IF EXISTS {}".format(fts))
+    elif dialect == 'postgresql':
+        for t in tables:
+            op.execute("DROP INDEX IF EXISTS ix_{}_name_trgm".format(t))
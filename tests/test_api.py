@@ -0,0 +1,91 @@
+import csv
+import json
+import unittest
+from app import create_app, db
+from app.models import populate_with_dummy_data, encode_recipe_cursor
+
+
+class APITestCase(unittest.TestCase):
+    def setUp(self):
+        self.app = create_app('testing')
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        db.create_all()
+        populate_with_dummy_data()
+        self.client = self.app.test_client()
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+
+    def test_get_recipe(self):
+        response = self.client.get('/api/v1/recipes/1')
+        self.assertEqual(response.status_code, 200)
+        recipe = response.get_json()
+        self.assertEqual(recipe['name'], 'salt water')
+        self.assertEqual(recipe['steps'], ['1. add water', '2. add salt'])
+        self.assertEqual(recipe['ingredients'], [
+            {'id': 6, 'name': 'water', 'amount': 10, 'measure': 'volume'},
+            {'id': 7, 'name': 'salt', 'amount': 1, 'measure': 'mass'}])
+        self.assertEqual(self.client.get('/api/v1/recipes/42').status_code, 404)
+
+    def test_get_recipes_batch(self):
+        response = self.client.get('/api/v1/recipes?ids=3,1,42')
+        recipes = response.get_json()['recipes']
+        self.assertEqual([r['id'] for r in recipes], [1, 3])
+        self.assertEqual(len(recipes[1]['ingredients']), 1)
+        self.assertEqual(self.client.get('/api/v1/recipes?ids=1,x').status_code, 400)
+        self.assertEqual(self.client.get('/api/v1/recipes?ids=' + ','.join(str(i) for i in range(101))).status_code, 400)
+
+    def test_search(self):
+        response = self.client.get('/api/v1/search?name=alad&ingredients=1,2,3,4,5,6')
+        self.assertEqual(response.get_json()['recipes'], [{'id': 2, 'name': 'salad'}])
+        response = self.client.get('/api/v1/search?ingredients=6,7&amounts=10,0.5')
+        self.assertEqual(response.get_json()['recipes'], [{'id': 3, 'name': 'water'}])
+        response = self.client.get('/api/v1/search?ingredients=6,7&amounts=10,x')
+        self.assertEqual(response.status_code, 400)
+
+    def test_ingredients_etag(self):
+        response = self.client.get('/api/v1/ingredients')
+        ingredients = response.get_json()['ingredients']
+        self.assertEqual(len(ingredients), 7)
+        self.assertEqual(ingredients[0], {'id': 1, 'name': 'carrots', 'measure': 'units'})
+        etag = response.headers['ETag']
+        response = self.client.get('/api/v1/ingredients', headers={'If-None-Match': etag})
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response.data, b'')
+        from app.models import add_ingredient
+        add_ingredient("pepper", "mass")
+        response = self.client.get('/api/v1/ingredients', headers={'If-None-Match': etag})
+        self.assertEqual(response.status_code, 200)
+
+    def test_export_recipes(self):
+        response = self.client.get('/api/v1/export/recipes')
+        self.assertEqual(response.mimetype, 'application/x-ndjson')
+        recipes = [json.loads(line) for line in response.data.decode().splitlines()]
+        self.assertEqual([r['id'] for r in recipes], [1, 2, 3])
+        self.assertEqual([i['id'] for i in recipes[1]['ingredients']], [1, 2, 3, 4, 5])
+        response = self.client.get('/api/v1/export/recipes?format=csv')
+        lines = response.data.decode().splitlines()
+        self.assertEqual(lines[0], 'recipe_id,recipe_name,time,rating,description,steps,meal,spoonacular_id,ingredient_id,ingredient_name,amount,measure')
+        # salt water has two multi-line step fields, so count rows with the csv reader
+        rows = list(csv.reader(response.data.decode().splitlines(True)))
+        self.assertEqual(len(rows), 1 + 2 + 5 + 1)
+        self.assertEqual(self.client.get('/api/v1/export/recipes?format=xml').status_code, 400)
+
+    def test_top_recipes(self):
+        from app.models import User, add_review
+        user = User(username='Test')
+        db.session.add(user)
+        db.session.commit()
+        add_review(user.id, 2, 5, 'Great')
+        response = self.client.get('/api/v1/top?per_page=2')
+        top = response.get_json()
+        self.assertEqual([r['id'] for r in top['recipes']], [2, 3])
+        self.assertEqual(top['total'], 3)
+        top = self.client.get('/api/v1/top?per_page=2&after=' + top['next']).get_json()
+        self.assertEqual([r['id'] for r in top['recipes']], [1])
+        self.assertIsNone(top['next'])
+        self.assertEqual(self.client.get('/top_recipes?per_page=2').status_code, 200)
+        self.assertEqual(self.client.get('/api/v1/top?after=' + encode_recipe_cursor([1], 2)).status_code, 400)
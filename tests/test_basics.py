@@ -1,8 +1,21 @@
 import unittest
+from unittest import mock
+try:
+    import numpy
+except ImportError:  # numpy is optional, the tests of the numpy engines are skipped without it
+    numpy = None
 from flask import current_app
+from sqlalchemy import event
 from app import create_app, db
 from app.models import *
-from app.main.views import metric_to_spoons_volume, spoons_to_metric_volume, metric_to_imp_mass, imp_to_metric_mass, get_user_volume_preference_string, get_user_mass_preference_string
+from app.name_search import get_name_search_backend, name_filter
+from app.cache import LRUCache, get_search_cache_stats, get_catalog_version
+from app.export import export_recipes_ndjson, export_recipes_csv
+from app.importer import import_recipes, read_ndjson_recipes, read_csv_recipes, backfill_content_hashes
+from flask_login import login_user
+from app.main.unit_conversions import format_ingredient_amounts, volume_string, volume_strings, mass_strings, metric_to_spoons_volume_array, spoons_to_metric_volume_array, metric_to_imp_mass_array, imp_to_metric_mass_array
+from app.main.unit_conversions import metric_to_spoons_volume, spoons_to_metric_volume, metric_to_imp_mass, imp_to_metric_mass, get_user_volume_preference_string, get_user_mass_preference_string
+from app.main.views import get_recipe_fragment
 
 class BasicsTestCase(unittest.TestCase):
     def setUp(self):
@@ -110,6 +123,36 @@ class BasicsTestCase(unittest.TestCase):
 
         self.assertEqual(get_aggragate_recipe_rating(1), 4)
         self.assertEqual(get_aggragate_recipe_rating(2), 4)
+        self.assertEqual(get_aggragate_recipe_rating(3), 0)
+
+        # replacing a review swaps its rating in the aggregates instead of adding another one
+        add_review(newUser1.id, 1, 1, 'Changed my mind')
+        self.assertEqual(get_aggragate_recipe_rating(1), 3)
+        self.assertEqual(get_aggregate_user_rating(newUser1.id), 3)
+        self.assertEqual(db.session.query(Recipe.rating_count).filter_by(id=1).scalar(), 2)
+        # and replacing it again only swaps the latest rating
+        add_review(newUser1.id, 1, 2, 'Hmm')
+        add_review(newUser1.id, 1, 4, 'Fine after all')
+        self.assertEqual(get_aggragate_recipe_rating(1), 4.5)
+        self.assertEqual(get_aggregate_user_rating(newUser1.id), 4.5)
+        self.assertEqual(db.session.query(Recipe.rating_count).filter_by(id=1).scalar(), 2)
+        self.assertEqual(db.session.query(User.rating_count).filter_by(id=newUser1.id).scalar(), 2)
+
+        # unknown recipes and users are refused before anything is written
+        self.assertRaises(ValueError, add_review, newUser1.id, 42, 3, 'Nope')
+        self.assertRaises(ValueError, add_review, 42, 1, 3, 'Nope')
+        self.assertRaises(ValueError, save_recipe, newUser1.id, 42)
+        self.assertRaises(ValueError, set_saved_recipes, 42, [1])
+        db.session.rollback()
+        self.assertEqual(db.session.query(RU_Association).filter(or_(RU_Association.r_id == 42, RU_Association.u_id == 42)).count(), 0)
+
+        db.session.query(Recipe).update({Recipe.rating_sum: 0, Recipe.rating_count: 0})
+        db.session.query(User).update({User.rating_sum: 0, User.rating_count: 0})
+        db.session.commit()
+        recompute_ratings()
+        self.assertEqual(get_aggragate_recipe_rating(1), 4.5)
+        self.assertEqual(get_aggragate_recipe_rating(2), 4)
+        self.assertEqual(get_aggregate_user_rating(newUser2.id), 4)
 
     def test_recipes(self):
         # goal is to test adding and retrieving a recipe in detail
@@ -164,7 +207,7 @@ class BasicsTestCase(unittest.TestCase):
         self.assertEqual(cups, 1)
         self.assertEqual(quarterCups, 0)
         self.assertEqual(tbsps, 1)
-        self.assertEqual(tsps, 2)
+        self.assertEqual(tsps, 2.25)
         self.assertAlmostEqual(volume, test_volume, delta=5)
 
     def test_unit_conversion_strings(self):
@@ -175,12 +218,623 @@ class BasicsTestCase(unittest.TestCase):
         newUser2 = User(username='Test2', prefers_metric_volume=False, prefers_metric_mass=False)
         db.session.add(newUser2)
         db.session.commit()
-        testString1 = "333.00 ml | "
-        testString2 = "600.00 g | "
-        testString3 = "1 cup | 1 quarter cup | 1 tablespoon | 1 teaspoon | "
-        testString4 = "1 lb | 5.16 ozs | "
+        testString1 = "333.00 ml"
+        testString2 = "600.00 g"
+        testString3 = "1 cup, 1 quarter cup, 1 tablespoon, 1.25 teaspoons"
+        testString4 = "1 lb and 5.16 ozs"
         self.assertEqual(testString1, get_user_volume_preference_string(newUser1.id, volume))
         self.assertEqual(testString2, get_user_mass_preference_string(newUser1.id, mass))
         self.assertEqual(testString3, get_user_volume_preference_string(newUser2.id, volume))
         self.assertEqual(testString4, get_user_mass_preference_string(newUser2.id, mass))
 
+
+    def test_search_recipe_index(self):
+        populate_with_dummy_data()
+        current_app.config['RECIPE_SEARCH_BACKEND'] = 'index'
+        recipes = search_recipe_by_ingredient(recipe_name="alad", ingred_ids=[1,2,3,4,5,6])
+        self.assertEqual(recipes, [2])
+        recipes = search_recipe_by_ingredient(recipe_name="alad", ingred_ids=[1,2,3,4,6])
+        self.assertEqual(len(recipes), 0)
+        recipes = search_recipe_by_ingredient(recipe_name="", ingred_ids=[1,2,3,4,5,6])
+        self.assertEqual(sorted(recipes), [2, 3])
+        recipes = search_recipe_by_ingredient(recipe_name="", ingred_ids=[6,7])
+        self.assertEqual(sorted(recipes), [1, 3])
+
+    def test_search_recipe_index_incremental(self):
+        populate_with_dummy_data()
+        current_app.config['RECIPE_SEARCH_BACKEND'] = 'index'
+        self.assertEqual(sorted(search_recipe_by_ingredient(ingred_ids=[6,7])), [1, 3])
+        index = get_recipe_index()
+        bits, planes = index.ingredient_bits, index.count_planes
+        snapshot = (dict(bits), list(planes))
+        i_id = add_ingredient("pepper", "mass")
+        r_id = add_recipe("peppered water", 2, "1. add water\n2. add pepper", [(6,0,10,0),(i_id,0,1,0)])
+        # the writes swapped in new structures, a search already holding the old ones isn't affected
+        self.assertEqual((bits, planes), snapshot)
+        self.assertEqual(sorted(search_recipe_by_ingredient(ingred_ids=[6,7])), [1, 3])
+        self.assertEqual(sorted(search_recipe_by_ingredient(ingred_ids=[6,7,i_id])), [1, 3, r_id])
+        # both writes were applied in place, so the index is still current without a rebuild
+        with mock.patch.object(get_recipe_index(), 'build') as build:
+            search_recipe_by_ingredient(ingred_ids=[6])
+            self.assertFalse(build.called)
+        current_app.config['RECIPE_SEARCH_BACKEND'] = 'sql'
+        self.assertEqual(sorted(search_recipe_by_ingredient(ingred_ids=[6,7,i_id])), [1, 3, r_id])
+
+    def test_search_recipe_index_shared(self):
+        populate_with_dummy_data()
+        current_app.config['RECIPE_SEARCH_BACKEND'] = 'index'
+        current_app.config['CATALOG_VERSION_CHECK_INTERVAL'] = 0
+        self.assertEqual(sorted(search_recipe_by_ingredient(ingred_ids=[6,7])), [1, 3])
+        self.assertEqual(autocomplete_ingredients("pep"), [])
+        # another process adds an ingredient and a recipe, the indexes are rebuilt on their next use
+        with db.engine.begin() as connection:
+            connection.execute("INSERT INTO ingredients (id, name, measure) VALUES (8, 'pepper', 'mass')")
+            connection.execute("INSERT INTO recipes (id, name, rating_sum, rating_count, rating_score) VALUES (4, 'aqua', 0, 0, 3)")
+            connection.execute('INSERT INTO "RI" (r_id, i_id, amount) VALUES (4, 6, 5)')
+            connection.execute("UPDATE catalog_version SET version = version + 1 WHERE id = 1")
+        self.assertEqual(sorted(search_recipe_by_ingredient(ingred_ids=[6,7])), [1, 3, 4])
+        self.assertEqual(autocomplete_ingredients("pep"), [(8, "pepper")])
+        # a local write after the other process's one can't be applied in place to the old index
+        index = get_recipe_index()
+        with db.engine.begin() as connection:
+            connection.execute("UPDATE catalog_version SET version = version + 1 WHERE id = 1")
+        r_id = add_recipe("pepper water", 2, "1. add water\n2. add pepper", [(6,0,10,0),(8,0,1,0)])
+        self.assertNotEqual(index.version, get_catalog_version())
+        self.assertEqual(sorted(search_recipe_by_ingredient(ingred_ids=[6,8])), [3, 4, r_id])
+        self.assertEqual(index.version, get_catalog_version())
+
+    def test_search_recipe_amounts_single_ingredient(self):
+        populate_with_dummy_data()
+        recipes = search_recipe_by_ingredient_amounts(recipe_name="", ingred_ids=[6], amounts=[10])
+        self.assertEqual(recipes, [3])
+        recipes = search_recipe_by_ingredient_amounts(recipe_name="", ingred_ids=[6], amounts=[9])
+        self.assertEqual(len(recipes), 0)
+        recipes = search_recipe_by_ingredient_amounts(recipe_name="", ingred_ids=[], amounts=[])
+        self.assertEqual(len(recipes), 0)
+        recipes = search_recipe_by_ingredient_amounts(recipe_name="", ingred_ids=[7,6,6], amounts=[1,10,0])
+        self.assertEqual(recipes, [1, 3])
+
+    def test_search_recipe_near_miss(self):
+        populate_with_dummy_data()
+        # pantry has water but no salt: "water" is complete, "salt water" misses salt
+        hits = search_recipe_near_miss(recipe_name="", ingred_ids=[6], max_missing=1)
+        self.assertEqual([r.id for r in hits], [3, 1])
+        self.assertEqual(hits[0].missing, [])
+        self.assertEqual(hits[1].missing, [(7, "salt")])
+        hits = search_recipe_near_miss(recipe_name="", ingred_ids=[6], max_missing=0)
+        self.assertEqual([r.id for r in hits], [3])
+        # salad uses 4 of the pantry ingredients, so it ranks above the recipes using only water
+        hits = search_recipe_near_miss(recipe_name="", ingred_ids=[1,2,3,4,6], max_missing=1)
+        self.assertEqual([r.id for r in hits], [2, 3, 1])
+        self.assertEqual(hits[0].missing, [(5, "ranch dressing")])
+        hits = search_recipe_near_miss(recipe_name="", ingred_ids=[1,2,3,4,6], max_missing=1, page=2, per_page=2)
+        self.assertEqual([r.id for r in hits], [1])
+
+    def test_search_near_miss_view(self):
+        populate_with_dummy_data()
+        client = self.app.test_client()
+        response = client.get('/search_near_miss?ingredients=6&max_missing=1')
+        results = response.get_json()['matching_results']
+        self.assertEqual([r['id'] for r in results], [3, 1])
+        self.assertEqual(results[1]['missing'], [{"id": 7, "name": "salt"}])
+        # per_page is clamped to 1..100, a negative one would mean no limit at all on sqlite
+        response = client.get('/search_near_miss?ingredients=6&max_missing=1&per_page=-1')
+        self.assertEqual([r['id'] for r in response.get_json()['matching_results']], [3])
+
+    def test_name_search_backends(self):
+        populate_with_dummy_data()
+        for backend in ['auto', 'like']:
+            current_app.config['NAME_SEARCH_BACKEND'] = backend
+            reset_name_search_backend()
+            self.assertEqual([g.name for g in search_ingredients("arro")], ["carrots"])
+            self.assertEqual(search_recipe_by_ingredient(recipe_name="alad", ingred_ids=[1,2,3,4,5,6]), [2])
+        # the fts index follows inserts and renames
+        current_app.config['NAME_SEARCH_BACKEND'] = 'auto'
+        reset_name_search_backend()
+        add_ingredient("baby carrots", "units")
+        self.assertEqual([g.name for g in search_ingredients("arro")], ["baby carrots", "carrots"])
+        ingredient = get_ingredient_by_name("carrots")
+        ingredient.name = "parsnips"
+        db.session.commit()
+        self.assertEqual([g.name for g in search_ingredients("arro")], ["baby carrots"])
+
+    def test_name_search_fallback(self):
+        # without a trigram capable sqlite, or when the DDL fails, tables are still created and use LIKE
+        db.drop_all()
+        with mock.patch.object(db.engine.dialect.dbapi, 'sqlite_version_info', (3, 31, 1)):
+            db.create_all()
+        reset_name_search_backend()
+        populate_with_dummy_data()
+        self.assertEqual(get_name_search_backend(), 'like')
+        self.assertEqual([g.name for g in search_ingredients("arro")], ["carrots"])
+
+        db.drop_all()
+        with mock.patch('app.name_search.sqlite_name_search_ddl', return_value=['CREATE VIRTUAL TABLE x USING nosuchmodule(name)']):
+            db.create_all()
+        reset_name_search_backend()
+        populate_with_dummy_data()
+        self.assertEqual(get_name_search_backend(), 'like')
+        self.assertEqual([g.name for g in search_ingredients("arro")], ["carrots"])
+
+    def test_name_search_short_phrase(self):
+        populate_with_dummy_data()
+        self.assertEqual(get_name_search_backend(), 'fts5')
+        # trigrams can't serve 2 characters, so those go to LIKE on the base table
+        self.assertIn('ingredients_fts', str(name_filter(Ingredient, "arr")))
+        self.assertNotIn('ingredients_fts', str(name_filter(Ingredient, "ar")))
+        self.assertEqual([g.name for g in search_ingredients("ar")], ["carrots"])
+
+    def test_autocomplete_ingredients(self):
+        populate_with_dummy_data()
+        self.assertEqual(autocomplete_ingredients("CAR"), [(1, "carrots")])
+        self.assertEqual(autocomplete_ingredients("dres"), [(5, "ranch dressing")])
+        # salt is used by a recipe and the new sauce isn't, so salt ranks first
+        add_ingredient("sauce", "volume")
+        self.assertEqual([name for _, name in autocomplete_ingredients("s")], ["salt", "sauce"])
+        self.assertEqual([name for _, name in autocomplete_ingredients("")], [])
+        add_ingredient("sweet water", "volume")
+        self.assertEqual([name for _, name in autocomplete_ingredients("wa")], ["water", "sweet water"])
+        self.assertEqual(len(autocomplete_ingredients("s", limit=1)), 1)
+        client = self.app.test_client()
+        response = client.get('/autocomplete?term=carr')
+        self.assertEqual(response.get_json()['matching_results'], [{"value": "carrots", "id": 1}])
+
+    @unittest.skipUnless(numpy, 'the pantry matrix engine needs numpy')
+    def test_search_recipe_amounts_matrix(self):
+        populate_with_dummy_data()
+        current_app.config['RECIPE_AMOUNT_SEARCH_BACKEND'] = 'matrix'
+        recipes = search_recipe_by_ingredient_amounts(recipe_name="alad",
+                    ingred_ids=[1,3,4,2,5,6], amounts=[5,5,5,5,5,5])
+        self.assertEqual(recipes, [2])
+        recipes = search_recipe_by_ingredient_amounts(recipe_name="alad",
+                    ingred_ids=[1,2,3,4,5,6], amounts=[5,5,5,4,5,5])
+        self.assertEqual(len(recipes), 0)
+        pantries = [([6,7], [10,1]), ([6], [10]), ([6], [9]), ([], [])]
+        self.assertEqual(search_recipes_for_pantries(pantries), [[1, 3], [3], [], []])
+        # the matrix is rebuilt after a recipe is added
+        r_id = add_recipe("more water", 1, "1. water", [(6,0,8,0)])
+        self.assertEqual(search_recipe_by_ingredient_amounts(ingred_ids=[6], amounts=[9]), [r_id])
+        # both backends list recipes by name, not by id
+        a_id = add_recipe("aqua", 1, "1. water", [(6,0,10,0)])
+        self.assertEqual(search_recipe_by_ingredient_amounts(ingred_ids=[6,7], amounts=[10,1]), [a_id, r_id, 1, 3])
+        current_app.config['RECIPE_AMOUNT_SEARCH_BACKEND'] = 'sql'
+        self.assertEqual(search_recipe_by_ingredient_amounts(ingred_ids=[6,7], amounts=[10,1]), [a_id, r_id, 1, 3])
+
+    def test_search_cache(self):
+        populate_with_dummy_data()
+        stats = get_search_cache_stats()
+        search_recipe_by_ingredient(recipe_name="", ingred_ids=[6,7])
+        search_recipe_by_ingredient(recipe_name="", ingred_ids=[7,6,6])
+        recipes = search_recipe_by_ingredient_amounts(recipe_name="", ingred_ids=[6], amounts=[10])
+        recipes.append(42)
+        self.assertEqual(search_recipe_by_ingredient_amounts(recipe_name="", ingred_ids=[6,6], amounts=[10,1]), [3])
+        self.assertEqual(get_search_cache_stats()['hits'], stats['hits'] + 2)
+        self.assertEqual(get_search_cache_stats()['misses'], stats['misses'] + 2)
+        # adding a recipe bumps the catalog version, so the next search is a miss with fresh results
+        r_id = add_recipe("more water", 1, "1. water", [(6,0,8,0)])
+        self.assertEqual(sorted(search_recipe_by_ingredient_amounts(recipe_name="", ingred_ids=[6], amounts=[10])), [3, r_id])
+        self.assertEqual(get_search_cache_stats()['misses'], stats['misses'] + 3)
+
+    def test_catalog_version_shared(self):
+        populate_with_dummy_data()
+        self.assertEqual(search_recipe_by_ingredient_amounts(ingred_ids=[6], amounts=[10]), [3])
+        version = get_catalog_version()
+        self.assertEqual(db.session.query(CatalogVersion.version).scalar(), version)
+        # another process adds a recipe on its own connection, bumping the version in its transaction
+        with db.engine.begin() as connection:
+            connection.execute("INSERT INTO recipes (id, name, rating_sum, rating_count, rating_score) VALUES (4, 'aqua', 0, 0, 3)")
+            connection.execute('INSERT INTO "RI" (r_id, i_id, amount) VALUES (4, 6, 5)')
+            connection.execute("UPDATE catalog_version SET version = version + 1 WHERE id = 1")
+        # seen once this process checks the version again, the cached result is keyed by the old one
+        self.assertEqual(search_recipe_by_ingredient_amounts(ingred_ids=[6], amounts=[10]), [3])
+        current_app.config['CATALOG_VERSION_CHECK_INTERVAL'] = 0
+        self.assertEqual(get_catalog_version(), version + 1)
+        self.assertEqual(search_recipe_by_ingredient_amounts(ingred_ids=[6], amounts=[10]), [4, 3])
+        # a rolled back write leaves the version alone
+        add_ingredient("pepper", "mass")
+        self.assertEqual(get_catalog_version(), version + 2)
+        db.session.add(Ingredient(name="paprika", measure="mass"))
+        db.session.flush()
+        db.session.rollback()
+        self.assertEqual(get_catalog_version(), version + 2)
+
+    def test_search_cache_stats_login(self):
+        client = self.app.test_client()
+        self.assertEqual(client.get('/search_cache_stats').status_code, 302)
+
+    def test_lru_cache(self):
+        cache = LRUCache(maxsize=2, ttl=None)
+        cache.set('a', 1)
+        cache.set('b', 2)
+        self.assertEqual(cache.get('a'), 1)
+        cache.set('c', 3)
+        self.assertTrue(cache.get('b') is None)
+        self.assertEqual(cache.get('a'), 1)
+        self.assertEqual(cache.stats()['evictions'], 1)
+        cache = LRUCache(maxsize=2, ttl=0)
+        cache.set('a', 1)
+        self.assertTrue(cache.get('a') is None)
+
+    def test_recipes_keyset_pagination(self):
+        populate_with_dummy_data()
+        add_recipe("salad", 5, "1. more salad", [(1,0,1,0)])
+        # ordered by name then id: salad (2), salad (4), salt water (1), water (3)
+        page = get_recipes_page(per_page=2)
+        self.assertEqual([r.id for r in page.items], [2, 4])
+        self.assertEqual(page.total, 4)
+        self.assertTrue(page.prev_cursor is None)
+        page = get_recipes_page(after=page.next_cursor, per_page=2)
+        self.assertEqual([r.id for r in page.items], [1, 3])
+        self.assertTrue(page.next_cursor is None)
+        page = get_recipes_page(before=page.prev_cursor, per_page=2)
+        self.assertEqual([r.id for r in page.items], [2, 4])
+        self.assertTrue(page.prev_cursor is None)
+        # cursors that weren't handed out are refused instead of reaching the query
+        for cursor in ["not a cursor", encode_recipe_cursor(["salad"], 2), encode_recipe_cursor({"a": 1}, 2),
+                       encode_recipe_cursor("salad", "2"), encode_recipe_cursor("salad", True)]:
+            self.assertRaises(InvalidCursor, get_recipes_page, after=cursor)
+        self.assertRaises(InvalidCursor, get_top_recipes_page, after=encode_recipe_cursor("salad", 2))
+        self.assertRaises(InvalidCursor, get_top_recipes_page, after=encode_recipe_cursor(float('nan'), 2))
+        # recipes without a name come first and are paged through like the others
+        db.session.add_all([Recipe(id=5, name=None), Recipe(id=6, name=None)])
+        db.session.commit()
+        page = get_recipes_page(per_page=1)
+        self.assertEqual([r.id for r in page.items], [5])
+        page = get_recipes_page(after=page.next_cursor, per_page=2)
+        self.assertEqual([r.id for r in page.items], [6, 2])
+        page = get_recipes_page(after=page.next_cursor, per_page=3)
+        self.assertEqual([r.id for r in page.items], [4, 1, 3])
+        page = get_recipes_page(before=page.prev_cursor, per_page=2)
+        self.assertEqual([r.id for r in page.items], [6, 2])
+        page = get_recipes_page(before=page.prev_cursor, per_page=2)
+        self.assertEqual([r.id for r in page.items], [5])
+        self.assertTrue(page.prev_cursor is None)
+        client = self.app.test_client()
+        self.assertEqual(client.get('/view_recipes?after=' + encode_recipe_cursor(["salad"], 2)).status_code, 400)
+        self.assertEqual(client.get('/top_recipes?before=x').status_code, 400)
+
+    def test_saved_recipes_pagination(self):
+        populate_with_dummy_data()
+        newUser = User(username='Test')
+        db.session.add(newUser)
+        db.session.commit()
+        save_recipe(newUser.id, 3)
+        save_recipe(newUser.id, 1)
+        page = get_user_saved_recipes_page(newUser.id, per_page=1)
+        self.assertEqual([r.id for r in page.items], [1])
+        self.assertEqual(page.total, 2)
+        page = get_user_saved_recipes_page(newUser.id, after=page.next_cursor, per_page=1)
+        self.assertEqual([r.id for r in page.items], [3])
+        save_recipe(newUser.id, 1)
+        self.assertEqual(get_user_saved_recipes_page(newUser.id).total, 1)
+        self.assertRaises(InvalidCursor, get_user_saved_recipes_page, newUser.id, after="one")
+
+    def test_saved_count(self):
+        populate_with_dummy_data()
+        newUser = User(username='Test')
+        db.session.add(newUser)
+        db.session.commit()
+        add_review(newUser.id, 2, 4, 'Review')
+        save_recipe(newUser.id, 1)
+        save_recipe(newUser.id, 2)
+        save_recipe(newUser.id, 3)
+        self.assertEqual(get_user_saved_count(newUser.id), 3)
+        save_recipe(newUser.id, 2)
+        self.assertEqual(get_user_saved_count(newUser.id), 2)
+        page = get_user_saved_recipes_page(newUser.id, per_page=1)
+        self.assertEqual([(r.id, r.name) for r in page.items], [(1, "salt water")])
+        page = get_user_saved_recipes_page(newUser.id, after=page.next_cursor, per_page=1)
+        self.assertEqual([(r.id, r.name) for r in page.items], [(3, "water")])
+        self.assertTrue(page.next_cursor is None)
+        page = get_user_saved_recipes_page(newUser.id, before=page.prev_cursor, per_page=1)
+        self.assertEqual([r.id for r in page.items], [1])
+
+        # toggling is one upsert, and doesn't touch the review on the same row
+        save_recipe(newUser.id, 2)
+        self.assertTrue(is_saved_recipe(newUser.id, 2))
+        self.assertEqual(get_user_saved_count(newUser.id), 3)
+        self.assertEqual(get_aggragate_recipe_rating(2), 4)
+        add_review(newUser.id, 3, 2, 'Meh')
+        self.assertTrue(is_saved_recipe(newUser.id, 3))
+        self.assertEqual(get_user_saved_count(newUser.id), 3)
+
+        # the existence checks are part of the writes, no separate lookups
+        user_id = newUser.id
+        statements = []
+        def count_query(conn, cursor, statement, parameters, context, executemany):
+            statements.append(statement)
+        event.listen(db.engine, 'before_cursor_execute', count_query)
+        try:
+            save_recipe(user_id, 1)
+            self.assertEqual(len(statements), 2)
+            del statements[:]
+            add_review(user_id, 1, 5, 'Good')
+            self.assertEqual(len(statements), 4)
+        finally:
+            event.remove(db.engine, 'before_cursor_execute', count_query)
+        self.assertEqual(get_user_saved_count(newUser.id), 2)
+        self.assertEqual(get_aggragate_recipe_rating(1), 5)
+
+    def test_get_recipe_ingredients(self):
+        populate_with_dummy_data()
+        recipe = get_recipe(1)
+        self.assertEqual([(i.id, i.name, i.amount, i.measure) for i in recipe.ingredients],
+                         [(6, "water", 10, "volume"), (7, "salt", 1, "mass")])
+        self.assertEqual(recipe.amounts, [10, 1])
+        self.assertEqual(recipe.steps, ["1. add water", "2. add salt"])
+        self.assertTrue(get_recipe(42) is None)
+        r_id = add_recipe("nothing", 0, "1. wait", [])
+        self.assertEqual(get_recipe(r_id).ingredients, [])
+
+    def test_view_recipe_query_count(self):
+        populate_with_dummy_data()
+        client = self.app.test_client()
+        statements = []
+        def count_query(conn, cursor, statement, parameters, context, executemany):
+            statements.append(statement)
+        event.listen(db.engine, 'before_cursor_execute', count_query)
+        try:
+            response = client.get('/view_recipe/2')
+        finally:
+            event.remove(db.engine, 'before_cursor_execute', count_query)
+        self.assertEqual(response.status_code, 200)
+        self.assertIn(b'ranch dressing', response.data)
+        self.assertEqual(len(statements), 1)
+        self.assertEqual(client.get('/view_recipe/42').status_code, 404)
+
+    def test_recipe_fragment_cache(self):
+        populate_with_dummy_data()
+        client = self.app.test_client()
+        self.assertIn(b'10.00 ml water', client.get('/view_recipe/1').data)
+        statements = []
+        def count_query(conn, cursor, statement, parameters, context, executemany):
+            statements.append(statement)
+        event.listen(db.engine, 'before_cursor_execute', count_query)
+        try:
+            response = client.get('/view_recipe/1')
+        finally:
+            event.remove(db.engine, 'before_cursor_execute', count_query)
+        self.assertIn(b'10.00 ml water', response.data)
+        self.assertEqual(len(statements), 0)
+        # changing an ingredient invalidates the cached body
+        ingredient = get_ingredient_by_name("water")
+        ingredient.name = "sparkling water"
+        db.session.commit()
+        self.assertIn(b'10.00 ml sparkling water', client.get('/view_recipe/1').data)
+        # and so does a change made by another process, once the version is checked again
+        current_app.config['CATALOG_VERSION_CHECK_INTERVAL'] = 0
+        with db.engine.begin() as connection:
+            connection.execute("UPDATE ingredients SET name = 'still water' WHERE name = 'sparkling water'")
+            connection.execute("UPDATE catalog_version SET version = version + 1 WHERE id = 1")
+        self.assertIn(b'10.00 ml still water', client.get('/view_recipe/1').data)
+
+    def test_recipe_fragment_preferences(self):
+        populate_with_dummy_data()
+        newUser = User(username='Test', prefers_metric_volume=False, prefers_metric_mass=False)
+        db.session.add(newUser)
+        db.session.commit()
+        with self.app.test_request_context('/view_recipe/1'):
+            name, body = get_recipe_fragment(1)
+            self.assertEqual(name, "salt water")
+            self.assertIn("10.00 ml water", body)
+            login_user(newUser)
+            name, body = get_recipe_fragment(1)
+            self.assertIn("2.0 teaspoons water", body)
+            self.assertIn("0.04 ozs salt", body)
+
+    def test_unit_preferences_per_request(self):
+        populate_with_dummy_data()
+        self.app.config['WTF_CSRF_ENABLED'] = False
+        newUser = User(username='Test', email='test@example.com', password='cat', confirmed=True,
+                       prefers_metric_volume=False, prefers_metric_mass=True)
+        db.session.add(newUser)
+        add_recipe("brine", 5, "1. mix", [(6,0,250,0),(7,0,30,0),(5,0,15,0)])
+        client = self.app.test_client()
+        client.post('/auth/login', data={'email': 'test@example.com', 'password': 'cat'})
+        statements = []
+        def count_query(conn, cursor, statement, parameters, context, executemany):
+            statements.append(statement)
+        event.listen(db.engine, 'before_cursor_execute', count_query)
+        try:
+            response = client.get('/view_recipe/4')
+        finally:
+            event.remove(db.engine, 'before_cursor_execute', count_query)
+        self.assertIn(b'1 cup water', response.data)
+        self.assertIn(b'30.00 g salt', response.data)
+        # at most flask-login's own user load touches the users table
+        self.assertLessEqual(len([s for s in statements if 'FROM users' in s]), 1)
+
+    def test_format_ingredient_amounts(self):
+        populate_with_dummy_data()
+        recipe = get_recipe(1)
+        self.assertEqual(format_ingredient_amounts(recipe.ingredients, (True, True)), ["10.00 ml", "1.00 g"])
+        self.assertEqual(format_ingredient_amounts(recipe.ingredients, (False, False)), ["2.0 teaspoons", "0.04 ozs"])
+        self.assertEqual(format_ingredient_amounts(get_recipe(2).ingredients, (True, True))[0], "5.0")
+
+    @unittest.skipUnless(numpy, 'the array conversions need numpy')
+    def test_unit_conversion_arrays(self):
+        volumes = [0, 62.5, 125, 276, 333, 1000.5]
+        masses = [0, 28.35, 453.6, 600]
+        cups, quarterCups, tbsps, tsps = metric_to_spoons_volume_array(volumes)
+        for idx, volume in enumerate(volumes):
+            self.assertEqual((cups[idx], quarterCups[idx], tbsps[idx], tsps[idx]), metric_to_spoons_volume(volume))
+        self.assertAlmostEqual(spoons_to_metric_volume_array(cups, quarterCups, tbsps, tsps)[3], 276, delta=5)
+        pounds, oz = metric_to_imp_mass_array(masses)
+        self.assertEqual(list(pounds), [0, 0, 1, 1])
+        for idx, mass in enumerate(masses):
+            self.assertAlmostEqual(imp_to_metric_mass_array(pounds, oz)[idx], mass, places=3)
+        self.assertEqual(volume_strings(volumes, False), [volume_string(v, False) for v in volumes])
+        self.assertEqual(volume_strings([125, 333], False), ["1 half cup", "1 cup, 1 quarter cup, 1 tablespoon, 1.25 teaspoons"])
+        self.assertEqual(mass_strings(masses, False), ["", "1.00 oz", "1 lb", "1 lb and 5.16 ozs"])
+
+    def test_import_recipes(self):
+        populate_with_dummy_data()
+        ndjson = list(export_recipes_ndjson())
+        csv_lines = "".join(export_recipes_csv()).splitlines(True)
+        # add_recipe doesn't hash recipes, the backfill hashes them like the import does, so in
+        # either format they're known, and an import that changes nothing leaves the catalog version alone
+        self.assertEqual(db.session.query(Recipe.id).filter(Recipe.content_hash.isnot(None)).count(), 0)
+        with db.engine.begin() as connection:
+            self.assertEqual(backfill_content_hashes(connection), 3)
+        version = get_catalog_version()
+        stats = import_recipes(read_ndjson_recipes(ndjson), batch_size=2)
+        self.assertEqual((stats['recipes'], stats['unchanged']), (0, 3))
+        stats = import_recipes(read_csv_recipes(csv_lines))
+        self.assertEqual((stats['recipes'], stats['unchanged'], stats['ingredient_lines']), (0, 3, 0))
+        self.assertEqual(get_catalog_version(), version)
+
+        self.assertEqual(search_recipe_by_ingredient("", [6, 7]), [1, 3])
+        copies = [dict(recipe, name=recipe['name'] + " copy") for recipe in read_ndjson_recipes(ndjson)]
+        stats = import_recipes(copies, batch_size=2)
+        self.assertEqual((stats['recipes'], stats['ingredient_lines'], stats['new_ingredients']), (3, 8, 0))
+        self.assertGreater(get_catalog_version(), version)
+        self.assertEqual(search_recipe_by_ingredient("", [6, 7]), [1, 3, 4, 6])
+        imported = get_recipe(5)
+        self.assertEqual(imported.name, "salad copy")
+        self.assertEqual([(i.id, i.amount) for i in imported.ingredients], [(i.id, i.amount) for i in get_recipe(2).ingredients])
+
+        # recipes stored before there was a content hash get theirs from the backfill, one per content
+        hashes = dict(db.session.query(Recipe.id, Recipe.content_hash))
+        db.session.query(Recipe).update({Recipe.content_hash: None})
+        db.session.commit()
+        with db.engine.begin() as connection:
+            connection.execute("INSERT INTO recipes (id, name, time, rating, description, steps, rating_sum, rating_count) "
+                               "VALUES (100, 'water', 1, 4.5, '', '1. literally just water', 0, 0)")
+            connection.execute('INSERT INTO "RI" (r_id, i_id, amount) VALUES (100, 6, 10)')
+            self.assertEqual(backfill_content_hashes(connection), 6)
+        self.assertEqual(dict(db.session.query(Recipe.id, Recipe.content_hash).filter(Recipe.id != 100)), hashes)
+        self.assertIsNone(db.session.query(Recipe.content_hash).filter_by(id=100).scalar())
+        db.session.query(RI_Association).filter_by(r_id=100).delete()
+        db.session.query(Recipe).filter_by(id=100).delete()
+        db.session.commit()
+
+        import_recipes([{"name": "pepper water", "time": 2, "ingredients": [
+            {"name": "water", "amount": 5, "measure": "volume"},
+            {"name": "pepper", "amount": 1, "measure": "mass"},
+            {"name": "pepper", "amount": 2, "measure": "mass"}]}])
+        pepper = get_recipe(7)
+        self.assertEqual([(i.name, i.amount) for i in pepper.ingredients], [("water", 5), ("pepper", 1)])
+        self.assertEqual(autocomplete_ingredients("pep"), [(8, "pepper")])
+
+        # another writer adding a recipe and an ingredient between two batches doesn't collide with the import
+        def other_writer(stats):
+            if stats['recipes'] == 1:
+                with db.engine.begin() as connection:
+                    connection.execute("INSERT INTO recipes (name, rating_sum, rating_count, rating_score) VALUES ('tea', 0, 0, 3)")
+                    connection.execute("INSERT INTO ingredients (name, measure) VALUES ('tea leaves', 'mass')")
+        stats = import_recipes([{"name": "soup", "ingredients": [{"name": "water", "amount": 5}]},
+                                {"name": "iced tea", "ingredients": [{"name": "tea leaves", "amount": 1, "measure": "mass"}]}],
+                               batch_size=1, progress=other_writer)
+        self.assertEqual((stats['recipes'], stats['new_ingredients']), (2, 0))
+        names = dict(db.session.query(Recipe.name, Recipe.id).filter(Recipe.name.in_(["soup", "tea", "iced tea"])))
+        self.assertEqual(sorted(names.values()), [8, 9, 10])
+        self.assertEqual([i.name for i in get_recipe(names["iced tea"]).ingredients], ["tea leaves"])
+
+        # the form adds what it is given, even a recipe that's already stored
+        r_id = add_recipe("water", 1, "1. literally just water", [(6,0,10,0)])
+        self.assertNotEqual(r_id, 3)
+        self.assertIsNone(db.session.query(Recipe.content_hash).filter_by(id=r_id).scalar())
+
+    def test_top_recipes(self):
+        populate_with_dummy_data()
+        add_recipe("porridge", 10, "1. boil", [(6,0,2,0)], meal="breakfast")
+        add_recipe("brine", 5, "1. stir", [(6,0,2,0),(7,0,2,0)], meal="dinner")
+        users = [User(username='Test%d' % n) for n in range(3)]
+        db.session.add_all(users)
+        db.session.commit()
+        # one 5 star review doesn't beat three 4.5s with the default prior of five 3s
+        add_review(users[0].id, 3, 5, 'Great')
+        for user in users:
+            add_review(user.id, 4, 4.5, 'Good')
+        add_review(users[1].id, 5, 1, 'Bad')
+        page = get_top_recipes_page(per_page=2)
+        self.assertEqual([row.id for row in page.items], [4, 3])
+        self.assertAlmostEqual(page.items[0].rating_score, (15 + 13.5) / 8)
+        # a recipe inserted without a score starts at the prior mean, like one added through the model
+        with db.engine.begin() as connection:
+            connection.execute("INSERT INTO recipes (id, name) VALUES (9, 'plain')")
+        self.assertEqual(db.session.query(Recipe.rating_score).filter(Recipe.id.in_([1, 9])).all(), [(3.0,), (3.0,)])
+        db.session.query(Recipe).filter_by(id=9).delete()
+        db.session.commit()
+        self.assertEqual(page.total, 5)
+        page = get_top_recipes_page(after=page.next_cursor, per_page=2)
+        self.assertEqual([row.id for row in page.items], [2, 1])
+        page = get_top_recipes_page(after=page.next_cursor, per_page=2)
+        self.assertEqual([row.id for row in page.items], [5])
+        self.assertIsNone(page.next_cursor)
+        page = get_top_recipes_page(before=page.prev_cursor, per_page=2)
+        self.assertEqual([row.id for row in page.items], [2, 1])
+        self.assertEqual([row.id for row in get_top_recipes_page("dinner").items], [5])
+
+        # replacing a review moves the recipe, and rank_recipes picks up a new prior
+        add_review(users[1].id, 5, 5, 'Better now')
+        self.assertEqual(get_top_recipes_page("dinner").items[0].rating_score, (15 + 5) / 6)
+        current_app.config['RATING_PRIOR_WEIGHT'] = 1
+        rank_recipes()
+        self.assertEqual([row.id for row in get_top_recipes_page(per_page=2).items], [4, 5])
+
+    def test_batch_save_recipes(self):
+        populate_with_dummy_data()
+        self.app.config['WTF_CSRF_ENABLED'] = False
+        newUser = User(username='Test', email='test@example.com', password='cat', confirmed=True)
+        db.session.add(newUser)
+        db.session.commit()
+        save_recipe(newUser.id, 1)
+        self.assertEqual(set_saved_recipes(newUser.id, [2, 3, 42], [1]), 2)
+        self.assertEqual([r.id for r in get_user_saved_recipes(newUser.id)], [2, 3])
+        self.assertEqual(set_saved_recipes(newUser.id, [1, 2], [2]), 2)
+        self.assertEqual(sorted(r.id for r in get_user_saved_recipes(newUser.id)), [1, 3])
+
+        client = self.app.test_client()
+        self.assertEqual(client.post('/saved_recipes', json={'save': [2]}).status_code, 302)
+        client.post('/auth/login', data={'email': 'test@example.com', 'password': 'cat'})
+        response = client.post('/saved_recipes', json={'save': [2], 'unsave': [1, 3]})
+        self.assertEqual(response.get_json(), {'saved_count': 1})
+        self.assertEqual(client.post('/saved_recipes', json={'save': ['x']}).status_code, 400)
+        self.assertEqual(client.post('/saved_recipes', json={'save': [True]}).status_code, 400)
+        response = client.get('/view_saved_recipes')
+        self.assertIn(b'Saved Recipes', response.data)
+        self.assertIn(b'order the recipes were added to the catalog', response.data)
+
+    def test_parse_spoonacular_response(self):
+        populate_with_dummy_data()
+        def ingredient(name, amount, unit):
+            return {'name': name, 'measures': {'metric': {'amount': amount, 'unitShort': unit}}}
+        response = [
+            {'title': 'brine', 'readyInMinutes': 5, 'spoonacularScore': 45, 'instructions': 'Mix.',
+             'extendedIngredients': [ingredient('water', 250, 'ml'), ingredient('salt', 30, 'g'), {'name': 'love'}]},
+            {'title': 'pickles', 'preparationMinutes': 10, 'cookingMinutes': 20,
+             'analyzedInstructions': [{'name': '', 'steps': [{'number': 1, 'step': 'Slice.'}, {'number': 2, 'step': 'Soak.'}]}],
+             'extendedIngredients': [ingredient('cucumber', 2, ''), ingredient('dill', 5, 'g'), ingredient('salt', 10, 'g')]},
+        ]
+        stats = parse_spoonacular_response(response, "dinner")
+        self.assertEqual((stats['recipes'], stats['ingredient_lines'], stats['new_ingredients']), (2, 5, 1))
+        self.assertEqual(set(stats['stages']), {'parse', 'resolve', 'insert', 'commit'})
+        # ingredients already in the catalog are linked instead of dropped
+        brine = get_recipe(4)
+        self.assertEqual([(i.name, i.amount) for i in brine.ingredients], [("water", 250), ("salt", 30)])
+        self.assertEqual((brine.time, brine.rating), (5, 3))
+        self.assertEqual(db.session.query(Recipe.steps).filter_by(id=4).scalar(), 'Mix.')
+        pickles = get_recipe(5)
+        self.assertEqual([i.name for i in pickles.ingredients], ["cucumber", "salt", "dill"])
+        self.assertEqual(pickles.time, 30)
+        self.assertEqual(db.session.query(Recipe.steps).filter_by(id=5).scalar(), 'Slice.\nSoak.\n')
+        self.assertEqual(search_recipe_by_ingredient("", [6, 7]), [1, 3, 4])
+
+        # re-ingesting is a no-op, and a changed recipe is updated in place
+        for recipe_id, recipe in enumerate(response):
+            recipe['id'] = 100 + recipe_id
+        db.session.query(RI_Association).filter(RI_Association.r_id > 3).delete()
+        db.session.query(Recipe).filter(Recipe.id > 3).delete()
+        db.session.commit()
+        self.assertEqual(parse_spoonacular_response(response, "dinner")['recipes'], 2)
+        stats = parse_spoonacular_response(response, "dinner")
+        self.assertEqual((stats['recipes'], stats['unchanged']), (0, 2))
+        response[0]['title'] = 'strong brine'
+        response[0]['extendedIngredients'][1] = ingredient('salt', 60, 'g')
+        stats = parse_spoonacular_response(response, "dinner")
+        self.assertEqual((stats['recipes'], stats['updated'], stats['unchanged']), (1, 1, 1))
+        self.assertEqual(db.session.query(Recipe).count(), 5)
+        brine = db.session.query(Recipe).filter_by(spoonacular_id=100).one()
+        self.assertEqual(get_recipe(brine.id).name, 'strong brine')
+        self.assertEqual([(i.name, i.amount) for i in get_recipe(brine.id).ingredients], [("water", 250), ("salt", 60)])
@@ -0,0 +1,325 @@
+import json
+import os
+import requests
+import tempfile
+import threading
+import time
+import unittest
+from datetime import datetime
+from unittest import mock
+from app import create_app, db
+from app.models import Recipe, SyncState, populate_with_dummy_data
+from app.hybrid_search import hybrid_search, get_ingestion_queue, get_remote_search_cache, \
+    start_remote_search
+from app.sync import sync_catalog, acquire_sync_lock, LOCK_NAME
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+from app.integrations.spoonacular_module import spoonacular_module, TokenBucket
+from app.integrations.response_cache import DiskResponseCache, ResponseCacheMiss
+
+
+# Minimal local stand-in for the spoonacular api. Every request is recorded, and
+# the first `failures` requests of a path answer 503 to exercise the retries.
+class StubSpoonacular():
+    def __init__(self, failures=None, delay=0):
+        self.requests = []
+        self.failures = dict(failures or {})
+        self.delay = delay
+        self.active = 0
+        self.max_active = 0
+        self.lock = threading.Lock()
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                url = urlparse(self.path)
+                query = {k: v[0] for k, v in parse_qs(url.query).items()}
+                status, body = stub.handle(url.path, query)
+                data = json.dumps(body).encode()
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def log_message(self, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.url = 'http://127.0.0.1:%d' % self.server.server_address[1]
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+
+    def handle(self, path, query):
+        with self.lock:
+            self.requests.append((path, query))
+            self.active += 1
+            self.max_active = max(self.max_active, self.active)
+            failing = self.failures.get(path, 0) > 0
+            if failing:
+                self.failures[path] -= 1
+        try:
+            time.sleep(self.delay)
+            if failing:
+                return 503, {'status': 'failure'}
+            if path == '/recipes/random':
+                return 200, {'recipes': [{'id': n, 'title': query['tags'] + str(n)} for n in range(3)]}
+            if path == '/recipes/autocomplete':
+                return 200, [{'id': n, 'title': query['query'] + str(n)} for n in range(int(query['number']))]
+            if path == '/recipes/complexSearch':
+                # 25 recipes per meal type, ids 1000-1024 for breakfast and so on
+                base = {'breakfast': 1000, 'dinner': 2000}.get(query.get('type'), 3000)
+                offset, number = int(query['offset']), int(query['number'])
+                ids = range(base + offset, base + min(offset + number, 25))
+                return 200, {'results': [{'id': id} for id in ids], 'offset': offset, 'totalResults': 25}
+            if path == '/recipes/informationBulk':
+                return 200, [{'id': int(id), 'title': 'recipe ' + id} for id in query['ids'].split(',')]
+            return 404, {'status': 'failure'}
+        finally:
+            with self.lock:
+                self.active -= 1
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+class SpoonacularClientTestCase(unittest.TestCase):
+    def tearDown(self):
+        self.stub.close()
+
+    def client(self, **kwargs):
+        settings = dict(base_url=self.stub.url, secret='key', rate=0, max_workers=4, timeout=5)
+        settings.update(kwargs)
+        client = spoonacular_module(**settings)
+        client.backoff_base = 0.01
+        self.addCleanup(client.close)
+        return client
+
+    def test_random_recipes_for_tags(self):
+        self.stub = StubSpoonacular(delay=0.1)
+        recipes = self.client().get_random_recipes_for_tags(['breakfast', 'lunch', 'dinner'])
+        self.assertEqual(list(recipes), ['breakfast', 'lunch', 'dinner'])
+        self.assertEqual(recipes['lunch'][1]['title'], 'lunch1')
+        self.assertEqual(self.stub.max_active, 3)
+        self.assertEqual({query['apiKey'] for _, query in self.stub.requests}, {'key'})
+
+    def test_keyword_search_chunks_bulk_requests(self):
+        self.stub = StubSpoonacular(delay=0.05)
+        recipes = self.client(bulk_chunk_size=4, max_workers=2).get_recipes_by_keyword('soup', 10)
+        self.assertEqual([r['id'] for r in recipes], list(range(10)))
+        bulk = [query['ids'] for path, query in self.stub.requests if path == '/recipes/informationBulk']
+        self.assertEqual(sorted(bulk), ['0,1,2,3', '4,5,6,7', '8,9'])
+        self.assertLessEqual(self.stub.max_active, 2)
+
+    def test_retries(self):
+        self.stub = StubSpoonacular(failures={'/recipes/random': 2})
+        self.assertEqual(len(self.client().get_random_recipes('dinner')), 3)
+        self.assertEqual(len(self.stub.requests), 3)
+
+        self.stub.failures['/recipes/random'] = 5
+        with self.assertRaises(requests.HTTPError):
+            self.client(max_retries=1).get_random_recipes('dinner')
+
+    def test_retry_after(self):
+        self.stub = StubSpoonacular()
+        client = self.client()
+        client.backoff_cap = 10
+        with mock.patch('time.sleep') as sleep:
+            for retry_after, delay in (('3', 3), ('60', 10), ('-5', 0), ('nan', 0)):
+                client.sleep_before_retry(0, retry_after)
+                self.assertEqual(sleep.call_args[0][0], delay)
+
+    def test_token_bucket(self):
+        self.stub = StubSpoonacular()
+        now = [0.0]
+        waits = []
+        def sleep(seconds):
+            waits.append(seconds)
+            now[0] += seconds
+        bucket = TokenBucket(2, 3, clock=lambda: now[0], sleep=sleep)
+        for _ in range(7):
+            bucket.acquire()
+        # a burst of 3, then one request every half second
+        self.assertEqual(len(waits), 4)
+        self.assertAlmostEqual(now[0], 2.0)
+
+    def test_disk_cache_and_replay(self):
+        self.stub = StubSpoonacular()
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        cache = DiskResponseCache(directory.name, ttl=60)
+        first = self.client(cache_mode='cache', cache=cache).get_recipes_by_keyword('soup', 3)
+        self.assertEqual(len(self.stub.requests), 2)
+        # a new client with another api key reads the same entries without calling the api
+        again = self.client(cache_mode='cache', cache=cache, secret='other').get_recipes_by_keyword('soup', 3)
+        self.assertEqual(again, first)
+        self.assertEqual(len(self.stub.requests), 2)
+
+        cache.ttl = -1
+        self.client(cache_mode='cache', cache=cache).get_random_recipes('lunch')
+        self.assertEqual(len(self.stub.requests), 3)
+        # replay serves expired entries and never goes to the api
+        self.assertEqual(self.client(cache_mode='replay', cache=cache).get_recipes_by_keyword('soup', 3), first)
+        with self.assertRaises(ResponseCacheMiss):
+            self.client(cache_mode='replay', cache=cache).get_random_recipes('dinner')
+        self.assertEqual(len(self.stub.requests), 3)
+
+    def test_disk_cache_size_cap(self):
+        self.stub = StubSpoonacular()
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        cache = DiskResponseCache(directory.name, max_bytes=2000)
+        for n in range(20):
+            cache.set('/recipes/random', {'tags': str(n)}, ['x' * 100])
+            os.utime(cache.filename(cache.key('/recipes/random', {'tags': str(n)})), (n, n))
+        self.assertLessEqual(sum(size for _, size, _ in cache.entries()), 2000)
+        self.assertIsNotNone(cache.get('/recipes/random', {'tags': '19'}))
+        self.assertIsNone(cache.get('/recipes/random', {'tags': '0'}))
+
+
+class CatalogSyncTestCase(unittest.TestCase):
+    def setUp(self):
+        self.app = create_app('testing')
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        db.create_all()
+        self.stub = StubSpoonacular()
+        self.module = spoonacular_module(base_url=self.stub.url, secret='key', rate=0, bulk_chunk_size=4)
+
+    def tearDown(self):
+        self.module.close()
+        self.stub.close()
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+
+    def sync(self, **kwargs):
+        return sync_catalog(['tag:breakfast', 'tag:dinner'], module=self.module, page_size=10, **kwargs)
+
+    def test_sync_budget_and_watermarks(self):
+        # a page costs one search and three bulk requests for its 10 ids
+        stats = self.sync(budget=6)
+        self.assertEqual(stats['requests'], 6)
+        self.assertEqual(stats['recipes'], 10 + 4)
+        self.assertEqual(db.session.query(SyncState).get('tag:breakfast').watermark, 10)
+        self.assertEqual(db.session.query(SyncState).get('tag:dinner').watermark, 4)
+        self.assertEqual(db.session.query(Recipe).filter_by(spoonacular_id=2003, meal='dinner').count(), 1)
+
+        stats = self.sync(budget=100)
+        self.assertEqual(db.session.query(Recipe).count(), 50)
+        # both targets wrapped around after their last page
+        self.assertEqual(db.session.query(SyncState).get('tag:dinner').watermark, 0)
+
+        # the next run only finds recipes it already has, and fetches nothing
+        requests = len(self.stub.requests)
+        stats = self.sync(budget=100)
+        self.assertEqual((stats['fetched'], stats['seen']), (0, 50))
+        self.assertFalse(any(path == '/recipes/informationBulk' for path, _ in self.stub.requests[requests:]))
+
+    def test_sync_lock(self):
+        self.assertTrue(acquire_sync_lock('other node', 60))
+        self.assertIsNone(self.sync(budget=10))
+        self.assertEqual(len(self.stub.requests), 0)
+        # an expired lease can be taken over
+        self.assertTrue(acquire_sync_lock('other node', -1))
+        self.assertIsNotNone(self.sync(budget=10))
+        self.assertTrue(acquire_sync_lock('other node', 60))
+
+    def test_sync_lock_lost(self):
+        search_recipes = self.module.search_recipes
+
+        def search_and_lose_lock(*args):
+            # the lease runs out during the first page and another node takes the lock over
+            db.session.query(SyncState).filter_by(name=LOCK_NAME).update({SyncState.locked_until: datetime.utcnow()})
+            db.session.commit()
+            self.assertTrue(acquire_sync_lock('other node', 60))
+            return search_recipes(*args)
+        with mock.patch.object(self.module, 'search_recipes', side_effect=search_and_lose_lock):
+            stats = self.sync(budget=100)
+        self.assertTrue(stats['lock_lost'])
+        self.assertEqual(stats['pages'], 1)
+        # the run stopped without touching the other node's lock
+        self.assertEqual(db.session.query(SyncState).get(LOCK_NAME).locked_by, 'other node')
+        self.assertIsNone(self.sync(budget=10))
+
+
+class HybridSearchTestCase(unittest.TestCase):
+    def setUp(self):
+        self.app = create_app('testing')
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        db.create_all()
+        populate_with_dummy_data()
+
+    def tearDown(self):
+        get_ingestion_queue().join()
+        self.stub.close()
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+
+    def use_stub(self, delay=0):
+        self.stub = StubSpoonacular(delay=delay)
+        self.app.extensions['spoonacular_client'] = spoonacular_module(base_url=self.stub.url, secret='key', rate=0)
+        self.addCleanup(self.app.extensions['spoonacular_client'].close)
+
+    def test_top_up_from_remote(self):
+        self.use_stub()
+        results, remote = hybrid_search("water", [6, 7], min_results=5, deadline=5)
+        self.assertEqual(remote, 'ok')
+        self.assertEqual([(r.id, r.source) for r in results[:2]], [(1, 'local'), (3, 'local')])
+        self.assertEqual([(r.id, r.name, r.source) for r in results[2:4]],
+                         [(0, 'recipe 0', 'spoonacular'), (1, 'recipe 1', 'spoonacular')])
+        self.assertEqual(len(results), 12)
+        self.assertEqual(self.stub.requests[0], ('/recipes/autocomplete', {'query': 'water', 'number': '10', 'apiKey': 'key'}))
+
+        # the remote recipes were ingested in the background, and the lookup is cached
+        get_ingestion_queue().join()
+        requests = len(self.stub.requests)
+        results, remote = hybrid_search("water", [6, 7], min_results=5, deadline=5)
+        self.assertEqual(len(self.stub.requests), requests)
+        self.assertEqual(len(results), 12)
+        self.assertEqual({r.source for r in results}, {'local'})
+        self.assertEqual(results[2].name, 'recipe 0')
+
+        results, remote = hybrid_search("water", [6, 7], min_results=2)
+        self.assertEqual((len(results), remote), (2, 'skipped'))
+
+    def test_deadline(self):
+        self.use_stub(delay=0.5)
+        started = time.monotonic()
+        results, remote = hybrid_search("", [6, 7], min_results=5, deadline=0.1)
+        self.assertLess(time.monotonic() - started, 0.4)
+        self.assertEqual(remote, 'timeout')
+        self.assertEqual([r.id for r in results], [1, 3])
+        # the late answer still lands in the cache for the next search
+        for _ in range(50):
+            if get_remote_search_cache().get(('salt water', 10)) is not None:
+                break
+            time.sleep(0.1)
+        self.assertEqual(len(get_remote_search_cache().get(('salt water', 10))), 10)
+
+        self.app.config['HYBRID_SEARCH_DEADLINE'] = 5
+        response = self.app.test_client().get('/search_hybrid?ingredients=6&ingredients=7')
+        self.assertEqual(response.get_json()['remote'], 'ok')
+
+    def test_remote_lookup_only_when_used(self):
+        self.use_stub(delay=0.5)
+        self.app.config['HYBRID_SEARCH_WORKERS'] = 1
+        self.app.config['HYBRID_SEARCH_MAX_PENDING'] = 2
+        # enough local results, so no lookup is started at all
+        self.assertEqual(hybrid_search("", [6, 7], min_results=2)[1], 'skipped')
+        self.assertEqual(self.stub.requests, [])
+        # the first lookup runs past its deadline, the second is still queued behind it at its
+        # deadline and is cancelled, giving its slot back
+        self.assertEqual(hybrid_search("water", [6, 7], min_results=5, deadline=0.1)[1], 'timeout')
+        self.assertEqual(hybrid_search("salt", [6, 7], min_results=5, deadline=0.1)[1], 'timeout')
+        # with both slots taken a search doesn't look remotely
+        brine = start_remote_search("brine")
+        self.assertEqual(hybrid_search("pepper", [6, 7], min_results=5, deadline=0.1)[1], 'busy')
+        self.assertEqual(len(brine.result(timeout=5)), 10)
+        self.assertEqual([params['query'] for path, params in self.stub.requests if path == '/recipes/autocomplete'],
+                         ['water', 'brine'])
+        # finished and cancelled lookups gave their slots back
+        self.assertEqual(hybrid_search("pepper", [6, 7], min_results=5, deadline=5)[1], 'ok')